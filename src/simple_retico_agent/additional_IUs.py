@@ -35,6 +35,15 @@ class AudioFinalIU(retico_core.audio.AudioIU):
         )
         self.final = final
 
+    def __getstate__(self):
+        state = dict(super().__getstate__())
+        # the raw audio of the TTS's AudioFinalIUs are memoryview slices,
+        # that cannot be pickled
+        for name, value in state.items():
+            if isinstance(value, memoryview):
+                state[name] = value.tobytes()
+        return state
+
 
 class VADIU(retico_core.audio.AudioIU):
     """AudioIU enhanced by VADModule with VA for both user and agent.
@@ -59,3 +68,29 @@ class VADIU(retico_core.audio.AudioIU):
         super().__init__(**kwargs)
         self.va_user = va_user
         self.va_agent = va_agent
+
+
+class SpeechRecognitionTimedIU(retico_core.text.SpeechRecognitionIU):
+    """SpeechRecognitionIU with the position of the recognized word in the
+    audio stream received by the ASR.
+
+    Attributes:
+        start_sample (int): offset of the first sample of the word, in
+            the audio stream received by the ASR. None if unknown.
+        end_sample (int): offset of the last sample of the word, in the
+            audio stream received by the ASR. None if unknown.
+    """
+
+    @staticmethod
+    def type():
+        return "Speech Recognition Timed IU"
+
+    def __init__(
+        self,
+        start_sample=None,
+        end_sample=None,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.start_sample = start_sample
+        self.end_sample = end_sample
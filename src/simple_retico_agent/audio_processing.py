@@ -0,0 +1,583 @@
+"""
+Audio Processing
+================
+
+Streaming audio processing utilities used by the Simple Retico Agent's
+modules, working on int16-encoded raw audio chunks.
+
+The StreamingResampler is a NumPy polyphase resampler that keeps its
+filter state across the chunks, so that resampling a stream chunk by
+chunk gives the same result as resampling the whole stream at once
+(without artefacts at the chunk boundaries), and gives an exact number
+of output samples. It costs about twice the CPU time per chunk of
+pydub's resampling, which the SimpleVADModule uses by default.
+
+The VADCascade predicts the voice activity of fixed-size frames with a
+cascade of detectors of increasing cost : each stage only processes the
+frames flagged as speech candidates by the previous ones.
+
+The to_int16_chunks and split_chunks functions convert a synthesized
+waveform to int16 once, and split it into fixed-size chunks without
+copying it.
+
+The PlaybackClock is published by the SimpleSpeakerModule and read
+directly by the SimpleVADModule, to know the agent's voice activity at
+any time from the actual playback timeline, without waiting for the
+agent BOT and EOT messages.
+
+The PCMRingBuffer is a preallocated ring buffer of raw audio bytes,
+written by the SimpleSpeakerModule's update thread and read by its audio
+callback, so that the callback can read exactly the number of frames
+the audio output asks for, whatever the size of the received audio IUs.
+"""
+
+import math
+import threading
+import time
+import numpy as np
+import webrtcvad
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def to_int16_chunks(waveform, chunk_size):
+    """Converts a float waveform (in [-1, 1]) to int16, in a single
+    vectorized operation, into a buffer padded with silence to a whole
+    number of chunks.
+
+    Args:
+        waveform (list[float] or np.ndarray): the float waveform.
+        chunk_size (int): number of samples per chunk.
+
+    Returns:
+        np.ndarray: the int16 buffer.
+    """
+    waveform = np.asarray(waveform).reshape(-1)
+    n_chunks = -(-len(waveform) // chunk_size)
+    buffer = np.zeros(n_chunks * chunk_size, dtype=np.int16)
+    np.multiply(waveform, 32767, out=buffer[: len(waveform)], casting="unsafe")
+    return buffer
+
+
+def split_chunks(buffer, chunk_size):
+    """Splits an int16 buffer into chunks of raw audio, as memoryview slices
+    of the buffer (without copying it).
+
+    Args:
+        buffer (np.ndarray): the int16 buffer, containing a whole number
+            of chunks.
+        chunk_size (int): number of samples per chunk.
+
+    Returns:
+        list[memoryview]: the raw audio chunks.
+    """
+    view = memoryview(buffer).cast("B")
+    chunk_size_bytes = chunk_size * buffer.itemsize
+    return [
+        view[i : i + chunk_size_bytes] for i in range(0, len(view), chunk_size_bytes)
+    ]
+
+
+class StreamingResampler:
+    """Polyphase resampler converting a mono int16 audio stream from
+    input_rate to output_rate, chunk by chunk.
+
+    The stream is upsampled by `up`, lowpass filtered by a windowed-sinc
+    filter and downsampled by `down` (up / down = output_rate /
+    input_rate), the polyphase decomposition of the filter only
+    computing the output samples that are kept. The last input samples
+    are kept between chunks as filter history, and the total number of
+    output samples after N input samples is always ceil(N * up / down).
+
+    Only the filter bank is precomputed, the input windows and filter
+    phases of the output samples are computed for each chunk, so that the
+    memory used does not depend on the chunk sizes.
+    """
+
+    def __init__(
+        self,
+        input_rate,
+        output_rate,
+        taps_per_phase=48,
+        cutoff_ratio=0.9,
+        kaiser_beta=8.0,
+    ):
+        """Initializes the StreamingResampler.
+
+        Args:
+            input_rate (int): framerate of the input stream.
+            output_rate (int): framerate of the output stream.
+            taps_per_phase (int, optional): number of filter taps
+                applied to compute each output sample, the greater the
+                sharper (and costlier) the filter. Defaults to 48.
+            cutoff_ratio (float, optional): cutoff frequency of the
+                filter, relatively to the Nyquist frequency of the
+                lowest framerate. Defaults to 0.9.
+            kaiser_beta (float, optional): beta parameter of the Kaiser
+                window of the filter. Defaults to 8.0.
+        """
+        gcd = math.gcd(input_rate, output_rate)
+        self.input_rate = input_rate
+        self.output_rate = output_rate
+        self.up = output_rate // gcd
+        self.down = input_rate // gcd
+        self.taps_per_phase = taps_per_phase
+
+        # windowed-sinc lowpass filter, at the upsampled framerate
+        n_taps = self.up * taps_per_phase
+        cutoff = cutoff_ratio * 0.5 / max(self.up, self.down)
+        t = np.arange(n_taps) - (n_taps - 1) / 2
+        prototype = (
+            2 * cutoff * np.sinc(2 * cutoff * t) * np.kaiser(n_taps, kaiser_beta)
+        )
+        prototype *= self.up / prototype.sum()
+        # filter_bank[phase, k] = prototype[phase + k * up]
+        self.filter_bank = (
+            prototype.reshape(taps_per_phase, self.up).T.astype(np.float32).copy()
+        )
+        # reversed, to be applied to the input windows in increasing order
+        self._reversed_bank = self.filter_bank[:, ::-1].copy()
+
+        # stream state
+        self.n_input_samples = 0
+        self.n_output_samples = 0
+        self._buffer = np.zeros(taps_per_phase - 1, dtype=np.float32)
+
+    def reset(self):
+        """Resets the stream state (filter history and sample counters)."""
+        self.n_input_samples = 0
+        self.n_output_samples = 0
+        self._buffer[: self.taps_per_phase - 1] = 0
+
+    def n_output(self, n_input_samples):
+        """Returns the number of output samples produced after a total of
+        n_input_samples input samples.
+
+        Args:
+            n_input_samples (int): total number of input samples.
+
+        Returns:
+            int: total number of output samples.
+        """
+        return -(-n_input_samples * self.up // self.down)
+
+    def _get_windows(self, n_samples):
+        """Returns the positions, in the chunk buffer, of the input windows
+        used to compute each output sample of the next chunk, and the filter
+        phase of each output sample.
+
+        Args:
+            n_samples (int): number of samples in the next input chunk.
+
+        Returns:
+            (np.ndarray, np.ndarray): the start position of the
+                taps_per_phase input samples of each output sample, and
+                its filter phase.
+        """
+        n_out = np.arange(
+            self.n_output_samples,
+            self.n_output(self.n_input_samples + n_samples),
+            dtype=np.int64,
+        )
+        upsampled = n_out * self.down
+        base = upsampled // self.up
+        phases = upsampled - base * self.up
+        # the window of the output sample ends on the input sample `base`,
+        # whose position in the chunk buffer is base - n_input_samples +
+        # taps_per_phase - 1
+        return base - self.n_input_samples, phases
+
+    def process(self, raw_audio):
+        """Resamples a chunk of the stream.
+
+        Args:
+            raw_audio (bytes): the int16-encoded input chunk.
+
+        Returns:
+            bytes: the int16-encoded resampled chunk.
+        """
+        x = np.frombuffer(raw_audio, dtype=np.int16)
+        n_samples = len(x)
+        n_history = self.taps_per_phase - 1
+
+        # preallocated buffer : filter history followed by the new chunk
+        if len(self._buffer) < n_history + n_samples:
+            buffer = np.zeros(n_history + n_samples, dtype=np.float32)
+            buffer[:n_history] = self._buffer[:n_history]
+            self._buffer = buffer
+        self._buffer[n_history : n_history + n_samples] = x
+
+        starts, phases = self._get_windows(n_samples)
+        windows = sliding_window_view(
+            self._buffer[: n_history + n_samples], self.taps_per_phase
+        )
+        y = np.einsum("ij,ij->i", windows[starts], self._reversed_bank[phases])
+
+        # keep the last input samples as filter history
+        self._buffer[:n_history] = self._buffer[n_samples : n_samples + n_history]
+        self.n_input_samples += n_samples
+        self.n_output_samples += len(starts)
+
+        return np.clip(np.rint(y), -32768, 32767).astype(np.int16).tobytes()
+
+
+class VADCascade:
+    """Voice activity detection cascade, predicting the voice activity of
+    each frame of an int16 mono audio chunk :
+
+    1. a vectorized RMS energy gate, rejecting the clearly silent frames
+       (disabled if energy_threshold is None),
+    2. WebRTC's VAD, called on the frames above the energy threshold,
+    3. an optional neural VAD (an ONNX model taking a (n_frames,
+       n_samples) float32 batch of frames and returning one speech
+       probability per frame), called in a single batch on the frames
+       flagged as speech by WebRTC's VAD.
+
+    The cascade keeps, for each stage, the number of frames it processed
+    and the CPU time it used, that can be retrieved with get_stats.
+    """
+
+    STAGES = ("energy", "webrtc", "neural")
+
+    def __init__(
+        self,
+        framerate=16000,
+        frame_length=0.02,
+        vad_aggressiveness=3,
+        energy_threshold=None,
+        neural_vad_path=None,
+        neural_vad_threshold=0.5,
+    ):
+        """Initializes the VADCascade.
+
+        Args:
+            framerate (int, optional): framerate of the audio, has to be
+                supported by WebRTC's VAD. Defaults to 16000.
+            frame_length (float, optional): duration of the frames, has
+                to be 0.01, 0.02 or 0.03. Defaults to 0.02.
+            vad_aggressiveness (int, optional): aggressiveness of
+                WebRTC's VAD. Defaults to 3.
+            energy_threshold (float, optional): RMS energy (in dBFS)
+                under which a frame is considered silent without calling
+                the next stages, None disables the energy gate. Defaults
+                to None.
+            neural_vad_path (str, optional): path to the ONNX neural VAD
+                model, None disables the neural stage. Defaults to None.
+            neural_vad_threshold (float, optional): speech probability
+                above which the neural VAD predicts speech. Defaults to
+                0.5.
+        """
+        if frame_length not in (0.01, 0.02, 0.03):
+            raise ValueError(
+                f"WebRTC's VAD only accepts 0.01, 0.02 or 0.03s frames : {frame_length}"
+            )
+        self.framerate = framerate
+        self.frame_length = frame_length
+        self.frame_samples = round(framerate * frame_length)
+        self.webrtc_vad = webrtcvad.Vad(vad_aggressiveness)
+        self.energy_threshold = energy_threshold
+        self.rms_threshold = (
+            32768 * 10 ** (energy_threshold / 20)
+            if energy_threshold is not None
+            else None
+        )
+        self.neural_vad_threshold = neural_vad_threshold
+        self.neural_vad = None
+        if neural_vad_path is not None:
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = 1
+            options.inter_op_num_threads = 1
+            self.neural_vad = onnxruntime.InferenceSession(
+                neural_vad_path, options, providers=["CPUExecutionProvider"]
+            )
+            self.neural_vad_input = self.neural_vad.get_inputs()[0].name
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Resets the cascade statistics."""
+        self.n_frames = 0
+        self.n_stage_frames = dict.fromkeys(self.STAGES, 0)
+        self.stage_cpu_time = dict.fromkeys(self.STAGES, 0.0)
+
+    def process(self, raw_audio):
+        """Predicts the voice activity of each frame of raw_audio.
+
+        Args:
+            raw_audio (bytes): int16-encoded mono audio, containing a
+                whole number of frames.
+
+        Returns:
+            np.ndarray: the boolean voice activity of each frame.
+        """
+        frames = np.frombuffer(raw_audio, dtype=np.int16).reshape(
+            -1, self.frame_samples
+        )
+        n_frames = len(frames)
+        self.n_frames += n_frames
+
+        # stage 1 : energy gate
+        if self.rms_threshold is not None:
+            start = time.thread_time()
+            squares = np.einsum("ij,ij->i", frames, frames, dtype=np.float64)
+            candidates = np.flatnonzero(
+                squares >= self.rms_threshold**2 * self.frame_samples
+            )
+            self.stage_cpu_time["energy"] += time.thread_time() - start
+            self.n_stage_frames["energy"] += n_frames
+        else:
+            candidates = np.arange(n_frames)
+
+        # stage 2 : WebRTC's VAD
+        start = time.thread_time()
+        raw_frames = memoryview(raw_audio)
+        frame_size = self.frame_samples * 2
+        self.n_stage_frames["webrtc"] += len(candidates)
+        is_speech = [
+            self.webrtc_vad.is_speech(
+                raw_frames[i * frame_size : (i + 1) * frame_size], self.framerate
+            )
+            for i in candidates
+        ]
+        candidates = candidates[np.array(is_speech, dtype=bool)]
+        self.stage_cpu_time["webrtc"] += time.thread_time() - start
+
+        # stage 3 : neural VAD, on a single batch of candidate frames
+        if self.neural_vad is not None and len(candidates) != 0:
+            start = time.thread_time()
+            batch = frames[candidates].astype(np.float32) / 32768.0
+            probabilities = self.neural_vad.run(
+                None, {self.neural_vad_input: batch}
+            )[0].reshape(-1)
+            candidates = candidates[probabilities >= self.neural_vad_threshold]
+            self.stage_cpu_time["neural"] += time.thread_time() - start
+            self.n_stage_frames["neural"] += len(batch)
+
+        va = np.zeros(n_frames, dtype=bool)
+        va[candidates] = True
+        return va
+
+    def get_stats(self):
+        """Returns the cascade statistics : the share of the frames processed
+        by each stage, and the CPU time used by each stage per second of
+        audio.
+
+        Returns:
+            dict: the statistics.
+        """
+        audio_duration = self.n_frames * self.frame_length
+        stats = {"audio_duration": audio_duration}
+        for stage in self.STAGES:
+            stats[f"{stage}_frames_ratio"] = (
+                self.n_stage_frames[stage] / self.n_frames if self.n_frames else None
+            )
+            stats[f"{stage}_cpu_per_second"] = (
+                self.stage_cpu_time[stage] / audio_duration if audio_duration else None
+            )
+        stats["cpu_per_second"] = (
+            sum(self.stage_cpu_time.values()) / audio_duration
+            if audio_duration
+            else None
+        )
+        return stats
+
+
+class PlaybackClock:
+    """Playback timeline of the agent's audio, written by the speaker's
+    audio callback (single writer) and read by other modules' threads.
+
+    The clock keeps the number of samples played, the current agent turn
+    and the latest played buffers as segments (start time, end time,
+    agent active, turn id). Every update replaces the clock's immutable
+    state tuple by a new one, the readers thus always get a consistent
+    snapshot without any lock (the assignment of a reference is atomic).
+
+    Times are UNIX timestamps (time.time()), like the IUs' created_at.
+    """
+
+    def __init__(self, rate, history_size=64):
+        """Initializes the PlaybackClock.
+
+        Args:
+            rate (int): framerate of the played audio.
+            history_size (int, optional): number of played buffers kept
+                as segments. Defaults to 64.
+        """
+        self.rate = rate
+        self.history_size = history_size
+        # (samples_played, turn_id, agent_active, segments, transitions)
+        # transitions : time of the latest agent BOT and EOT, per turn
+        self._state = (0, 0, False, (), {})
+
+    def push(self, n_samples, agent_active, output_latency=0.0):
+        """Records a buffer handed to the audio output. Called by the
+        speaker's audio callback only.
+
+        Args:
+            n_samples (int): number of samples of the buffer.
+            agent_active (bool): True if the buffer contains agent
+                audio, False if it is silence.
+            output_latency (float, optional): time (in seconds) before
+                the buffer's first sample is actually played (from
+                PortAudio's time_info), if it is unknown (0.0), the
+                buffer is considered played right after the previous
+                one. Defaults to 0.0.
+        """
+        samples_played, turn_id, was_active, segments, transitions = self._state
+        now = time.time()
+        if output_latency > 0:
+            start = now + output_latency
+        elif len(segments) != 0 and segments[-1][1] > now:
+            # no latency information : the buffer follows the previous one
+            start = segments[-1][1]
+        else:
+            start = now
+        end = start + n_samples / self.rate
+        if agent_active and not was_active:
+            turn_id += 1
+            transitions = {**transitions, (turn_id, "agent_BOT"): start}
+        elif was_active and not agent_active:
+            transitions = {**transitions, (turn_id, "agent_EOT"): start}
+        if len(transitions) > 2 * self.history_size:
+            transitions = dict(list(transitions.items())[-self.history_size :])
+        segment = (start, end, agent_active, turn_id)
+        self._state = (
+            samples_played + n_samples,
+            turn_id,
+            agent_active,
+            (segments + (segment,))[-self.history_size :],
+            transitions,
+        )
+
+    def snapshot(self):
+        """Returns the number of samples played, the current agent turn id,
+        and whether the agent is currently active.
+
+        Returns:
+            (int, int, bool): the clock's state.
+        """
+        samples_played, turn_id, agent_active, _, _ = self._state
+        return samples_played, turn_id, agent_active
+
+    def agent_activity(self, start, end):
+        """Returns the share of the [start, end] time interval during which
+        agent audio was played.
+
+        Args:
+            start (float): start of the interval (UNIX timestamp).
+            end (float): end of the interval (UNIX timestamp).
+
+        Returns:
+            float: the share of the interval, between 0 and 1.
+        """
+        segments = self._state[3]
+        if end <= start:
+            return 0.0
+        active = 0.0
+        for seg_start, seg_end, agent_active, _ in reversed(segments):
+            if seg_end <= start:
+                break
+            if agent_active:
+                active += max(0.0, min(end, seg_end) - max(start, seg_start))
+        return active / (end - start)
+
+    def transition_time(self, turn_id, event):
+        """Returns the time at which the agent BOT or EOT of a turn was
+        actually played.
+
+        Args:
+            turn_id (int): id of the agent turn.
+            event (str): "agent_BOT" or "agent_EOT".
+
+        Returns:
+            float: the UNIX timestamp, or None if unknown.
+        """
+        return self._state[4].get((turn_id, event))
+
+
+class PCMRingBuffer:
+    """Preallocated ring buffer of raw audio bytes, with a single writer and
+    a single reader thread.
+
+    The read and write positions are the total numbers of bytes read and
+    written since the creation of the buffer, so that positions in the
+    audio stream (e.g. the start of an agent turn) can be compared to
+    them.
+    """
+
+    def __init__(self, capacity):
+        """Initializes the PCMRingBuffer.
+
+        Args:
+            capacity (int): size of the buffer, in bytes.
+        """
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=np.uint8)
+        self.read_position = 0
+        self.write_position = 0
+        self.closed = False
+        self._cond = threading.Condition()
+
+    def available(self):
+        """Returns the number of bytes that can be read.
+
+        Returns:
+            int: the number of bytes.
+        """
+        return self.write_position - self.read_position
+
+    def write(self, data):
+        """Writes audio to the buffer, waiting for the reader to free enough
+        space if the buffer is full.
+
+        Args:
+            data (bytes): the audio.
+
+        Returns:
+            int: the number of bytes written (less than len(data) only if
+                the buffer was closed while waiting).
+        """
+        data = np.frombuffer(data, dtype=np.uint8)
+        written = 0
+        while written < len(data):
+            with self._cond:
+                while not self.closed and self.available() == self.capacity:
+                    self._cond.wait()
+                if self.closed:
+                    return written
+                n = min(len(data) - written, self.capacity - self.available())
+                start = self.write_position % self.capacity
+                first = min(n, self.capacity - start)
+                self.buffer[start : start + first] = data[written : written + first]
+                self.buffer[: n - first] = data[written + first : written + n]
+                self.write_position += n
+                written += n
+        return written
+
+    def read_into(self, out):
+        """Reads audio from the buffer into a writable buffer, without
+        waiting.
+
+        Args:
+            out (memoryview): the destination, filled from its start.
+
+        Returns:
+            int: the number of bytes read (less than len(out) if not
+                enough audio is available).
+        """
+        out = np.frombuffer(out, dtype=np.uint8)
+        with self._cond:
+            n = min(len(out), self.available())
+            start = self.read_position % self.capacity
+            first = min(n, self.capacity - start)
+            out[:first] = self.buffer[start : start + first]
+            out[first:n] = self.buffer[: n - first]
+            self.read_position += n
+            self._cond.notify()
+        return n
+
+    def close(self):
+        """Closes the buffer, releasing the writer if it is waiting."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
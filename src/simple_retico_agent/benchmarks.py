@@ -0,0 +1,1029 @@
+"""
+Benchmarks
+==========
+
+Micro-benchmarks and evaluations of the performance-critical parts of
+the Simple Retico Agent's modules. Each benchmark can be executed from
+the command line, for example :
+
+.. code-block:: bash
+
+    python benchmarks.py asr_engine --n_streams 1 2 4 8
+    python benchmarks.py pipeline conversation.json --output results.json
+    python benchmarks.py tcp_bridge --n_ius 1000
+"""
+
+import argparse
+import json
+import threading
+import time
+import numpy as np
+
+
+def load_wav(path, samplerate=16000):
+    """Loads a mono 16-bit wav file as a float32 numpy array.
+
+    Args:
+        path (str): path to the wav file.
+        samplerate (int, optional): expected framerate of the file.
+            Defaults to 16000.
+
+    Returns:
+        np.ndarray: the float32 audio.
+    """
+    import wave
+
+    with wave.open(path, "rb") as f:
+        if f.getframerate() != samplerate or f.getnchannels() != 1:
+            raise ValueError(f"{path} should be a mono {samplerate}Hz wav file")
+        raw_audio = f.readframes(f.getnframes())
+    return np.frombuffer(raw_audio, dtype=np.int16).astype(np.float32) / 32768.0
+
+
+def benchmark_asr_engine(
+    n_streams_list=(1, 2, 4, 8),
+    whisper_model="distil-large-v2",
+    device=None,
+    wav_path=None,
+    turn_duration=4.0,
+    interim_period=0.3,
+    max_batch_size=8,
+):
+    """Measures the aggregate real-time factor and the per-stream latency
+    of the WhisperASREngine as the number of concurrent streams scales.
+
+    Each stream simulates a user turn of turn_duration seconds : it
+    submits an interim hypothesis request on the audio received so far
+    every interim_period seconds, and a final request at the end of the
+    turn, as a SimpleWhisperASRModule would do.
+
+    Args:
+        n_streams_list (list[int], optional): the numbers of concurrent
+            streams to benchmark. Defaults to (1, 2, 4, 8).
+        whisper_model (str, optional): name of the faster_whisper
+            model. Defaults to "distil-large-v2".
+        device (str, optional): device of the engine. Defaults to None.
+        wav_path (str, optional): 16kHz mono wav file used as user
+            speech, white noise is used if None. Defaults to None.
+        turn_duration (float, optional): duration of each user turn.
+            Defaults to 4.0.
+        interim_period (float, optional): period of the interim
+            requests. Defaults to 0.3.
+        max_batch_size (int, optional): maximum batch size of the
+            engine. Defaults to 8.
+
+    Returns:
+        list[dict]: the engine statistics for each number of streams.
+    """
+    from simple_retico_agent.whisper_asr_engine import WhisperASREngine
+
+    if wav_path is not None:
+        audio = load_wav(wav_path)
+    else:
+        audio = np.random.default_rng(0).normal(
+            0, 0.05, int(turn_duration * 16000)
+        ).astype(np.float32)
+    audio = audio[: int(turn_duration * 16000)]
+
+    results = []
+    for n_streams in n_streams_list:
+        engine = WhisperASREngine(
+            whisper_model=whisper_model, device=device, max_batch_size=max_batch_size
+        )
+        engine.start()
+        # warm-up
+        engine.transcribe(audio[:16000], stream_id="warmup", final=True)
+        engine.reset_stats()
+
+        def stream(stream_id):
+            start = time.perf_counter()
+            elapsed = 0.0
+            while elapsed < turn_duration:
+                engine.transcribe(
+                    audio[: int(elapsed * 16000) + 1600], stream_id=stream_id
+                )
+                next_request = elapsed + interim_period
+                elapsed = time.perf_counter() - start
+                time.sleep(max(0.0, next_request - elapsed))
+                elapsed = time.perf_counter() - start
+            engine.transcribe(audio, stream_id=stream_id, final=True)
+
+        threads = [
+            threading.Thread(target=stream, args=(f"stream_{i}",))
+            for i in range(n_streams)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        engine.stop()
+
+        stats = engine.get_stats()
+        stats["n_streams"] = n_streams
+        results.append(stats)
+        p50s = [s["latency_p50"] for s in stats["streams"].values()]
+        p95s = [s["latency_p95"] for s in stats["streams"].values()]
+        print(
+            f"n_streams={n_streams:3d}  rtf={stats['rtf']:.3f}  "
+            f"mean_batch={stats['mean_batch_size']:.2f}  "
+            f"latency_p50={np.mean(p50s) * 1000:.1f}ms  "
+            f"latency_p95={np.max(p95s) * 1000:.1f}ms"
+        )
+    return results
+
+
+def benchmark_resampling(
+    input_rate=44100, output_rate=16000, frame_length=0.02, n_chunks=5000
+):
+    """Measures the time (in microseconds) needed to resample one audio
+    chunk, with the StreamingResampler used by the SimpleVADModule, and with
+    the per-chunk pydub resampling.
+
+    Args:
+        input_rate (int, optional): microphone framerate. Defaults to
+            44100.
+        output_rate (int, optional): VAD framerate. Defaults to 16000.
+        frame_length (float, optional): duration of the microphone
+            chunks. Defaults to 0.02.
+        n_chunks (int, optional): number of chunks resampled. Defaults
+            to 5000.
+
+    Returns:
+        dict: the microseconds per chunk of each method.
+    """
+    import pydub
+    from simple_retico_agent.audio_processing import StreamingResampler
+
+    chunk_size = int(input_rate * frame_length)
+    t = np.arange(chunk_size * n_chunks) / input_rate
+    audio = (np.sin(2 * np.pi * 440 * t) * 10000).astype(np.int16)
+    chunks = [
+        audio[i * chunk_size : (i + 1) * chunk_size].tobytes() for i in range(n_chunks)
+    ]
+
+    resampler = StreamingResampler(input_rate, output_rate)
+    start = time.perf_counter()
+    for chunk in chunks:
+        resampler.process(chunk)
+    numpy_us = (time.perf_counter() - start) / n_chunks * 1e6
+
+    start = time.perf_counter()
+    for chunk in chunks:
+        s = pydub.AudioSegment(
+            chunk, sample_width=2, channels=1, frame_rate=input_rate
+        )
+        s.set_frame_rate(output_rate)._data
+    pydub_us = (time.perf_counter() - start) / n_chunks * 1e6
+
+    print(
+        f"{input_rate}Hz -> {output_rate}Hz, {chunk_size} samples per chunk : "
+        f"numpy {numpy_us:.1f}us/chunk, pydub {pydub_us:.1f}us/chunk"
+    )
+    return {"numpy": numpy_us, "pydub": pydub_us}
+
+
+def benchmark_tts_chunking(
+    clause_durations=(2, 10, 30, 60),
+    samplerate=22050,
+    frame_duration=0.2,
+    n_runs=20,
+):
+    """Measures the time needed to convert a synthesized clause (a float32
+    waveform, as in coqui's TTS outputs) to int16 and split it into the
+    raw_audio of fixed-size AudioFinalIUs : with the previous per-chunk
+    conversion and padding, and with the single conversion and memoryview
+    slicing of the SimpleTTSModule.
+
+    Args:
+        clause_durations (list[float], optional): durations of the
+            synthesized clauses, in seconds. Defaults to (2, 10, 30,
+            60).
+        samplerate (int, optional): framerate of the synthesized audio.
+            Defaults to 22050.
+        frame_duration (float, optional): duration of the AudioFinalIUs.
+            Defaults to 0.2.
+        n_runs (int, optional): number of runs per clause. Defaults to
+            20.
+
+    Returns:
+        dict[float, dict]: the milliseconds per clause of each method.
+    """
+    from simple_retico_agent.audio_processing import split_chunks, to_int16_chunks
+
+    chunk_size = int(samplerate * frame_duration)
+    chunk_size_bytes = chunk_size * 2
+
+    def per_chunk(wav):
+        chunks = []
+        i = 0
+        while i < len(wav):
+            chunk = wav[i : i + chunk_size]
+            chunk = (np.array(chunk) * 32767).astype(np.int16).tobytes()
+            if len(chunk) <= chunk_size_bytes:
+                chunk = chunk + b"\x00" * (chunk_size_bytes - len(chunk))
+            i += chunk_size
+            chunks.append(chunk)
+        return chunks
+
+    def single_conversion(wav):
+        return split_chunks(to_int16_chunks(wav, chunk_size), chunk_size)
+
+    rng = np.random.default_rng(0)
+    results = {}
+    for duration in clause_durations:
+        wav = rng.uniform(-0.5, 0.5, int(duration * samplerate)).astype(np.float32)
+        assert b"".join(per_chunk(wav)) == b"".join(single_conversion(wav))
+        results[duration] = {}
+        for name, method in [
+            ("per_chunk", per_chunk),
+            ("single_conversion", single_conversion),
+        ]:
+            start = time.perf_counter()
+            for _ in range(n_runs):
+                method(wav)
+            results[duration][name] = (time.perf_counter() - start) / n_runs * 1000
+        print(
+            f"{duration:5.0f}s clause : per chunk "
+            f"{results[duration]['per_chunk']:.2f}ms, single conversion "
+            f"{results[duration]['single_conversion']:.2f}ms"
+        )
+    return results
+
+
+def evaluate_endpointing(session_paths, detector_kwargs=None, endpointer_kwargs=None):
+    """Replays sessions recorded by SimpleWhisperASRModules (cf. its
+    session_record_path parameter) to evaluate the AdaptiveEndpointer :
+    reports the latency saved compared to the fixed silence_dur EOT,
+    against the number of premature cut-offs of the user turns.
+
+    Args:
+        session_paths (list[str]): paths to the recorded sessions.
+        detector_kwargs (dict, optional): VATurnDetector parameters.
+            Defaults to None.
+        endpointer_kwargs (dict, optional): AdaptiveEndpointer
+            parameters. Defaults to None.
+
+    Returns:
+        dict: the aggregated evaluation.
+    """
+    from simple_retico_agent.turn_detection import replay_endpointing
+
+    n_turns, n_premature, latencies_saved = 0, 0, []
+    for path in session_paths:
+        result = replay_endpointing(path, detector_kwargs, endpointer_kwargs)
+        n_turns += result["n_turns"]
+        n_premature += result["n_premature"]
+        latencies_saved.extend(result["latencies_saved"])
+        print(
+            f"{path} : {result['n_turns']} turns, "
+            f"{len(result['latencies_saved'])} early EOTs, "
+            f"{result['n_premature']} premature cut-offs"
+        )
+
+    evaluation = {
+        "n_turns": n_turns,
+        "n_early_eots": len(latencies_saved),
+        "n_premature": n_premature,
+        "premature_rate": n_premature / n_turns if n_turns else None,
+        "mean_latency_saved": (
+            float(np.mean(latencies_saved)) if latencies_saved else 0.0
+        ),
+        "total_latency_saved": float(np.sum(latencies_saved)),
+    }
+    print(
+        f"total : {n_turns} turns, mean latency saved "
+        f"{evaluation['mean_latency_saved'] * 1000:.0f}ms, "
+        f"premature cut-offs {n_premature}"
+        + (f" ({evaluation['premature_rate']:.1%})" if n_turns else "")
+    )
+    return evaluation
+
+
+def evaluate_vad_cascade(
+    configurations=None,
+    noise_paths=None,
+    speech_paths=None,
+    frame_length=0.02,
+    detector_kwargs=None,
+):
+    """Evaluates VADCascade configurations : measures the CPU time each
+    configuration needs per second of audio, and its false user BOT rate,
+    i.e. the number of BOTs the VATurnDetector predicts per minute of audio
+    containing no user speech. The number of BOTs predicted on audio
+    containing user speech is also reported, to check that the cascade
+    does not miss the user turns.
+
+    Args:
+        configurations (dict[str, dict], optional): the VADCascade
+            parameters of each configuration. Defaults to None
+            (WebRTC's VAD alone, and with a -50dBFS energy gate).
+        noise_paths (list[str], optional): 16kHz mono wav files
+            containing no user speech, synthetic noise bursts are used
+            if None. Defaults to None.
+        speech_paths (list[str], optional): 16kHz mono wav files
+            containing user speech. Defaults to None.
+        frame_length (float, optional): duration of the VAD frames.
+            Defaults to 0.02.
+        detector_kwargs (dict, optional): VATurnDetector parameters.
+            Defaults to None.
+
+    Returns:
+        dict[str, dict]: the evaluation of each configuration.
+    """
+    from simple_retico_agent.audio_processing import VADCascade
+    from simple_retico_agent.turn_detection import VATurnDetector
+
+    if configurations is None:
+        configurations = {
+            "webrtc": {},
+            "energy+webrtc": {"energy_threshold": -50},
+        }
+
+    def to_int16(audio):
+        return (np.clip(audio, -1, 1) * 32767).astype(np.int16)
+
+    if noise_paths is None:
+        # background hum, with bursts of loud white noise
+        rng = np.random.default_rng(0)
+        t = np.arange(16000 * 60) / 16000
+        noise = 0.002 * np.sin(2 * np.pi * 50 * t) + rng.normal(0, 0.001, len(t))
+        for start in rng.integers(0, len(t) - 8000, 20):
+            noise[start : start + 8000] += rng.normal(0, 0.1, 8000)
+        noises = [to_int16(noise)]
+    else:
+        noises = [to_int16(load_wav(path)) for path in noise_paths]
+    speeches = [to_int16(load_wav(path)) for path in speech_paths or []]
+
+    def count_bots(cascade, audios):
+        n_bots = 0
+        for audio in audios:
+            detector = VATurnDetector(**(detector_kwargs or {}))
+            n_frames = len(audio) // cascade.frame_samples
+            va = cascade.process(audio[: n_frames * cascade.frame_samples].tobytes())
+            for va_user in va:
+                if detector.update(va_user, frame_length) == "user_BOT":
+                    n_bots += 1
+        return n_bots
+
+    results = {}
+    for name, kwargs in configurations.items():
+        cascade = VADCascade(frame_length=frame_length, **kwargs)
+        n_false_bots = count_bots(cascade, noises)
+        stats = cascade.get_stats()
+        noise_minutes = stats["audio_duration"] / 60
+        results[name] = {
+            "cpu_per_second": stats["cpu_per_second"],
+            "false_bots_per_minute": n_false_bots / noise_minutes,
+            "speech_bots": count_bots(cascade, speeches) if speeches else None,
+            "stats": stats,
+        }
+        print(
+            f"{name:30s} cpu {stats['cpu_per_second'] * 1000:.2f}ms/s  "
+            f"false BOTs {results[name]['false_bots_per_minute']:.1f}/min"
+            + (
+                f"  speech BOTs {results[name]['speech_bots']}"
+                if speeches
+                else ""
+            )
+        )
+    return results
+
+
+def benchmark_tts_first_chunk(
+    models=None,
+    text="Hello, I am your assistant, how can I help you today?",
+    device=None,
+    n_runs=3,
+):
+    """Measures, for each model of SimpleTTSModule.LANGUAGE_MAPPING, the
+    time-to-first-audio of the streaming synthesis (time until the first
+    audio chunk is synthesized), compared to the synthesis time of the
+    whole clause.
+
+    Args:
+        models (list[tuple[str, str]], optional): the (language, model)
+            pairs to benchmark, all models of LANGUAGE_MAPPING if None.
+            Defaults to None.
+        text (str, optional): the synthesized clause. Defaults to
+            "Hello, I am your assistant, how can I help you today?".
+        device (str, optional): device of the models. Defaults to None.
+        n_runs (int, optional): number of runs per model, after a
+            warm-up run. Defaults to 3.
+
+    Returns:
+        dict[str, dict]: the median latencies (in seconds) of each model.
+    """
+    from simple_retico_agent.simple_tts import SimpleTTSModule
+
+    if models is None:
+        models = [
+            (language, model)
+            for language, language_models in SimpleTTSModule.LANGUAGE_MAPPING.items()
+            for model in language_models
+        ]
+
+    results = {}
+    for language, model in models:
+        try:
+            tts = SimpleTTSModule(
+                model=model, language=language, device=device, streaming=True
+            )
+            tts.setup()
+            first_chunk_latencies, full_latencies = [], []
+            for run in range(n_runs + 1):
+                start = time.perf_counter()
+                stream = tts.synthesize_stream(text)
+                next(stream)
+                first_chunk = time.perf_counter() - start
+                for _ in stream:
+                    pass
+                start = time.perf_counter()
+                tts.synthesize(text)
+                full = time.perf_counter() - start
+                if run != 0:
+                    first_chunk_latencies.append(first_chunk)
+                    full_latencies.append(full)
+        except Exception as e:
+            print(f"{language}/{model} : failed ({e})")
+            continue
+        results[f"{language}/{model}"] = {
+            "first_chunk": float(np.median(first_chunk_latencies)),
+            "full_clause": float(np.median(full_latencies)),
+        }
+        print(
+            f"{language}/{model:12s} first chunk "
+            f"{results[f'{language}/{model}']['first_chunk'] * 1000:.0f}ms, "
+            f"full clause {results[f'{language}/{model}']['full_clause'] * 1000:.0f}ms"
+        )
+    return results
+
+
+def compare_waveforms(reference, estimate, n_fft=1024):
+    """Compares a synthesized waveform to a reference one (the lengths may
+    differ slightly, the longest is truncated).
+
+    Args:
+        reference (np.ndarray): the reference waveform.
+        estimate (np.ndarray): the compared waveform.
+        n_fft (int, optional): frame length of the spectra. Defaults to
+            1024.
+
+    Returns:
+        (float, float): the signal-to-noise ratio (in dB) and the
+            log-spectral distance (in dB) of the estimate.
+    """
+    length = min(len(reference), len(estimate))
+    reference = np.asarray(reference[:length], dtype=np.float64)
+    estimate = np.asarray(estimate[:length], dtype=np.float64)
+    noise = np.sum((reference - estimate) ** 2)
+    snr = 10 * np.log10(np.sum(reference**2) / max(noise, 1e-12))
+    n_frames = length // n_fft
+    if n_frames == 0:
+        return float(snr), None
+    window = np.hanning(n_fft)
+    spectra = [
+        np.abs(np.fft.rfft(x[: n_frames * n_fft].reshape(n_frames, n_fft) * window))
+        for x in (reference, estimate)
+    ]
+    log_ratio = 20 * np.log10((spectra[0] + 1e-8) / (spectra[1] + 1e-8))
+    lsd = np.mean(np.sqrt(np.mean(log_ratio**2, axis=1)))
+    return float(snr), float(lsd)
+
+
+def benchmark_tts_optimization(
+    models=None,
+    modes=("int8", "compile", "torchscript"),
+    text="Hello, I am your assistant, how can I help you today?",
+    cache_dir=None,
+    n_runs=3,
+):
+    """Measures, for each model of SimpleTTSModule.LANGUAGE_MAPPING, the
+    real-time factor (synthesis time / audio duration) of the optimized
+    CPU inference modes, and the quality of their audio compared to the
+    eager fp32 model (with the same random seed, as the VITS models are
+    stochastic).
+
+    Args:
+        models (list[tuple[str, str]], optional): the (language, model)
+            pairs to benchmark, all models of LANGUAGE_MAPPING if None.
+            Defaults to None.
+        modes (tuple[str], optional): the optimization modes. Defaults
+            to ("int8", "compile", "torchscript").
+        text (str, optional): the synthesized clause. Defaults to
+            "Hello, I am your assistant, how can I help you today?".
+        cache_dir (str, optional): directory of the cached optimized
+            models. Defaults to None.
+        n_runs (int, optional): number of runs per model and mode, after
+            the warm-up. Defaults to 3.
+
+    Returns:
+        dict[str, dict]: the real-time factor, SNR and log-spectral
+            distance of each model and mode.
+    """
+    import torch
+    from simple_retico_agent.simple_tts import SimpleTTSModule
+
+    if models is None:
+        models = [
+            (language, model)
+            for language, language_models in SimpleTTSModule.LANGUAGE_MAPPING.items()
+            for model in language_models
+        ]
+
+    results = {}
+    print(f"{'model':22s} {'mode':12s} {'RTF':>6s} {'SNR (dB)':>9s} {'LSD (dB)':>9s}")
+    for language, model in models:
+        reference = None
+        for mode in (None,) + tuple(modes):
+            name = f"{language}/{model}/{mode or 'fp32'}"
+            try:
+                tts = SimpleTTSModule(
+                    model=model,
+                    language=language,
+                    device="cpu",
+                    optimization=mode,
+                    optimization_cache_dir=cache_dir,
+                    warmup_text=text,
+                )
+                tts.setup()
+                rtfs = []
+                for _ in range(n_runs):
+                    torch.manual_seed(0)
+                    start = time.perf_counter()
+                    _, outputs = tts.synthesize(text)
+                    duration = time.perf_counter() - start
+                    wav = np.concatenate(
+                        [np.asarray(o["wav"]).reshape(-1) for o in outputs]
+                    )
+                    rtfs.append(duration / (len(wav) / tts.samplerate))
+            except Exception as e:
+                print(f"{name} : failed ({e})")
+                continue
+            snr, lsd = None, None
+            if mode is None:
+                reference = wav
+            elif reference is not None:
+                snr, lsd = compare_waveforms(reference, wav)
+            results[name] = {"rtf": float(np.median(rtfs)), "snr": snr, "lsd": lsd}
+            print(
+                f"{language + '/' + model:22s} {mode or 'fp32':12s} "
+                f"{results[name]['rtf']:6.3f} "
+                + (f"{snr:9.1f} " if snr is not None else f"{'-':>9s} ")
+                + (f"{lsd:9.2f}" if lsd is not None else f"{'-':>9s}")
+            )
+    return results
+
+
+BENCHMARK_IU_TYPES = ("VADIU", "SpeechRecognitionTimedIU", "TextFinalIU", "AudioFinalIU")
+# the raw audio of a VAD frame and of a TTS chunk, shared by the created IUs
+VAD_FRAME = bytes(640)
+TTS_CHUNK = bytes(19200)
+
+
+def make_benchmark_iu(name, iuid="benchmark:0", creator=None, previous_iu=None):
+    """Creates an IU of one of the types having a wire format (cf.
+    iu_serialization), with typical contents.
+
+    Args:
+        name (str): name of the IU type, in BENCHMARK_IU_TYPES.
+        iuid (str, optional): iuid of the IU. Defaults to "benchmark:0".
+        creator (object, optional): creator of the IU, a stand-in
+            module if None. Defaults to None.
+        previous_iu (retico_core.IncrementalUnit, optional): the previous
+            IU. Defaults to None.
+
+    Returns:
+        retico_core.IncrementalUnit: the IU.
+    """
+    import types
+    from simple_retico_agent.additional_IUs import (
+        AudioFinalIU,
+        SpeechRecognitionTimedIU,
+        TextFinalIU,
+        VADIU,
+    )
+
+    audio_fields = {"rate": 16000, "nframes": 320, "sample_width": 2}
+    # IU class and init arguments
+    ius = {
+        "VADIU": (
+            VADIU,
+            {
+                "raw_audio": VAD_FRAME,
+                **audio_fields,
+                "va_user": True,
+                "va_agent": False,
+            },
+        ),
+        "SpeechRecognitionTimedIU": (
+            SpeechRecognitionTimedIU,
+            {
+                "predictions": ["hello how are you"],
+                "text": "hello",
+                "stability": 0.0,
+                "confidence": 0.99,
+                "final": False,
+                "start_sample": 1600,
+                "end_sample": 6400,
+            },
+        ),
+        "TextFinalIU": (TextFinalIU, {"text": " Hello", "final": False}),
+        "AudioFinalIU": (
+            AudioFinalIU,
+            {
+                "raw_audio": TTS_CHUNK,
+                **audio_fields,
+                "rate": 48000,
+                "nframes": 9600,
+                "final": False,
+            },
+        ),
+    }
+    if name not in ius:
+        raise ValueError(f"unknown benchmark IU type : {name}")
+    cls, kwargs = ius[name]
+    if creator is None:
+        creator = types.SimpleNamespace(
+            id="benchmark",
+            name=lambda: "Benchmark Module",
+            description=lambda: "Benchmark Module",
+        )
+    common = {
+        "creator": creator,
+        "iuid": iuid,
+        "previous_iu": previous_iu,
+        "grounded_in": None,
+    }
+    return cls(**common, **kwargs)
+
+
+def make_benchmark_ius():
+    """Creates an IU of each type of BENCHMARK_IU_TYPES.
+
+    Returns:
+        dict[str, retico_core.IncrementalUnit]: the IUs, by type name.
+    """
+    return {
+        name: make_benchmark_iu(name, iuid=f"benchmark:{i}")
+        for i, name in enumerate(BENCHMARK_IU_TYPES)
+    }
+
+
+def benchmark_iu_serialization(n_runs=20000):
+    """Measures the time (in microseconds) needed to encode and decode an IU
+    of each type with the binary wire format, and its size, compared to
+    pickle.
+
+    Args:
+        n_runs (int, optional): number of encodings and decodings.
+            Defaults to 20000.
+
+    Returns:
+        dict[str, dict]: the encoding and decoding microseconds per IU
+            and the size in bytes of each format, by IU type.
+    """
+    import pickle
+    import retico_core
+    from simple_retico_agent.iu_serialization import IURegistry, IUSerializer
+
+    encoder = IUSerializer(IURegistry())
+    # a registry keeping no IU, so that every decoded IU is a new one
+    decoder = IUSerializer(IURegistry(max_ius=0))
+    results = {}
+    print(f"{'IU':26s} {'enc us':>8s} {'dec us':>8s} {'bytes':>7s} {'pickle':>7s}")
+    for name, iu in make_benchmark_ius().items():
+        um = retico_core.UpdateMessage.from_iu(iu, retico_core.UpdateType.ADD)
+        start = time.perf_counter()
+        for _ in range(n_runs):
+            data = encoder.encode_update_message(um)
+        encoding_us = (time.perf_counter() - start) / n_runs * 1e6
+        start = time.perf_counter()
+        for _ in range(n_runs):
+            decoder.decode_update_message(data)
+        decoding_us = (time.perf_counter() - start) / n_runs * 1e6
+        pickle_size = len(pickle.dumps(iu))
+        results[name] = {
+            "encoding_us": encoding_us,
+            "decoding_us": decoding_us,
+            "bytes": len(data),
+            "pickle_bytes": pickle_size,
+        }
+        print(
+            f"{name:26s} {encoding_us:8.2f} {decoding_us:8.2f} "
+            f"{len(data):7d} {pickle_size:7d}"
+        )
+    return results
+
+
+def run_bridge_echo(port_in, port_out, stop_event):
+    """Sends back every UpdateMessage received on port_in to port_out, until
+    stop_event is set. Run in the echo process of benchmark_tcp_bridge."""
+    from simple_retico_agent.tcp_bridge import TCPBridgeReceiver, TCPBridgeSender
+
+    receiver = TCPBridgeReceiver(port_in, host="127.0.0.1")
+    sender = TCPBridgeSender("127.0.0.1", port_out)
+    receiver.subscribe(sender)
+    receiver.setup()
+    sender.setup()
+    receiver.run(run_setup=False)
+    sender.run(run_setup=False)
+    stop_event.wait()
+    receiver.stop()
+    sender.stop()
+
+
+def benchmark_tcp_bridge(n_ius=1000, interval=0.02, port=9050):
+    """Measures the latency added by a TCP bridge hop, on loopback between
+    two local processes : VADIUs are sent to an echo process, that sends
+    them back, the hop latency being half the round trip.
+
+    Args:
+        n_ius (int, optional): number of sent VADIUs. Defaults to 1000.
+        interval (float, optional): time (in seconds) between two sent
+            VADIUs. Defaults to 0.02.
+        port (int, optional): port of the echo process, the next one is
+            used for the way back. Defaults to 9050.
+
+    Returns:
+        dict: the hop latency percentiles (in seconds), and the encoding
+            and decoding microseconds per IU.
+    """
+    import multiprocessing
+    import retico_core
+    from simple_retico_agent.tcp_bridge import TCPBridgeReceiver, TCPBridgeSender
+
+    context = multiprocessing.get_context("spawn")
+    stop_event = context.Event()
+    echo = context.Process(
+        target=run_bridge_echo, args=(port, port + 1, stop_event), daemon=True
+    )
+    receiver = TCPBridgeReceiver(port + 1, host="127.0.0.1")
+    sender = TCPBridgeSender("127.0.0.1", port)
+    # the sent UpdateMessages are put in the sender's left buffer
+    left_buffer = retico_core.IncrementalQueue(None, sender)
+    sender.add_left_buffer(left_buffer)
+    arrivals = {}
+
+    def append(update_message):
+        now = time.perf_counter()
+        for iu, _ in update_message:
+            arrivals[iu.iuid] = now
+
+    receiver.append = append
+    receiver.setup()
+    echo.start()
+    sender.setup()
+    receiver.run(run_setup=False)
+    sender.run(run_setup=False)
+    while not sender._forwarding:
+        time.sleep(0.01)
+
+    departures = {}
+    for i in range(n_ius):
+        iu = make_benchmark_iu("VADIU", iuid=f"bridge:{i}")
+        departures[iu.iuid] = time.perf_counter()
+        left_buffer.put(
+            retico_core.UpdateMessage.from_iu(iu, retico_core.UpdateType.ADD)
+        )
+        time.sleep(interval)
+    time.sleep(0.5)
+    stop_event.set()
+    sender.stop()
+    receiver.stop()
+    echo.join()
+
+    hops = [
+        (arrivals[iuid] - departure) / 2
+        for iuid, departure in departures.items()
+        if iuid in arrivals
+    ]
+    results = {
+        "n_sent": n_ius,
+        "n_received": len(hops),
+        "encoding_us": sender.encoding_time / max(sender.n_ius, 1) * 1e6,
+        "decoding_us": receiver.decoding_time / max(receiver.n_ius, 1) * 1e6,
+    }
+    for p in (50, 95, 99):
+        results[f"hop_p{p}"] = float(np.percentile(hops, p)) if hops else None
+    print(
+        f"{len(hops)}/{n_ius} VADIUs echoed, hop latency "
+        + " ".join(
+            f"p{p} {results[f'hop_p{p}'] * 1000:.2f}ms"
+            for p in (50, 95, 99)
+            if results[f"hop_p{p}"] is not None
+        )
+        + f", encoding {results['encoding_us']:.1f}us/IU"
+        f", decoding {results['decoding_us']:.1f}us/IU"
+    )
+    return results
+
+
+def benchmark_iu_memory(n_ius=180000):
+    """Measures the memory and garbage collection cost of the IUs of
+    additional_IUs. For each IU type, n_ius IUs are created, linked to the
+    previous ones, and kept alive (as in the modules' buffers and the
+    dialogue history). The raw audio is shared by the IUs, so that only the
+    cost of the IUs themselves is measured.
+
+    Args:
+        n_ius (int, optional): number of IUs of each type, the default is
+            the number of VADIUs of an hour-long session. Defaults to
+            180000.
+
+    Returns:
+        dict[str, dict]: by IU type, the bytes and the number of
+            gc-tracked objects per IU, the number of collections and the
+            time (in seconds) spent in the garbage collector while
+            creating the IUs, and the time of a full collection once they
+            are created.
+    """
+    import gc
+    import tracemalloc
+
+    creator = make_benchmark_iu("VADIU").creator
+    gc_time = [0.0, 0]
+
+    def on_gc(phase, info):
+        if phase == "start":
+            gc_time[1] = time.perf_counter()
+        else:
+            gc_time[0] += time.perf_counter() - gc_time[1]
+
+    results = {}
+    print(
+        f"{'IU':26s} {'bytes/IU':>9s} {'objs/IU':>8s} "
+        f"{'MB':>7s} {'gcs':>5s} {'gc ms':>7s} {'full gc ms':>10s}"
+    )
+    for name in BENCHMARK_IU_TYPES:
+        gc.collect()
+        n_collections = sum(stats["collections"] for stats in gc.get_stats())
+        n_objects = len(gc.get_objects())
+        gc_time[0] = 0.0
+        gc.callbacks.append(on_gc)
+        tracemalloc.start()
+        ius = [None]
+        for i in range(n_ius):
+            ius.append(
+                make_benchmark_iu(
+                    name, iuid=f"{i}", creator=creator, previous_iu=ius[-1]
+                )
+            )
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        gc.callbacks.remove(on_gc)
+        result = {
+            "bytes_per_iu": size / n_ius,
+            "objects_per_iu": (len(gc.get_objects()) - n_objects) / n_ius,
+            "collections": sum(stats["collections"] for stats in gc.get_stats())
+            - n_collections,
+            "gc_time": gc_time[0],
+        }
+        start = time.perf_counter()
+        gc.collect()
+        result["full_collection_time"] = time.perf_counter() - start
+        del ius
+        results[name] = result
+        print(
+            f"{name:26s} {result['bytes_per_iu']:9.0f} "
+            f"{result['objects_per_iu']:8.2f} {size / 2**20:7.1f} "
+            f"{result['collections']:5d} {result['gc_time'] * 1000:7.1f} "
+            f"{result['full_collection_time'] * 1000:10.1f}"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simple Retico Agent benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    asr_parser = subparsers.add_parser("asr_engine")
+    asr_parser.add_argument("--n_streams", type=int, nargs="+", default=[1, 2, 4, 8])
+    asr_parser.add_argument("--model", default="distil-large-v2")
+    asr_parser.add_argument("--device", default=None)
+    asr_parser.add_argument("--wav", default=None)
+
+    endpointing_parser = subparsers.add_parser("endpointing")
+    endpointing_parser.add_argument("sessions", nargs="+")
+    endpointing_parser.add_argument("--min_silence_dur", type=float, default=0.3)
+    endpointing_parser.add_argument("--mid_silence_dur", type=float, default=0.6)
+    endpointing_parser.add_argument("--n_stable_hypotheses", type=int, default=2)
+
+    resampling_parser = subparsers.add_parser("resampling")
+    resampling_parser.add_argument("--input_rate", type=int, default=44100)
+    resampling_parser.add_argument("--output_rate", type=int, default=16000)
+    resampling_parser.add_argument("--frame_length", type=float, default=0.02)
+
+    vad_parser = subparsers.add_parser("vad_cascade")
+    vad_parser.add_argument("--noise", nargs="+", default=None)
+    vad_parser.add_argument("--speech", nargs="+", default=None)
+    vad_parser.add_argument("--energy_threshold", type=float, default=-50)
+    vad_parser.add_argument("--neural_vad", default=None)
+
+    chunking_parser = subparsers.add_parser("tts_chunking")
+    chunking_parser.add_argument(
+        "--durations", type=float, nargs="+", default=[2, 10, 30, 60]
+    )
+
+    tts_parser = subparsers.add_parser("tts_first_chunk")
+    tts_parser.add_argument("--device", default=None)
+    tts_parser.add_argument("--n_runs", type=int, default=3)
+
+    optimization_parser = subparsers.add_parser("tts_optimization")
+    optimization_parser.add_argument(
+        "--modes", nargs="+", default=["int8", "compile", "torchscript"]
+    )
+    optimization_parser.add_argument("--cache_dir", default=None)
+    optimization_parser.add_argument("--n_runs", type=int, default=3)
+
+    serialization_parser = subparsers.add_parser("iu_serialization")
+    serialization_parser.add_argument("--n_runs", type=int, default=20000)
+
+    memory_parser = subparsers.add_parser("iu_memory")
+    memory_parser.add_argument("--n_ius", type=int, default=180000)
+
+    bridge_parser = subparsers.add_parser("tcp_bridge")
+    bridge_parser.add_argument("--n_ius", type=int, default=1000)
+    bridge_parser.add_argument("--interval", type=float, default=0.02)
+    bridge_parser.add_argument("--port", type=int, default=9050)
+
+    pipeline_parser = subparsers.add_parser("pipeline")
+    pipeline_parser.add_argument("script")
+    pipeline_parser.add_argument("--output", default=None)
+    pipeline_parser.add_argument("--device", default=None)
+    pipeline_parser.add_argument("--asr_model", default=None)
+    pipeline_parser.add_argument("--llm_repo", default=None)
+    pipeline_parser.add_argument("--llm_name", default=None)
+    pipeline_parser.add_argument("--tts_model", default=None)
+    pipeline_parser.add_argument("--stand_in_kwargs", type=json.loads, default=None)
+    pipeline_parser.add_argument("--trace", default=None)
+    pipeline_parser.add_argument(
+        "--processes", nargs="*", default=[], choices=["asr", "llm", "tts"]
+    )
+
+    args = parser.parse_args()
+    if args.benchmark == "asr_engine":
+        benchmark_asr_engine(
+            n_streams_list=args.n_streams,
+            whisper_model=args.model,
+            device=args.device,
+            wav_path=args.wav,
+        )
+    elif args.benchmark == "endpointing":
+        evaluate_endpointing(
+            args.sessions,
+            endpointer_kwargs={
+                "min_silence_dur": args.min_silence_dur,
+                "mid_silence_dur": args.mid_silence_dur,
+                "n_stable_hypotheses": args.n_stable_hypotheses,
+            },
+        )
+    elif args.benchmark == "resampling":
+        benchmark_resampling(
+            input_rate=args.input_rate,
+            output_rate=args.output_rate,
+            frame_length=args.frame_length,
+        )
+    elif args.benchmark == "vad_cascade":
+        configurations = {
+            "webrtc": {},
+            "energy+webrtc": {"energy_threshold": args.energy_threshold},
+        }
+        if args.neural_vad is not None:
+            configurations["energy+webrtc+neural"] = {
+                "energy_threshold": args.energy_threshold,
+                "neural_vad_path": args.neural_vad,
+            }
+        evaluate_vad_cascade(
+            configurations=configurations,
+            noise_paths=args.noise,
+            speech_paths=args.speech,
+        )
+    elif args.benchmark == "tts_first_chunk":
+        benchmark_tts_first_chunk(device=args.device, n_runs=args.n_runs)
+    elif args.benchmark == "tts_chunking":
+        benchmark_tts_chunking(clause_durations=args.durations)
+    elif args.benchmark == "tts_optimization":
+        benchmark_tts_optimization(
+            modes=args.modes, cache_dir=args.cache_dir, n_runs=args.n_runs
+        )
+    elif args.benchmark == "iu_serialization":
+        benchmark_iu_serialization(n_runs=args.n_runs)
+    elif args.benchmark == "tcp_bridge":
+        benchmark_tcp_bridge(n_ius=args.n_ius, interval=args.interval, port=args.port)
+    elif args.benchmark == "iu_memory":
+        benchmark_iu_memory(n_ius=args.n_ius)
+    elif args.benchmark == "pipeline":
+        from simple_retico_agent.pipeline_benchmark import run_pipeline_benchmark
+
+        run_pipeline_benchmark(
+            args.script,
+            output_path=args.output,
+            device=args.device,
+            asr_model=args.asr_model,
+            llm_repo=args.llm_repo,
+            llm_name=args.llm_name,
+            tts_model=args.tts_model,
+            stand_in_kwargs=args.stand_in_kwargs,
+            trace_path=args.trace,
+            process_modules=tuple(args.processes),
+        )
@@ -0,0 +1,200 @@
+"""
+ClausePacker
+============
+
+Packing stage of the SimpleTTSModule, adapting the clauses committed by
+the LLM to a target synthesis duration per TTS call : the tiny fragments
+("Hi,", "Well,"), whose synthesis time is dominated by the fixed
+overhead of the model, are merged with the next clauses when they are
+already waiting or due soon, and the over-long clauses, that would delay
+the first audio, are split at safe boundaries (punctuation if possible,
+word boundaries otherwise).
+
+The packed units are lists of the source TextFinalIUs, so that every
+packed unit stays traceable to the IUs it was built from. The duration
+of a text is estimated from its number of characters, the speaking rate
+being calibrated on the synthesized audio.
+
+The packer is fed by the module's process_update and calibrated by its
+TTS workers, its state is guarded by a lock.
+"""
+
+import threading
+import time
+
+
+class ClausePacker:
+    """Merges short clauses and splits long ones, to get packed units
+    close to a target synthesis duration."""
+
+    SPLIT_PUNCTUATION = (",", ";", ":", ".", "!", "?")
+
+    def __init__(
+        self,
+        target_duration=2.0,
+        min_duration=0.6,
+        max_duration=5.0,
+        hold_time=0.15,
+        chars_per_second=14.0,
+    ):
+        """Initializes the ClausePacker.
+
+        Args:
+            target_duration (float, optional): target audio duration (in
+                seconds) of a packed unit. Defaults to 2.0.
+            min_duration (float, optional): the units shorter than
+                min_duration are held to be merged with the next
+                clauses. Defaults to 0.6.
+            max_duration (float, optional): the clauses longer than
+                max_duration are split. Defaults to 5.0.
+            hold_time (float, optional): maximum time (in seconds) a
+                short unit is held waiting for the next clause, when no
+                clause is waiting to be synthesized. Defaults to 0.15.
+            chars_per_second (float, optional): initial estimation of
+                the speaking rate. Defaults to 14.0.
+        """
+        self.target_duration = target_duration
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.hold_time = hold_time
+        self.chars_per_second = chars_per_second
+        self.held_unit = None
+        self.held_since = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def text(ius):
+        """Returns the text of a list of TextFinalIUs.
+
+        Args:
+            ius (list[TextFinalIU]): the IUs.
+
+        Returns:
+            str: the text.
+        """
+        return "".join([iu.text for iu in ius])
+
+    def estimate_duration(self, ius):
+        """Estimates the audio duration of a list of TextFinalIUs.
+
+        Args:
+            ius (list[TextFinalIU]): the IUs.
+
+        Returns:
+            float: the estimated duration, in seconds.
+        """
+        return len(self.text(ius).strip()) / self.chars_per_second
+
+    def observe(self, text, audio_duration, smoothing=0.1):
+        """Calibrates the speaking rate on a synthesized text.
+
+        Args:
+            text (str): the synthesized text.
+            audio_duration (float): duration of the synthesized audio,
+                without the silence padding it to a whole number of
+                chunks.
+            smoothing (float, optional): weight of the new observation
+                in the moving average. Defaults to 0.1.
+        """
+        n_chars = len(text.strip())
+        if n_chars == 0 or audio_duration <= 0:
+            return
+        with self._lock:
+            self.chars_per_second += smoothing * (
+                n_chars / audio_duration - self.chars_per_second
+            )
+
+    def split(self, clause_ius):
+        """Splits a clause longer than max_duration into units close to
+        target_duration, preferably after a punctuation, otherwise between
+        two words (the IUs are never split).
+
+        Args:
+            clause_ius (list[TextFinalIU]): the IUs of the clause.
+
+        Returns:
+            list[list[TextFinalIU]]: the units.
+        """
+        if self.estimate_duration(clause_ius) <= self.max_duration:
+            return [clause_ius]
+        units = []
+        start = 0
+        last_word_boundary = None
+        for i in range(len(clause_ius) - 1):
+            if clause_ius[i + 1].text.startswith(" "):
+                last_word_boundary = i + 1
+            if self.estimate_duration(clause_ius[start : i + 1]) >= (
+                self.target_duration
+            ) and clause_ius[i].text.strip().endswith(self.SPLIT_PUNCTUATION):
+                end = i + 1
+            elif (
+                self.estimate_duration(clause_ius[start : i + 2]) > self.max_duration
+                and last_word_boundary is not None
+                and last_word_boundary > start
+            ):
+                end = last_word_boundary
+            else:
+                continue
+            units.append(clause_ius[start:end])
+            start = end
+        units.append(clause_ius[start:])
+        return units
+
+    def add(self, clause_ius):
+        """Adds a committed clause to the packer, and returns the units ready
+        to be synthesized.
+
+        Args:
+            clause_ius (list[TextFinalIU]): the IUs of the clause.
+
+        Returns:
+            list[list[TextFinalIU]]: the ready units.
+        """
+        with self._lock:
+            return self._add(clause_ius)
+
+    def _add(self, clause_ius):
+        ready = []
+        # the agent EOT is never merged
+        if clause_ius[-1].final:
+            if self.held_unit is not None:
+                ready.append(self.held_unit)
+                self.held_unit = None
+            ready.append(clause_ius)
+            return ready
+
+        units = self.split(clause_ius)
+        if self.held_unit is not None:
+            units[0] = self.held_unit + units[0]
+            self.held_unit = None
+
+        ready.extend(units[:-1])
+        if self.estimate_duration(units[-1]) < self.min_duration:
+            self.held_unit = units[-1]
+            self.held_since = time.perf_counter()
+        else:
+            ready.append(units[-1])
+        return ready
+
+    def poll(self, backlog_depth=0):
+        """Returns the held unit if it has been held for more than hold_time
+        and no clause is waiting to be synthesized (if clauses are waiting,
+        the unit would wait anyway, it is thus kept to be merged).
+
+        Args:
+            backlog_depth (int, optional): number of clauses waiting to
+                be synthesized. Defaults to 0.
+
+        Returns:
+            list[list[TextFinalIU]]: the ready units.
+        """
+        with self._lock:
+            if (
+                self.held_unit is not None
+                and backlog_depth == 0
+                and time.perf_counter() - self.held_since >= self.hold_time
+            ):
+                unit = self.held_unit
+                self.held_unit = None
+                return [unit]
+        return []
@@ -0,0 +1,443 @@
+"""
+Event Log
+=========
+
+Compact append-only binary log of the modules' log events, and an
+incremental live plotter reading it, replacing retico's live plot that
+re-reads and re-parses the whole text log at every refresh.
+
+The BinaryEventLog instruments the modules of a network by wrapping
+their file_logger : every logged event is still written in the text log,
+and is also appended to the binary log as a fixed-size (time, module
+code, event code) record. The log is made of three files, in the log
+folder :
+
+- events.bin : the records.
+- events.names : the module and event names of the codes, one JSON line
+  per new (module, event) pair, written before its first record.
+- events.idx : the time index, one (time, record number) entry per
+  index_interval seconds, used to start reading at a given time without
+  scanning the records before it.
+
+The events aggregated by an EventRecorder (logged once per flush with
+their count) are expanded back to count records, spread between their
+first and last event times.
+
+The LivePlotter runs in a separate process. At every refresh, it only
+reads the records appended since the previous one, keeps the last ones
+in a fixed-size array, and updates the data of its matplotlib artists
+(one per plotted event, created once) to show the last window_duration
+seconds. The plotted events and their markers are taken from the plot
+configuration (e.g. configs/plot_config_simple.json).
+
+.. code-block:: python
+
+    event_log = BinaryEventLog(log_folder)
+    event_log.instrument_network(mic)
+    plotter = LivePlotter(log_folder, plot_config_path, window_duration=30)
+    plotter.start()
+    network.run(mic)
+    ...
+    network.stop(mic)
+    plotter.stop()
+    event_log.close()
+"""
+
+import json
+import multiprocessing
+import os
+import threading
+import time
+import numpy as np
+
+from retico_core import network
+
+RECORD_DTYPE = np.dtype([("time", "<f8"), ("module", "<u2"), ("event", "<u2")])
+INDEX_DTYPE = np.dtype([("time", "<f8"), ("record", "<u8")])
+
+
+class EventLoggerProxy:
+    """Wraps a module's file_logger, to also append the logged events to a
+    BinaryEventLog."""
+
+    def __init__(self, file_logger, event_log, module_name):
+        """Initializes the EventLoggerProxy.
+
+        Args:
+            file_logger: the module's file_logger.
+            event_log (BinaryEventLog): the binary log.
+            module_name (str): name of the module.
+        """
+        self.file_logger = file_logger
+        self.event_log = event_log
+        self.module_name = module_name
+
+    def _log(self, level, event, **kw):
+        self.event_log.record_message(self.module_name, event, kw)
+        return getattr(self.file_logger, level)(event, **kw)
+
+    def debug(self, event, **kw):
+        return self._log("debug", event, **kw)
+
+    def info(self, event, **kw):
+        return self._log("info", event, **kw)
+
+    def warning(self, event, **kw):
+        return self._log("warning", event, **kw)
+
+    def error(self, event, **kw):
+        return self._log("error", event, **kw)
+
+    def exception(self, event, **kw):
+        return self._log("exception", event, **kw)
+
+    def __getattr__(self, name):
+        return getattr(self.file_logger, name)
+
+
+class BinaryEventLog:
+    """Append-only binary log of the modules' log events, with a time
+    index."""
+
+    def __init__(self, log_folder, flush_interval=0.5, index_interval=1.0):
+        """Initializes the BinaryEventLog, creating (or truncating) its
+        files.
+
+        Args:
+            log_folder (str): folder of the log files.
+            flush_interval (float, optional): maximum time (in seconds)
+                between two flushes of the records to the disk. Defaults
+                to 0.5.
+            index_interval (float, optional): time (in seconds) between
+                two entries of the time index. Defaults to 1.0.
+        """
+        os.makedirs(log_folder, exist_ok=True)
+        self.log_folder = log_folder
+        self.flush_interval = flush_interval
+        self.index_interval = index_interval
+        self.codes = {}
+        self.n_records = 0
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        self._next_index_time = 0.0
+        self._records_file = open(os.path.join(log_folder, "events.bin"), "wb")
+        self._names_file = open(
+            os.path.join(log_folder, "events.names"), "w", encoding="utf-8"
+        )
+        self._index_file = open(os.path.join(log_folder, "events.idx"), "wb")
+
+    def _get_codes(self, module_name, event):
+        """Returns the module and event codes, writing the new names to the
+        names file.
+
+        Args:
+            module_name (str): name of the module.
+            event (str): name of the event.
+
+        Returns:
+            (int, int): the module and event codes.
+        """
+        module_code = self.codes.get(module_name)
+        if module_code is None:
+            module_code = self.codes[module_name] = len(self.codes)
+            self._names_file.write(
+                json.dumps({"kind": "module", "code": module_code, "name": module_name})
+                + "\n"
+            )
+        event_code = self.codes.get((module_name, event))
+        if event_code is None:
+            event_code = self.codes[(module_name, event)] = len(self.codes)
+            self._names_file.write(
+                json.dumps({"kind": "event", "code": event_code, "name": event})
+                + "\n"
+            )
+            self._names_file.flush()
+        return module_code, event_code
+
+    def record(self, module_name, event, times):
+        """Appends records of an event to the log.
+
+        Args:
+            module_name (str): name of the module.
+            event (str): name of the event.
+            times (list[float]): UNIX timestamps of the event's
+                occurrences.
+        """
+        now = time.time()
+        with self._lock:
+            if self._records_file.closed:
+                return
+            module_code, event_code = self._get_codes(module_name, event)
+            records = np.empty(len(times), dtype=RECORD_DTYPE)
+            records["time"] = times
+            records["module"] = module_code
+            records["event"] = event_code
+            if now >= self._next_index_time:
+                entry = np.array([(now, self.n_records)], dtype=INDEX_DTYPE)
+                self._index_file.write(entry.tobytes())
+                self._next_index_time = now + self.index_interval
+            self._records_file.write(records.tobytes())
+            self.n_records += len(records)
+            if now - self._last_flush >= self.flush_interval:
+                self._records_file.flush()
+                self._index_file.flush()
+                self._last_flush = now
+
+    def record_message(self, module_name, event, fields):
+        """Appends the records of a log message : one, or count records for
+        the events aggregated by an EventRecorder.
+
+        Args:
+            module_name (str): name of the module.
+            event (str): name of the event.
+            fields (dict): fields of the log message.
+        """
+        event_time = fields.get("event_time", time.time())
+        count = fields.get("count", 1)
+        if "event_times" in fields:
+            times = fields["event_times"]
+        elif count > 1:
+            times = np.linspace(
+                event_time, fields.get("last_event_time", event_time), count
+            )
+        else:
+            times = [event_time]
+        self.record(module_name, event, times)
+
+    def instrument(self, module):
+        """Wraps the file_logger of a module to record its events.
+
+        Args:
+            module (retico_core.AbstractModule): the module.
+        """
+        module.file_logger = EventLoggerProxy(module.file_logger, self, module.name())
+
+    def instrument_network(self, module):
+        """Instruments all the modules of a network.
+
+        Args:
+            module (retico_core.AbstractModule): a module of the network.
+        """
+        modules, _ = network.discover(module)
+        for m in modules:
+            self.instrument(m)
+
+    def close(self):
+        """Flushes and closes the log files."""
+        with self._lock:
+            for f in (self._records_file, self._names_file, self._index_file):
+                f.close()
+
+
+class EventLogReader:
+    """Incremental reader of a BinaryEventLog, possibly written by another
+    process."""
+
+    def __init__(self, log_folder):
+        """Initializes the EventLogReader.
+
+        Args:
+            log_folder (str): folder of the log files.
+        """
+        self.log_folder = log_folder
+        self.module_names = {}
+        self.event_names = {}
+        self.record_position = 0
+        self._names_position = 0
+
+    def _path(self, name):
+        return os.path.join(self.log_folder, name)
+
+    def read_names(self):
+        """Reads the names written since the last call."""
+        if not os.path.exists(self._path("events.names")):
+            return
+        with open(self._path("events.names"), "r", encoding="utf-8") as f:
+            f.seek(self._names_position)
+            while True:
+                line = f.readline()
+                # a line is only complete once its newline is written
+                if not line.endswith("\n"):
+                    break
+                self._names_position = f.tell()
+                entry = json.loads(line)
+                if entry["kind"] == "module":
+                    self.module_names[entry["code"]] = entry["name"]
+                else:
+                    self.event_names[entry["code"]] = entry["name"]
+
+    def seek(self, t):
+        """Moves the reading position to the first record written after the
+        time t, using the time index.
+
+        Args:
+            t (float): UNIX timestamp.
+        """
+        if not os.path.exists(self._path("events.idx")):
+            return
+        with open(self._path("events.idx"), "rb") as f:
+            data = f.read()
+        index = np.frombuffer(
+            data[: len(data) - len(data) % INDEX_DTYPE.itemsize], dtype=INDEX_DTYPE
+        )
+        i = np.searchsorted(index["time"], t, side="right") - 1
+        if i >= 0:
+            self.record_position = max(self.record_position, int(index["record"][i]))
+
+    def read_new(self):
+        """Reads the records appended since the last call.
+
+        Returns:
+            np.ndarray: the new records (of dtype RECORD_DTYPE).
+        """
+        if not os.path.exists(self._path("events.bin")):
+            return np.empty(0, dtype=RECORD_DTYPE)
+        with open(self._path("events.bin"), "rb") as f:
+            f.seek(self.record_position * RECORD_DTYPE.itemsize)
+            data = f.read()
+        # the last record can be partially written
+        n = len(data) // RECORD_DTYPE.itemsize
+        records = np.frombuffer(data[: n * RECORD_DTYPE.itemsize], dtype=RECORD_DTYPE)
+        self.record_position += n
+        self.read_names()
+        return records
+
+
+class LivePlotter:
+    """Live plot of the events of a BinaryEventLog, in a separate process,
+    refreshed incrementally."""
+
+    def __init__(
+        self,
+        log_folder,
+        plot_config_path,
+        window_duration=30,
+        refreshing_time=1,
+        max_points=200000,
+    ):
+        """Initializes the LivePlotter.
+
+        Args:
+            log_folder (str): folder of the BinaryEventLog.
+            plot_config_path (str): path to the plot configuration, giving
+                the plotted events of every module and their markers.
+            window_duration (float, optional): duration (in seconds) of
+                the plotted time window. Defaults to 30.
+            refreshing_time (float, optional): time (in seconds) between
+                two refreshes. Defaults to 1.
+            max_points (int, optional): size of the array of the last
+                records kept for the plot. Defaults to 200000.
+        """
+        self.log_folder = log_folder
+        self.window_duration = window_duration
+        self.refreshing_time = refreshing_time
+        self.max_points = max_points
+        with open(plot_config_path, "r", encoding="utf-8") as f:
+            self.plot_config = json.load(f)
+        self._stop_event = multiprocessing.Event()
+        self._process = None
+
+    def get_plot_settings(self, module_name, event):
+        """Returns the plot settings of a module's event, from the module's
+        configuration or the "any_module" one.
+
+        Args:
+            module_name (str): name of the module.
+            event (str): name of the event.
+
+        Returns:
+            dict: the plot settings, None if the event is not plotted.
+        """
+        module_config = self.plot_config.get(module_name, {}).get("events", {})
+        any_config = self.plot_config.get("any_module", {}).get("events", {})
+        config = module_config.get(event, any_config.get(event))
+        if config is None or config.get("exclude", False):
+            return None
+        return config.get("plot_settings")
+
+    def run(self):
+        """Plotting loop, run in the plotter's process until stop is
+        called."""
+        # imported here as the plotting is optional
+        import matplotlib.pyplot as plt
+
+        modules = [m for m in self.plot_config if m != "any_module"]
+        fig, ax = plt.subplots(figsize=(14, 1 + 0.6 * len(modules)))
+        ax.set_yticks(range(len(modules)), modules)
+        ax.set_ylim(-0.5, len(modules) - 0.5)
+        ax.set_xlabel("time (s)")
+        fig.tight_layout()
+
+        reader = EventLogReader(self.log_folder)
+        reader.seek(time.time() - self.window_duration)
+        # ring of the last plotted records : time, and series
+        times = np.full(self.max_points, -np.inf)
+        series = np.zeros(self.max_points, dtype=np.int32)
+        n_points = 0
+        # series by (module code, event code), -1 if not plotted
+        series_of_codes = {}
+        lines = []
+        start_time = None
+
+        while not self._stop_event.is_set():
+            records = reader.read_new()
+            if len(records) != 0:
+                if start_time is None:
+                    start_time = float(records["time"][0])
+                keys = records["module"].astype(np.int64) << 16 | records["event"]
+                unique_keys, inverse = np.unique(keys, return_inverse=True)
+                codes_series = np.empty(len(unique_keys), dtype=np.int32)
+                for i, key in enumerate(unique_keys):
+                    key = int(key)
+                    if key not in series_of_codes:
+                        module_name = reader.module_names.get(key >> 16)
+                        event = reader.event_names.get(key & 0xFFFF)
+                        settings = self.get_plot_settings(module_name, event)
+                        if module_name not in modules or settings is None:
+                            series_of_codes[key] = -1
+                        else:
+                            (line,) = ax.plot(
+                                [],
+                                [],
+                                linestyle="None",
+                                marker=settings.get("marker", "|"),
+                                color=settings.get("marker_color"),
+                                markersize=settings.get("marker_size"),
+                                label=event,
+                            )
+                            lines.append((line, modules.index(module_name)))
+                            series_of_codes[key] = len(lines) - 1
+                    codes_series[i] = series_of_codes[key]
+                new_series = codes_series[inverse]
+                plotted = new_series >= 0
+                new_times = records["time"][plotted] - start_time
+                new_series = new_series[plotted][-self.max_points :]
+                new_times = new_times[-self.max_points :]
+                positions = (n_points + np.arange(len(new_times))) % self.max_points
+                times[positions] = new_times
+                series[positions] = new_series
+                n_points += len(new_times)
+
+            if start_time is not None:
+                now = time.time() - start_time
+                in_window = times >= now - self.window_duration
+                for i, (line, y) in enumerate(lines):
+                    x = times[in_window & (series == i)]
+                    line.set_data(x, np.full(len(x), y))
+                ax.set_xlim(now - self.window_duration, now)
+            fig.canvas.draw_idle()
+            plt.pause(self.refreshing_time)
+        plt.close(fig)
+
+    def start(self):
+        """Starts the plotter's process."""
+        self._stop_event.clear()
+        self._process = multiprocessing.Process(target=self.run, daemon=True)
+        self._process.start()
+
+    def stop(self):
+        """Stops the plotter's process."""
+        self._stop_event.set()
+        if self._process is not None:
+            self._process.join(timeout=5)
+            self._process = None
@@ -0,0 +1,138 @@
+"""
+EventRecorder
+=============
+
+Low-overhead recording of the high-rate log events of a module (e.g. the
+per-frame voice activity of the SimpleVADModule, or the per-callback
+output_audio of the SimpleSpeakerModule, that runs in the real-time
+audio thread).
+
+Instead of formatting and writing a log message, the hot path only
+appends a compact (timestamp, event code, fields) tuple to an in-memory
+ring (a bounded deque, whose appends and pops are atomic, so that no
+lock is taken). A background thread flushes the ring to the module's
+file_logger, one message per event, with the same event names, so that
+the plot configurations (configs/plot_config_simple.json) keep working :
+only the formatting and the I/O are moved out of the hot path.
+
+The messages are written up to flush_interval seconds after the events
+(the default 20ms being the duration of a VAD frame), their exact time
+is given in their event_time field (used by the BinaryEventLog).
+
+The high-rate events can optionally be aggregated : one message per
+event and per flush is then logged, with the number of occurrences and
+the time of each of them (event_times field).
+"""
+
+import collections
+import threading
+import time
+
+from retico_core import log_utils
+
+
+class EventRecorder:
+    """In-memory ring of a module's log events, flushed to its file_logger
+    by a background thread."""
+
+    def __init__(
+        self, module, flush_interval=0.02, capacity=65536, aggregated_events=()
+    ):
+        """Initializes the EventRecorder.
+
+        Args:
+            module (retico_core.AbstractModule): the module, whose
+                file_logger is used.
+            flush_interval (float, optional): time (in seconds) between
+                two flushes. Defaults to 0.02.
+            capacity (int, optional): maximum number of events kept in
+                the ring, the oldest ones are dropped first. Defaults to
+                65536.
+            aggregated_events (tuple[str], optional): the events logged
+                once per flush, with their number of occurrences and
+                their times, the other events being logged one by one.
+                Defaults to ().
+        """
+        self.module = module
+        self.flush_interval = flush_interval
+        self.ring = collections.deque(maxlen=capacity)
+        self.aggregated_events = set(aggregated_events)
+        self.codes = {}
+        self.event_names = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def record(self, event, **fields):
+        """Records an event. Called from the hot paths.
+
+        Args:
+            event (str): name of the event.
+            **fields: optional fields of the log message.
+        """
+        code = self.codes.get(event)
+        if code is None:
+            code = self.register(event)
+        self.ring.append((time.time(), code, fields or None))
+
+    def register(self, event):
+        """Returns the code of an event, registering it if needed.
+
+        Args:
+            event (str): name of the event.
+
+        Returns:
+            int: the code.
+        """
+        with self._lock:
+            code = self.codes.get(event)
+            if code is None:
+                code = len(self.event_names)
+                self.event_names.append(event)
+                self.codes[event] = code
+            return code
+
+    def flush(self):
+        """Logs the recorded events one by one, in order, except the
+        aggregated events, logged once with their number of occurrences and
+        their times."""
+        aggregated = {}
+        for _ in range(len(self.ring)):
+            timestamp, code, fields = self.ring.popleft()
+            event = self.event_names[code]
+            if event in self.aggregated_events:
+                aggregated.setdefault(event, []).append(timestamp)
+            else:
+                self.module.file_logger.info(
+                    event, event_time=timestamp, **(fields or {})
+                )
+        for event, times in aggregated.items():
+            self.module.file_logger.info(
+                event,
+                event_time=times[0],
+                last_event_time=times[-1],
+                count=len(times),
+                event_times=times,
+            )
+
+    def _flush_thread(self):
+        """Flushes the ring every flush_interval seconds."""
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                log_utils.log_exception(module=self.module, exception=e)
+
+    def start(self):
+        """Starts the flushing thread."""
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._flush_thread, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the flushing thread, and flushes the remaining events."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
@@ -0,0 +1,284 @@
+"""
+Headless I/O
+============
+
+File-backed replacements of the audio input and output modules, to run
+the whole dialogue system without sound hardware (e.g. on servers or in
+CI) :
+
+- WavFileSource replaces retico's MicrophoneModule : it streams a list
+  of WAV files into the network as AudioIUs, at real time or N times
+  faster, with a silence between the files (the user's turns) and after
+  the last one.
+- WavFileSink replaces the SimpleSpeakerModule : it consumes the
+  AudioFinalIUs with the same jitter-buffered playback logic (and the
+  same agent BOT and EOT TextIUs and PlaybackClock updates), driven by
+  a thread emulating the audio output's callbacks, and writes the
+  played audio to a timestamped WAV file.
+
+Both modules are drop-in swaps, for example in main.py :
+
+.. code-block:: python
+
+    mic = WavFileSource(["user_turn_1.wav", "user_turn_2.wav"])
+    speaker = WavFileSink(rate=tts_model_samplerate, output_dir="logs/audio")
+"""
+
+import os
+import threading
+import time
+import wave
+import numpy as np
+
+import retico_core
+from retico_core import log_utils
+from retico_core.audio import AudioIU
+
+from simple_retico_agent.audio_processing import StreamingResampler
+from simple_retico_agent.simple_speaker import SimpleSpeakerModule
+
+
+def read_wav(path, rate):
+    """Reads a 16-bit WAV file, as mono int16-encoded raw audio at the
+    desired framerate.
+
+    Args:
+        path (str): path to the WAV file.
+        rate (int): the desired framerate.
+
+    Returns:
+        bytes: the raw audio.
+    """
+    with wave.open(path, "rb") as f:
+        if f.getsampwidth() != 2:
+            raise ValueError(f"{path} should be a 16-bit wav file")
+        n_channels = f.getnchannels()
+        file_rate = f.getframerate()
+        raw_audio = f.readframes(f.getnframes())
+    if n_channels != 1:
+        audio = np.frombuffer(raw_audio, dtype=np.int16).reshape(-1, n_channels)
+        raw_audio = audio.mean(axis=1).astype(np.int16).tobytes()
+    if file_rate != rate:
+        raw_audio = StreamingResampler(file_rate, rate).process(raw_audio)
+    return raw_audio
+
+
+class WavFileSource(retico_core.AbstractProducingModule):
+    """A producing module that streams WAV files into the network as
+    AudioIUs, like the MicrophoneModule would with a user reading them.
+
+    Attributes:
+        file_times (list[tuple[str, float, float]]): the path, and the
+            UNIX timestamps at which the first and last chunks of each
+            streamed file were produced.
+        finished (threading.Event): set once all the files are streamed.
+    """
+
+    @staticmethod
+    def name():
+        return "WAV File Source Module"
+
+    @staticmethod
+    def description():
+        return "A producing module that streams WAV files as AudioIUs."
+
+    @staticmethod
+    def output_iu():
+        return AudioIU
+
+    def __init__(
+        self,
+        wav_paths,
+        frame_length=0.02,
+        rate=16000,
+        sample_width=2,
+        speed=1.0,
+        gap_duration=3.0,
+        **kwargs,
+    ):
+        """Initializes the WavFileSource.
+
+        Args:
+            wav_paths (list[str]): the WAV files, streamed one after the
+                other.
+            frame_length (float, optional): duration of the produced
+                AudioIUs. Defaults to 0.02.
+            rate (int, optional): framerate of the produced audio, the
+                files are resampled if needed. Defaults to 16000.
+            sample_width (int, optional): sample width of the produced
+                audio. Defaults to 2.
+            speed (float, optional): streaming speed, relative to real
+                time. Defaults to 1.0.
+            gap_duration (float, optional): duration (in seconds) of the
+                silence streamed after each file, leaving time for the
+                agent to answer. Defaults to 3.0.
+        """
+        super().__init__(**kwargs)
+        if speed <= 0:
+            raise ValueError("speed should be positive")
+        self.wav_paths = list(wav_paths)
+        self.frame_length = frame_length
+        self.rate = rate
+        self.sample_width = sample_width
+        self.speed = speed
+        self.gap_duration = gap_duration
+        self.chunk_size = round(rate * frame_length)
+        self.chunk_size_bytes = self.chunk_size * sample_width
+        self.file_times = []
+        self.finished = threading.Event()
+        self._chunks = None
+        self._start_time = None
+        self._n_chunks = 0
+
+    def iter_chunks(self):
+        """Yields the chunks of the streamed audio : the files and the
+        silences after them, then an endless silence.
+
+        Yields:
+            (bytes, str, bool, bool): the chunk, the path of its file
+                (None for the silences), and whether it is the first or
+                last chunk of its file.
+        """
+        silence = b"\x00" * self.chunk_size_bytes
+        n_gap_chunks = round(self.gap_duration / self.frame_length)
+        for path in self.wav_paths:
+            raw_audio = read_wav(path, self.rate)
+            # pad the file to a whole number of chunks
+            raw_audio += b"\x00" * (-len(raw_audio) % self.chunk_size_bytes)
+            n = len(raw_audio) // self.chunk_size_bytes
+            for i in range(n):
+                chunk = raw_audio[
+                    i * self.chunk_size_bytes : (i + 1) * self.chunk_size_bytes
+                ]
+                yield chunk, path, i == 0, i == n - 1
+            for _ in range(n_gap_chunks):
+                yield silence, None, False, False
+        self.finished.set()
+        self.terminal_logger.info("source_finished")
+        while True:
+            yield silence, None, False, False
+
+    def process_update(self, _):
+        """Produces the next chunk as an AudioIU, once it is due."""
+        chunk, path, first, last = next(self._chunks)
+        due_time = self._start_time + (
+            self._n_chunks * self.frame_length / self.speed
+        )
+        delay = due_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self._n_chunks += 1
+        if first:
+            self.file_times.append((path, time.time(), None))
+            self.file_logger.info("source_file_start", path=path)
+        if last:
+            self.file_times[-1] = (path, self.file_times[-1][1], time.time())
+            self.file_logger.info("source_file_end", path=path)
+        output_iu = self.create_iu()
+        output_iu.set_audio(chunk, self.chunk_size, self.rate, self.sample_width)
+        return retico_core.UpdateMessage.from_iu(output_iu, retico_core.UpdateType.ADD)
+
+    def prepare_run(self):
+        """Starts streaming the files."""
+        super().prepare_run()
+        self._chunks = self.iter_chunks()
+        self._n_chunks = 0
+        self.finished.clear()
+        self._start_time = time.perf_counter()
+
+
+class WavFileSink(SimpleSpeakerModule):
+    """A SimpleSpeakerModule that writes the played audio to a WAV file
+    instead of the computer's speakers, a thread emulating the audio
+    output's callbacks.
+
+    Attributes:
+        wav_path (str): path of the written WAV file.
+        turn_events (list[tuple[str, int]]): the agent BOT and EOT, with
+            their position (in frames) in the written WAV file.
+    """
+
+    @staticmethod
+    def name():
+        return "WAV File Sink Module"
+
+    @staticmethod
+    def description():
+        return "A module that writes audio to a WAV file and outputs agent BOT and EOT (agent turn's first and last audio outputted)"
+
+    def __init__(self, output_dir="logs/audio", speed=1.0, **kwargs):
+        """Initializes the WavFileSink.
+
+        Args:
+            output_dir (str, optional): directory of the written WAV
+                files. Defaults to "logs/audio".
+            speed (float, optional): playback speed, relative to real
+                time, it should be the same as the WavFileSource's.
+                Defaults to 1.0.
+        """
+        super().__init__(**kwargs)
+        if speed <= 0:
+            raise ValueError("speed should be positive")
+        self.output_dir = output_dir
+        self.speed = speed
+        self.wav_path = None
+        self.turn_events = []
+        self._wav_file = None
+        self._n_frames_written = 0
+        self._playback_active = False
+        self._playback_thread = None
+
+    def send_turn_event(self, event, iu):
+        """Logs an agent BOT or EOT, with its position in the WAV file, and
+        outputs it as a TextIU.
+
+        Args:
+            event (str): "agent_BOT" or "agent_EOT".
+            iu (AudioFinalIU): the IU the event is grounded in.
+        """
+        self.turn_events.append((event, self._n_frames_written))
+        super().send_turn_event(event, iu)
+
+    def _playback_loop(self):
+        """Emulates the audio output : calls self.callback every frame_length
+        (divided by the speed) seconds, and writes the returned buffers to
+        the WAV file."""
+        frame_count = int(self.rate * self.frame_length)
+        period = self.frame_length / self.speed
+        next_time = time.perf_counter()
+        while self._playback_active:
+            try:
+                data, _ = self.callback(None, frame_count, None, None)
+                self._wav_file.writeframes(data)
+                self._n_frames_written += frame_count
+            except Exception as e:
+                log_utils.log_exception(module=self, exception=e)
+            next_time += period
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    def open_stream(self):
+        """Opens the WAV file, and starts the thread emulating the audio
+        output."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.wav_path = os.path.join(
+            self.output_dir, time.strftime("agent_output_%Y%m%d_%H%M%S.wav")
+        )
+        self._wav_file = wave.open(self.wav_path, "wb")
+        self._wav_file.setnchannels(self.channels)
+        self._wav_file.setsampwidth(self.sample_width)
+        self._wav_file.setframerate(self.rate)
+        self._n_frames_written = 0
+        self.turn_events = []
+        self._playback_active = True
+        self._playback_thread = threading.Thread(target=self._playback_loop)
+        self._playback_thread.start()
+
+    def close_stream(self):
+        """Stops the emulated audio output, and closes the WAV file."""
+        self._playback_active = False
+        self._playback_thread.join()
+        self._wav_file.close()
+        self._wav_file = None
+        self.terminal_logger.info("sink_wav_written", path=self.wav_path)
@@ -0,0 +1,369 @@
+"""
+IU Serialization
+================
+
+Compact binary wire format of the IUs exchanged by the agent's modules
+(AudioIU, VADIU, AudioFinalIU, TextIU, TextFinalIU, SpeechRecognitionIU
+and SpeechRecognitionTimedIU), used to distribute the pipeline over
+several machines (cf. tcp_bridge).
+
+Every IU is encoded as a fixed header (type code, update type, flags and
+creation time), its iuid and the name of its creator, the iuids of its
+previous_iu and grounded_in, and the fields of its type, in a fixed
+order (no field names are sent). The raw audio is sent as-is. The None
+values are encoded with sentinels (e.g. the nframes of the TTS's
+AudioFinalIUs, or the audio fields of its agent EOT IU).
+
+The links between the IUs are kept as iuids : every sent and received
+IU is registered in an IURegistry, shared by all the bridges of the
+process, that resolves the iuids of the received IUs back to the
+process's IUs (e.g. the TextFinalIUs of an LLM running on another
+machine are grounded in this machine's SpeechRecognitionTimedIUs, not
+in copies of them). An IU received again (e.g. ADD then COMMIT) is
+updated in place.
+
+An UpdateMessage is encoded as its number of IUs followed by its IUs.
+"""
+
+import collections
+import struct
+import threading
+
+import retico_core
+from retico_core import audio, text
+
+from simple_retico_agent.additional_IUs import (
+    AudioFinalIU,
+    SpeechRecognitionTimedIU,
+    TextFinalIU,
+    VADIU,
+)
+
+# type code, update type code, flags, created_at
+IU_HEADER = struct.Struct("<BBBd")
+COMMITTED = 1
+REVOKED = 2
+UPDATE_TYPES = list(retico_core.UpdateType)
+UPDATE_TYPE_CODES = {ut: code for code, ut in enumerate(UPDATE_TYPES)}
+
+# the fields of each IU type, in the order of the wire format
+IU_FIELDS = {
+    audio.AudioIU: (
+        ("rate", "u32"),
+        ("nframes", "u32"),
+        ("sample_width", "u8"),
+        ("raw_audio", "bytes"),
+    ),
+    text.TextIU: (("text", "str"),),
+    text.SpeechRecognitionIU: (
+        ("text", "str"),
+        ("predictions", "strs"),
+        ("stability", "f64"),
+        ("confidence", "f64"),
+        ("final", "bool"),
+    ),
+}
+IU_FIELDS[AudioFinalIU] = IU_FIELDS[audio.AudioIU] + (("final", "bool"),)
+IU_FIELDS[VADIU] = IU_FIELDS[audio.AudioIU] + (
+    ("va_user", "bool"),
+    ("va_agent", "bool"),
+)
+IU_FIELDS[TextFinalIU] = IU_FIELDS[text.TextIU] + (("final", "bool"),)
+IU_FIELDS[SpeechRecognitionTimedIU] = IU_FIELDS[text.SpeechRecognitionIU] + (
+    ("start_sample", "i64"),
+    ("end_sample", "i64"),
+)
+IU_TYPES = list(IU_FIELDS)
+IU_TYPE_CODES = {cls: code for code, cls in enumerate(IU_TYPES)}
+# the attribute the payload of each IU type is
+IU_PAYLOADS = {
+    audio.AudioIU: "raw_audio",
+    text.TextIU: "text",
+    text.SpeechRecognitionIU: "predictions",
+}
+
+U8 = struct.Struct("<B")
+U16 = struct.Struct("<H")
+U32 = struct.Struct("<I")
+I64 = struct.Struct("<q")
+F64 = struct.Struct("<d")
+NONE_LENGTH = 0xFFFFFFFF
+# sentinels of the None values of the integer fields
+NONE_U8 = 0xFF
+NONE_U32 = 0xFFFFFFFF
+NONE_INT = -(2**63)
+
+
+class _Reader:
+    """Reads the values of a buffer one after the other."""
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def unpack(self, s):
+        values = s.unpack_from(self.data, self.offset)
+        self.offset += s.size
+        return values
+
+    def read_bytes(self):
+        (length,) = self.unpack(U32)
+        if length == NONE_LENGTH:
+            return None
+        data = bytes(self.data[self.offset : self.offset + length])
+        self.offset += length
+        return data
+
+    def read_str(self):
+        data = self.read_bytes()
+        return data.decode("utf-8") if data is not None else None
+
+    def read_short_str(self):
+        (length,) = self.unpack(U16)
+        data = bytes(self.data[self.offset : self.offset + length])
+        self.offset += length
+        return data.decode("utf-8")
+
+
+def _write_bytes(out, data):
+    if data is None:
+        out += U32.pack(NONE_LENGTH)
+    else:
+        # the raw audio can be a memoryview of any format
+        out += U32.pack(memoryview(data).nbytes)
+        out += data
+
+
+def _write_short_str(out, value):
+    data = value.encode("utf-8")
+    out += U16.pack(len(data))
+    out += data
+
+
+def _write_field(out, kind, value):
+    if kind == "bytes":
+        _write_bytes(out, value)
+    elif kind == "str":
+        _write_bytes(out, value.encode("utf-8") if value is not None else None)
+    elif kind == "bool":
+        # None, False or True
+        out += U8.pack(0 if value is None else 1 + bool(value))
+    elif kind == "u8":
+        out += U8.pack(NONE_U8 if value is None else value)
+    elif kind == "u32":
+        out += U32.pack(NONE_U32 if value is None else value)
+    elif kind == "i64":
+        out += I64.pack(NONE_INT if value is None else value)
+    elif kind == "f64":
+        out += F64.pack(float("nan") if value is None else value)
+    elif kind == "strs":
+        if value is None:
+            out += U32.pack(NONE_LENGTH)
+        else:
+            out += U32.pack(len(value))
+            for s in value:
+                _write_bytes(out, s.encode("utf-8"))
+
+
+def _read_field(reader, kind):
+    if kind == "bytes":
+        return reader.read_bytes()
+    if kind == "str":
+        return reader.read_str()
+    if kind == "bool":
+        (value,) = reader.unpack(U8)
+        return None if value == 0 else value == 2
+    if kind == "u8":
+        (value,) = reader.unpack(U8)
+        return None if value == NONE_U8 else value
+    if kind == "u32":
+        (value,) = reader.unpack(U32)
+        return None if value == NONE_U32 else value
+    if kind == "i64":
+        (value,) = reader.unpack(I64)
+        return None if value == NONE_INT else value
+    if kind == "f64":
+        (value,) = reader.unpack(F64)
+        return None if value != value else value
+    if kind == "strs":
+        (length,) = reader.unpack(U32)
+        if length == NONE_LENGTH:
+            return None
+        return [reader.read_str() for _ in range(length)]
+    raise ValueError(f"unknown field kind : {kind}")
+
+
+class RemoteCreator:
+    """Creator of the IUs received from another process, only giving the
+    name of the module that created them."""
+
+    def __init__(self, name):
+        self._name = name
+
+    def name(self):
+        return self._name
+
+    def description(self):
+        return f"{self._name} (remote)"
+
+
+class IURegistry:
+    """The last sent and received IUs of the process, by iuid, used to
+    resolve the links between the received IUs and the process's IUs."""
+
+    def __init__(self, max_ius=10000):
+        """Initializes the IURegistry.
+
+        Args:
+            max_ius (int, optional): number of IUs kept. Defaults to
+                10000.
+        """
+        self.max_ius = max_ius
+        self.ius = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, iu):
+        """Registers an IU.
+
+        Args:
+            iu (retico_core.IncrementalUnit): the IU.
+        """
+        with self._lock:
+            self.ius[str(iu.iuid)] = iu
+            if len(self.ius) > self.max_ius:
+                self.ius.popitem(last=False)
+
+    def get(self, iuid):
+        """Returns the IU of an iuid.
+
+        Args:
+            iuid (str): the iuid.
+
+        Returns:
+            retico_core.IncrementalUnit: the IU, None if it is unknown.
+        """
+        if iuid is None:
+            return None
+        with self._lock:
+            return self.ius.get(iuid)
+
+
+DEFAULT_REGISTRY = IURegistry()
+
+
+class IUSerializer:
+    """Encodes and decodes the IUs and UpdateMessages."""
+
+    def __init__(self, registry=None):
+        """Initializes the IUSerializer.
+
+        Args:
+            registry (IURegistry, optional): the registry of the sent and
+                received IUs, DEFAULT_REGISTRY if None. Defaults to None.
+        """
+        self.registry = registry if registry is not None else DEFAULT_REGISTRY
+        self._creators = {}
+
+    def encode_iu(self, iu, update_type, out):
+        """Appends the encoding of an IU to a buffer, and registers it.
+
+        Args:
+            iu (retico_core.IncrementalUnit): the IU.
+            update_type (retico_core.UpdateType): its update type.
+            out (bytearray): the buffer.
+        """
+        cls = type(iu)
+        code = IU_TYPE_CODES.get(cls)
+        if code is None:
+            raise ValueError(f"no wire format for IUs of type {cls.__name__}")
+        flags = (COMMITTED if iu.committed else 0) | (REVOKED if iu.revoked else 0)
+        out += IU_HEADER.pack(
+            code, UPDATE_TYPE_CODES[update_type], flags, iu.created_at
+        )
+        _write_short_str(out, str(iu.iuid))
+        creator = iu.creator.name() if iu.creator is not None else ""
+        _write_short_str(out, creator)
+        for link in (iu.previous_iu, iu.grounded_in):
+            _write_field(out, "str", str(link.iuid) if link is not None else None)
+        for name, kind in IU_FIELDS[cls]:
+            _write_field(out, kind, getattr(iu, name, None))
+        self.registry.register(iu)
+
+    def decode_iu(self, reader):
+        """Decodes an IU, updating it if it was already received, and
+        registers it.
+
+        Args:
+            reader (_Reader): the reader of the buffer.
+
+        Returns:
+            (retico_core.IncrementalUnit, retico_core.UpdateType): the
+                IU and its update type.
+        """
+        code, update_type, flags, created_at = reader.unpack(IU_HEADER)
+        cls = IU_TYPES[code]
+        iuid = reader.read_short_str()
+        creator = reader.read_short_str()
+        previous_iuid = reader.read_str()
+        grounded_iuid = reader.read_str()
+        values = [(name, _read_field(reader, kind)) for name, kind in IU_FIELDS[cls]]
+        iu = self.registry.get(iuid)
+        if iu is None or type(iu) is not cls:
+            iu = cls.__new__(cls)
+            iu.iuid = iuid
+            iu.mutex = threading.Lock()
+            iu._processed_list = []
+            iu.meta_data = {}
+            iu.created_at = created_at
+            if creator not in self._creators:
+                self._creators[creator] = RemoteCreator(creator)
+            iu.creator = self._creators[creator]
+            iu.creator_id = None
+            self.registry.register(iu)
+        iu.committed = bool(flags & COMMITTED)
+        iu.revoked = bool(flags & REVOKED)
+        iu.previous_iu = self.registry.get(previous_iuid)
+        iu.grounded_in = self.registry.get(grounded_iuid)
+        # the payload is set first, as some retico_core versions define the
+        # text of the TextIUs as a property setting the payload
+        for base in cls.__mro__:
+            if base in IU_PAYLOADS:
+                iu.payload = dict(values)[IU_PAYLOADS[base]]
+                break
+        for name, value in values:
+            setattr(iu, name, value)
+        return iu, UPDATE_TYPES[update_type]
+
+    def encode_update_message(self, update_message):
+        """Encodes an UpdateMessage.
+
+        Args:
+            update_message (retico_core.UpdateMessage): the UpdateMessage.
+
+        Returns:
+            bytearray: the encoding.
+        """
+        out = bytearray()
+        ius = list(update_message)
+        out += U16.pack(len(ius))
+        for iu, ut in ius:
+            self.encode_iu(iu, ut, out)
+        return out
+
+    def decode_update_message(self, data):
+        """Decodes an UpdateMessage.
+
+        Args:
+            data (bytes): the encoding.
+
+        Returns:
+            retico_core.UpdateMessage: the UpdateMessage.
+        """
+        reader = _Reader(data)
+        (n_ius,) = reader.unpack(U16)
+        update_message = retico_core.UpdateMessage()
+        for _ in range(n_ius):
+            iu, ut = self.decode_iu(reader)
+            update_message.add_iu(iu, ut)
+        return update_message
+
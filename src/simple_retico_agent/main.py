@@ -15,6 +15,11 @@ from simple_retico_agent.simple_llm import SimpleLLMModule
 
 from simple_retico_agent.simple_tts import SimpleTTSModule
 from simple_retico_agent.simple_speaker import SimpleSpeakerModule
+from simple_retico_agent.audio_processing import PlaybackClock
+from simple_retico_agent.headless_io import WavFileSource, WavFileSink
+from simple_retico_agent.tracing import IUTracer
+from simple_retico_agent.event_log import BinaryEventLog, LivePlotter
+from simple_retico_agent.process_runtime import ProcessModule
 
 
 from retico_core.log_utils import (
@@ -29,12 +34,36 @@ from retico_core.log_utils import (
 )
 
 
+def create_llm(
+    prompt_format_config,
+    system_prompt,
+    context_size,
+    log_folder,
+    terminal_logger=None,
+    **kwargs,
+):
+    """Creates the LLM module and its DialogueHistory, possibly in the
+    child process of a ProcessModule (with its own logger)."""
+    if terminal_logger is None:
+        terminal_logger, _ = retico_core.log_utils.configurate_logger(log_folder)
+    dialogue_history = DialogueHistory(
+        prompt_format_config,
+        terminal_logger=terminal_logger,
+        initial_system_prompt=system_prompt,
+        context_size=context_size,
+    )
+    return SimpleLLMModule(
+        dialogue_history=dialogue_history, context_size=context_size, **kwargs
+    )
+
+
 def main_simple():
     # parameters definition
     device = "cuda" if torch.cuda.is_available() else "cpu"
     log_folder = "logs/run"
     frame_length = 0.02
     tts_frame_length = 0.2
+    speaker_frame_length = 0.04
     rate = 16000
     tts_model_samplerate = 48000
     # model_path = "./models/mistral-7b-instruct-v0.2.Q4_K_S.gguf"
@@ -48,6 +77,14 @@ def main_simple():
     plot_live = True
     prompt_format_config = "configs/prompt_format_config.json"
     context_size = 2000
+    # WAV files of the user's turns, to run without sound hardware (the agent's
+    # audio is then written in log_folder), None uses the microphone and
+    # speakers
+    input_wavs = None
+    # path of the Chrome trace of the IUs' latencies, None disables the tracing
+    trace_path = None
+    # modules run in separate processes, among "asr", "llm" and "tts"
+    process_modules = []
 
     # filters
     filters = [
@@ -65,47 +102,79 @@ def main_simple():
         log_folder, filters=filters
     )
 
-    # configure plot
+    # configure plot, the live plot is drawn from the binary event log
     configurate_plot(
-        is_plot_live=plot_live,
+        is_plot_live=False,
         refreshing_time=1,
         plot_config_path=plot_config_path,
         window_duration=30,
     )
 
-    dialogue_history = DialogueHistory(
-        prompt_format_config,
-        terminal_logger=terminal_logger,
-        initial_system_prompt=system_prompt,
-        context_size=context_size,
-    )
+    def create_module(name, module_class, factory=None, **module_kwargs):
+        if name in process_modules:
+            return ProcessModule(
+                module_class,
+                factory=factory,
+                log_folder=log_folder,
+                log_filters=filters,
+                module_kwargs=module_kwargs,
+            )
+        return (factory or module_class)(**module_kwargs)
 
     # create modules
-    mic = audio.MicrophoneModule()
+    if input_wavs is not None:
+        mic = WavFileSource(input_wavs, frame_length=frame_length, rate=rate)
+    else:
+        mic = audio.MicrophoneModule()
+
+    playback_clock = PlaybackClock(tts_model_samplerate)
 
     vad = SimpleVADModule(
         input_framerate=rate,
         frame_length=frame_length,
+        playback_clock=playback_clock,
     )
 
-    asr = SimpleWhisperASRModule(device=device, framerate=rate)
+    asr = create_module(
+        "asr", SimpleWhisperASRModule, device=device, framerate=rate
+    )
 
-    llm = SimpleLLMModule(
+    llm = create_module(
+        "llm",
+        SimpleLLMModule,
+        factory=create_llm,
+        prompt_format_config=prompt_format_config,
+        system_prompt=system_prompt,
+        context_size=context_size,
+        log_folder=log_folder,
+        terminal_logger=None if "llm" in process_modules else terminal_logger,
         model_path=None,
         model_repo=model_repo,
         model_name=model_name,
-        dialogue_history=dialogue_history,
         device=device,
-        context_size=context_size,
         # verbose=True,
     )
 
-    tts = SimpleTTSModule(
+    tts = create_module(
+        "tts",
+        SimpleTTSModule,
         frame_duration=tts_frame_length,
         device=device,
     )
 
-    speaker = SimpleSpeakerModule(rate=tts_model_samplerate)
+    if input_wavs is not None:
+        speaker = WavFileSink(
+            output_dir=log_folder,
+            rate=tts_model_samplerate,
+            frame_length=speaker_frame_length,
+            playback_clock=playback_clock,
+        )
+    else:
+        speaker = SimpleSpeakerModule(
+            rate=tts_model_samplerate,
+            frame_length=speaker_frame_length,
+            playback_clock=playback_clock,
+        )
 
     # create network
     mic.subscribe(vad)
@@ -115,16 +184,44 @@ def main_simple():
     tts.subscribe(speaker)
     speaker.subscribe(vad)
 
+    tracer = None
+    if trace_path is not None:
+        tracer = IUTracer()
+        tracer.instrument_network(mic)
+
+    # the live plotter reads the binary event log
+    event_log = None
+    plotter = None
+    if plot_live:
+        event_log = BinaryEventLog(log_folder)
+        event_log.instrument_network(mic)
+        plotter = LivePlotter(
+            log_folder,
+            plot_config_path,
+            window_duration=30,
+            refreshing_time=1,
+        )
+        plotter.start()
+
     # running system
     try:
         network.run(mic)
-        print("Dialog system running until ENTER key is pressed")
-        input()
+        if input_wavs is not None:
+            print("Dialog system running until all the WAV files are streamed")
+            mic.finished.wait()
+        else:
+            print("Dialog system running until ENTER key is pressed")
+            input()
         network.stop(mic)
     except Exception:
         terminal_logger.exception("exception in main")
         network.stop(mic)
     finally:
+        if plotter is not None:
+            plotter.stop()
+            event_log.close()
+        if tracer is not None:
+            tracer.export(trace_path)
         plot_once(plot_config_path=plot_config_path)
 
 
@@ -0,0 +1,677 @@
+"""
+Pipeline Benchmark
+==================
+
+End-to-end conversational latency benchmark of the main.py pipeline
+(VAD, ASR, LLM, TTS, speaker), run headless on scripted multi-turn WAV
+conversations (cf. headless_io).
+
+The heavy models can be replaced by configurable CPU stand-ins, that
+keep the real modules' logic (turn detection, incremental sending,
+clause packing, playback) and only emulate the models' latencies :
+
+- StandInASREngine, given to the SimpleWhisperASRModule as its
+  asr_engine, returns the scripted transcription of the user turn.
+- StandInLlama, used by the StandInLLMModule, streams the scripted
+  answer token by token.
+- StandInTTSModule synthesizes a tone of the estimated duration of the
+  clause, with a configurable real-time factor.
+
+A LatencyProbe module, subscribed to the ASR, LLM, TTS and speaker
+modules, timestamps their outputs. For each user turn, the benchmark
+computes the ASR final latency (from the end of the user's WAV file),
+the LLM time-to-first-token, the TTS first-chunk time, the playback
+start time and the total time from the user EOT to the first agent
+audio, prints their p50/p95/p99, and writes all the measures to a JSON
+file for regression tracking between commits. The duration and jitter of
+the speaker's audio callbacks are measured as well.
+
+The ASR, LLM and TTS can be run in separate processes (cf.
+process_runtime), to compare the callback timing and end-to-end latency
+with the single-process pipeline.
+
+The conversation script is a JSON file, for example :
+
+.. code-block:: json
+
+    {
+        "gap_duration": 6.0,
+        "turns": [
+            {"wav": "turn_1.wav", "transcript": "Hi.", "answer": "Hello!"},
+            {"wav": "turn_2.wav", "transcript": "Bye.", "answer": "Goodbye!"}
+        ]
+    }
+
+The WAV files should be trimmed, as the end of each file is considered
+as the user EOT.
+"""
+
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+import numpy as np
+
+import retico_core
+from retico_core import network
+
+from simple_retico_agent.audio_processing import PlaybackClock, to_int16_chunks
+from simple_retico_agent.dialogue_history import DialogueHistory
+from simple_retico_agent.headless_io import WavFileSource, WavFileSink
+from simple_retico_agent.process_runtime import ProcessModule
+from simple_retico_agent.simple_llm import SimpleLLMModule
+from simple_retico_agent.simple_tts import SimpleTTSModule
+from simple_retico_agent.simple_vad import SimpleVADModule
+from simple_retico_agent.simple_whisper_asr import SimpleWhisperASRModule
+from simple_retico_agent.tracing import IUTracer
+
+CONFIG_FOLDER = os.path.join(os.path.dirname(__file__), "configs")
+STAGES = (
+    "asr_final_latency",
+    "llm_first_token",
+    "tts_first_chunk",
+    "playback_start",
+    "user_eot_to_agent_audio",
+)
+
+
+class StandInASREngine:
+    """CPU stand-in of the WhisperASREngine, returning the scripted
+    transcription of the current user turn after a latency proportional
+    to the duration of the transcribed audio."""
+
+    def __init__(
+        self,
+        transcripts,
+        framerate=16000,
+        base_latency=0.05,
+        latency_per_second=0.02,
+    ):
+        """Initializes the StandInASREngine.
+
+        Args:
+            transcripts (list[str]): the transcriptions of the user
+                turns.
+            framerate (int, optional): framerate of the transcribed
+                audio. Defaults to 16000.
+            base_latency (float, optional): fixed latency (in seconds)
+                of a transcription. Defaults to 0.05.
+            latency_per_second (float, optional): latency added per
+                second of transcribed audio. Defaults to 0.02.
+        """
+        self.device = "cpu"
+        self.transcripts = transcripts
+        self.framerate = framerate
+        self.base_latency = base_latency
+        self.latency_per_second = latency_per_second
+        self.n_turns = 0
+
+    def transcribe(self, audio, stream_id, final=False):
+        """Returns the transcription of the current user turn.
+
+        Args:
+            audio (np.ndarray): the float32 audio.
+            stream_id (int): id of the ASR module.
+            final (bool, optional): True for the final hypothesis of the
+                user turn. Defaults to False.
+
+        Returns:
+            str: the transcription.
+        """
+        time.sleep(
+            self.base_latency + self.latency_per_second * len(audio) / self.framerate
+        )
+        transcript = self.transcripts[self.n_turns % len(self.transcripts)]
+        if final:
+            self.n_turns += 1
+        return transcript
+
+
+class StandInLlama:
+    """CPU stand-in of llama_cpp's Llama model, streaming the scripted
+    answers token by token (a token being a word or a punctuation)."""
+
+    EOS = 0
+
+    def __init__(self, answers, prefill_time_per_token=0.0005, token_interval=0.03):
+        """Initializes the StandInLlama.
+
+        Args:
+            answers (list[str]): the answers of the agent turns.
+            prefill_time_per_token (float, optional): time (in seconds)
+                per prompt token before the first generated token.
+                Defaults to 0.0005.
+            token_interval (float, optional): time between two
+                generated tokens. Defaults to 0.03.
+        """
+        self.answers = answers
+        self.prefill_time_per_token = prefill_time_per_token
+        self.token_interval = token_interval
+        self.n_turns = 0
+        self.vocabulary = {b"": self.EOS}
+        self.words = [b""]
+
+    def token_eos(self):
+        return self.EOS
+
+    def tokenize(self, text, add_bos=True):
+        tokens = []
+        for word in re.findall(rb"\s*\w+|\s*[^\w\s]", text):
+            if word not in self.vocabulary:
+                self.vocabulary[word] = len(self.words)
+                self.words.append(word)
+            tokens.append(self.vocabulary[word])
+        return tokens
+
+    def detokenize(self, tokens):
+        return b"".join([self.words[t] for t in tokens])
+
+    def generate(self, tokens, stopping_criteria=None, **kwargs):
+        """Yields the tokens of the next scripted answer, then the EOS token.
+
+        Args:
+            tokens (list[int]): the prompt tokens.
+            stopping_criteria (Callable, optional): called after every
+                token, stops the generation if it returns True. Defaults
+                to None.
+
+        Yields:
+            int: the generated tokens.
+        """
+        time.sleep(self.prefill_time_per_token * len(tokens))
+        answer = self.answers[self.n_turns % len(self.answers)]
+        self.n_turns += 1
+        generated = []
+        for token in self.tokenize(b" " + answer.encode("utf-8")) + [self.EOS]:
+            time.sleep(self.token_interval)
+            generated.append(token)
+            yield token
+            if stopping_criteria is not None and stopping_criteria(generated, None):
+                return
+
+
+class StandInLLMModule(SimpleLLMModule):
+    """A SimpleLLMModule generating with a StandInLlama."""
+
+    def __init__(self, stand_in_model, dialogue_history, **kwargs):
+        """Initializes the StandInLLMModule.
+
+        Args:
+            stand_in_model (StandInLlama): the stand-in model.
+            dialogue_history (DialogueHistory): the dialogue history.
+        """
+        super().__init__(
+            model_path=None,
+            model_repo=None,
+            model_name=None,
+            dialogue_history=dialogue_history,
+            **kwargs,
+        )
+        self.stand_in_model = stand_in_model
+
+    def setup(self, **kwargs):
+        """Uses the stand-in model instead of loading a Llama model."""
+        retico_core.AbstractModule.setup(self, **kwargs)
+        self.model = self.stand_in_model
+        self.init_stop_criteria()
+
+
+class StandInTTSModule(SimpleTTSModule):
+    """A SimpleTTSModule synthesizing a tone of the estimated duration of
+    each clause, with a configurable real-time factor."""
+
+    def __init__(
+        self,
+        samplerate=48000,
+        real_time_factor=0.3,
+        base_latency=0.05,
+        chars_per_second=14.0,
+        **kwargs,
+    ):
+        """Initializes the StandInTTSModule.
+
+        Args:
+            samplerate (int, optional): framerate of the synthesized
+                audio. Defaults to 48000.
+            real_time_factor (float, optional): synthesis time per
+                second of synthesized audio. Defaults to 0.3.
+            base_latency (float, optional): fixed synthesis time (in
+                seconds) per clause. Defaults to 0.05.
+            chars_per_second (float, optional): speaking rate used to
+                estimate the duration of a clause. Defaults to 14.0.
+        """
+        super().__init__(**kwargs)
+        self.stand_in_samplerate = samplerate
+        self.real_time_factor = real_time_factor
+        self.base_latency = base_latency
+        self.chars_per_second = chars_per_second
+
+    def setup(self):
+        """Sets the audio attributes instead of loading a TTS model."""
+        retico_core.AbstractModule.setup(self)
+        self.samplerate = self.stand_in_samplerate
+        self.chunk_size = int(self.samplerate * self.frame_duration)
+        self.chunk_size_bytes = self.chunk_size * self.samplewidth
+        self.worker_models = [None] * self.n_workers
+
+    def is_batch_capable(self):
+        return False
+
+    def synthesize(self, text):
+        """Synthesizes a tone of the estimated duration of the text.
+
+        Args:
+            text (str): the text.
+
+        Returns:
+            (np.ndarray, list[dict]): the int16 audio, padded to a whole
+                number of chunks, and the outputs.
+        """
+        duration = max(len(text.strip()), 1) / self.chars_per_second
+        time.sleep(self.base_latency + self.real_time_factor * duration)
+        t = np.arange(int(duration * self.samplerate)) / self.samplerate
+        wav = (0.1 * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+        return to_int16_chunks(wav, self.chunk_size), [{"wav": wav}]
+
+
+class LatencyProbe(retico_core.AbstractConsumingModule):
+    """A consuming module that timestamps the IUs it receives from the
+    modules it is subscribed to.
+
+    Attributes:
+        timestamps (list[tuple[float, str, str]]): the (UNIX timestamp,
+            module name, event) of the received IUs, the events being
+            "add", "commit", "final", "agent_BOT" or "agent_EOT".
+    """
+
+    @staticmethod
+    def name():
+        return "Latency Probe Module"
+
+    @staticmethod
+    def description():
+        return "A module that timestamps the IUs of the modules it is subscribed to."
+
+    @staticmethod
+    def input_ius():
+        return [retico_core.IncrementalUnit]
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.timestamps = []
+        self._lock = threading.Lock()
+
+    def process_update(self, update_message):
+        received_at = time.time()
+        for iu, ut in update_message:
+            module = iu.creator.name() if iu.creator is not None else None
+            if getattr(iu, "text", None) in ("agent_BOT", "agent_EOT"):
+                event = iu.text
+            elif ut == retico_core.UpdateType.COMMIT:
+                event = "commit"
+            elif ut == retico_core.UpdateType.ADD:
+                event = "final" if getattr(iu, "final", False) else "add"
+            else:
+                continue
+            # the ADDs are timestamped when the IU was created
+            timestamp = iu.created_at if ut == retico_core.UpdateType.ADD else None
+            with self._lock:
+                self.timestamps.append((timestamp or received_at, module, event))
+
+
+def get_turn_measures(file_times, timestamps, asr, llm, tts, speaker):
+    """Computes the per-stage latencies of every user turn from the source's
+    file times and the probe's timestamps.
+
+    Args:
+        file_times (list[tuple[str, float, float]]): the WAV files and
+            their start and end times.
+        timestamps (list[tuple[float, str, str]]): the probe's timestamps.
+        asr, llm, tts, speaker (str): names of the modules.
+
+    Returns:
+        list[dict]: the measures (in seconds) of every turn, None if a
+            stage was not reached.
+    """
+    timestamps = sorted(timestamps)
+
+    def first(module, kinds, after, before):
+        for timestamp, m, event in timestamps:
+            if m == module and event in kinds and after <= timestamp < before:
+                return timestamp
+        return None
+
+    turns = []
+    for i, (path, start, user_eot) in enumerate(file_times):
+        end = file_times[i + 1][1] if i + 1 < len(file_times) else float("inf")
+        measures = {"wav": path}
+        asr_final = first(asr, ("commit",), start, end)
+        llm_first = asr_final and first(llm, ("add",), asr_final, end)
+        tts_first = llm_first and first(tts, ("add",), llm_first, end)
+        agent_bot = tts_first and first(speaker, ("agent_BOT",), tts_first, end)
+        measures["asr_final_latency"] = asr_final and asr_final - user_eot
+        measures["llm_first_token"] = llm_first and llm_first - asr_final
+        measures["tts_first_chunk"] = tts_first and tts_first - llm_first
+        measures["playback_start"] = agent_bot and agent_bot - tts_first
+        measures["user_eot_to_agent_audio"] = agent_bot and agent_bot - user_eot
+        turns.append(measures)
+    return turns
+
+
+def summarize(turns, inter_clause_gaps, other_measures=None):
+    """Returns the p50/p95/p99 of every stage latency, of the inter-clause
+    gaps, and of other measures.
+
+    Args:
+        turns (list[dict]): the measures of every turn.
+        inter_clause_gaps (list[float]): the inter-clause gaps.
+        other_measures (dict[str, list[float]], optional): other
+            measures (e.g. the speaker's callback durations). Defaults
+            to None.
+
+    Returns:
+        dict[str, dict]: the percentiles (in seconds) and number of
+            measures of every stage.
+    """
+    summary = {}
+    measures = {
+        stage: [t[stage] for t in turns if t[stage] is not None] for stage in STAGES
+    }
+    measures["inter_clause_gap"] = inter_clause_gaps
+    measures.update(other_measures or {})
+    for stage, values in measures.items():
+        summary[stage] = {"n": len(values)}
+        for p in (50, 95, 99):
+            summary[stage][f"p{p}"] = (
+                float(np.percentile(values, p)) if len(values) != 0 else None
+            )
+    return summary
+
+
+def create_llm_module(
+    system_prompt,
+    stand_in_answers=None,
+    stand_in_kwargs=None,
+    log_folder=None,
+    terminal_logger=None,
+    **kwargs,
+):
+    """Creates the LLM module (the stand-in one if answers are given) and its
+    DialogueHistory. Used as the factory of the LLM's ProcessModule, as the
+    DialogueHistory is created in the child process.
+
+    Args:
+        system_prompt (str): the initial system prompt.
+        stand_in_answers (list[str], optional): the answers of the
+            StandInLlama, the SimpleLLMModule is created if None.
+            Defaults to None.
+        stand_in_kwargs (dict, optional): parameters of the
+            StandInLlama. Defaults to None.
+        log_folder (str, optional): log folder given to
+            log_utils.configurate_logger if terminal_logger is None.
+            Defaults to None.
+        terminal_logger (TerminalLogger, optional): the terminal logger
+            of the DialogueHistory. Defaults to None.
+        **kwargs: parameters of the SimpleLLMModule.
+
+    Returns:
+        SimpleLLMModule: the LLM module.
+    """
+    if terminal_logger is None:
+        terminal_logger, _ = retico_core.log_utils.configurate_logger(log_folder)
+    dialogue_history = DialogueHistory(
+        os.path.join(CONFIG_FOLDER, "prompt_format_config.json"),
+        terminal_logger=terminal_logger,
+        initial_system_prompt=system_prompt,
+        context_size=2000,
+    )
+    if stand_in_answers is not None:
+        return StandInLLMModule(
+            StandInLlama(stand_in_answers, **(stand_in_kwargs or {})),
+            dialogue_history,
+        )
+    return SimpleLLMModule(
+        model_path=None, dialogue_history=dialogue_history, **kwargs
+    )
+
+
+def get_git_commit():
+    """Returns the hash of the current git commit, or None."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(__file__),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_pipeline_benchmark(
+    script_path,
+    output_path=None,
+    log_folder="logs/pipeline_benchmark",
+    device=None,
+    asr_model=None,
+    llm_repo=None,
+    llm_name=None,
+    tts_model=None,
+    stand_in_kwargs=None,
+    tail_duration=5.0,
+    trace_path=None,
+    process_modules=(),
+):
+    """Runs the main.py pipeline headless on a scripted conversation, and
+    measures its per-stage latencies.
+
+    Args:
+        script_path (str): path to the JSON conversation script.
+        output_path (str, optional): path of the JSON results file.
+            Defaults to None.
+        log_folder (str, optional): folder of the modules' logs and of
+            the agent's audio. Defaults to "logs/pipeline_benchmark".
+        device (str, optional): device of the real models. Defaults to
+            None.
+        asr_model (str, optional): faster_whisper model of the ASR, the
+            stand-in is used if None. Defaults to None.
+        llm_repo (str, optional): HF repository of the LLM, the stand-in
+            is used if None. Defaults to None.
+        llm_name (str, optional): file name of the LLM. Defaults to
+            None.
+        tts_model (str, optional): SimpleTTSModule model name of the
+            TTS, the stand-in is used if None. Defaults to None.
+        stand_in_kwargs (dict[str, dict], optional): parameters of the
+            "asr", "llm" and "tts" stand-ins. Defaults to None.
+        tail_duration (float, optional): time (in seconds) the pipeline
+            keeps running after the end of the script. Defaults to 5.0.
+        trace_path (str, optional): path of the Chrome trace of the IUs'
+            latencies (cf. tracing), None disables the tracing. Defaults
+            to None.
+        process_modules (tuple[str], optional): the modules run in
+            separate processes, among "asr", "llm" and "tts". Defaults
+            to ().
+
+    Returns:
+        dict: the results.
+    """
+    with open(script_path, encoding="utf-8") as f:
+        script = json.load(f)
+    script_dir = os.path.dirname(os.path.abspath(script_path))
+    turns = script["turns"]
+    wav_paths = [os.path.join(script_dir, t["wav"]) for t in turns]
+    stand_in_kwargs = stand_in_kwargs or {}
+    rate = 16000
+    frame_length = 0.02
+    tts_model_samplerate = 48000
+
+    for stage in process_modules:
+        if stage not in ("asr", "llm", "tts"):
+            raise ValueError(f"unknown process module : {stage}")
+
+    terminal_logger, _ = retico_core.log_utils.configurate_logger(log_folder)
+
+    def create_module(stage, module_class, factory=None, **module_kwargs):
+        if stage in process_modules:
+            return ProcessModule(
+                module_class,
+                factory=factory,
+                log_folder=log_folder,
+                module_kwargs=module_kwargs,
+            )
+        return (factory or module_class)(**module_kwargs)
+
+    source = WavFileSource(
+        wav_paths,
+        frame_length=frame_length,
+        rate=rate,
+        gap_duration=script.get("gap_duration", 6.0),
+    )
+    playback_clock = PlaybackClock(tts_model_samplerate)
+    vad = SimpleVADModule(
+        input_framerate=rate,
+        frame_length=frame_length,
+        playback_clock=playback_clock,
+    )
+    if asr_model is None:
+        asr = create_module(
+            "asr",
+            SimpleWhisperASRModule,
+            framerate=rate,
+            asr_engine=StandInASREngine(
+                [t.get("transcript", "Hello.") for t in turns],
+                framerate=rate,
+                **stand_in_kwargs.get("asr", {}),
+            ),
+        )
+    else:
+        asr = create_module(
+            "asr",
+            SimpleWhisperASRModule,
+            whisper_model=asr_model,
+            device=device,
+            framerate=rate,
+        )
+    llm_kwargs = {
+        "system_prompt": script.get(
+            "system_prompt", "This is a spoken dialog scenario."
+        ),
+        # the DialogueHistory of a child process has its own logger
+        "log_folder": log_folder,
+        "terminal_logger": None if "llm" in process_modules else terminal_logger,
+    }
+    if llm_repo is None:
+        llm_kwargs["stand_in_answers"] = [
+            t.get("answer", "Hello, how can I help you?") for t in turns
+        ]
+        llm_kwargs["stand_in_kwargs"] = stand_in_kwargs.get("llm", {})
+        llm_class = StandInLLMModule
+    else:
+        llm_kwargs.update(model_repo=llm_repo, model_name=llm_name, device=device)
+        llm_class = SimpleLLMModule
+    llm = create_module("llm", llm_class, factory=create_llm_module, **llm_kwargs)
+    if tts_model is None:
+        tts = create_module(
+            "tts",
+            StandInTTSModule,
+            samplerate=tts_model_samplerate,
+            **stand_in_kwargs.get("tts", {}),
+        )
+    else:
+        tts = create_module("tts", SimpleTTSModule, model=tts_model, device=device)
+    speaker = WavFileSink(
+        output_dir=log_folder,
+        rate=tts_model_samplerate,
+        frame_length=0.04,
+        playback_clock=playback_clock,
+    )
+    probe = LatencyProbe()
+
+    # times the speaker's audio callbacks, that share the GIL with the
+    # modules run in the main process
+    callback_times = []
+    speaker_callback = speaker.callback
+
+    def timed_callback(*args):
+        start = time.perf_counter()
+        try:
+            return speaker_callback(*args)
+        finally:
+            callback_times.append((start, time.perf_counter() - start))
+
+    speaker.callback = timed_callback
+
+    source.subscribe(vad)
+    vad.subscribe(asr)
+    asr.subscribe(llm)
+    llm.subscribe(tts)
+    tts.subscribe(speaker)
+    speaker.subscribe(vad)
+    for module in (asr, llm, tts, speaker):
+        module.subscribe(probe)
+
+    tracer = None
+    if trace_path is not None:
+        tracer = IUTracer()
+        tracer.instrument_network(source)
+
+    network.run(source)
+    try:
+        source.finished.wait()
+        time.sleep(tail_duration)
+    finally:
+        network.stop(source)
+    if tracer is not None:
+        tracer.export(trace_path)
+
+    callback_starts = np.array([t for t, _ in callback_times])
+    callback_measures = {
+        "speaker_callback_duration": [d for _, d in callback_times],
+        # deviation of the intervals between the callbacks from their period
+        "speaker_callback_jitter": list(
+            np.abs(np.diff(callback_starts) - speaker.frame_length)
+        ),
+    }
+    turn_measures = get_turn_measures(
+        source.file_times,
+        probe.timestamps,
+        asr.name(),
+        llm.name(),
+        tts.name(),
+        speaker.name(),
+    )
+    results = {
+        "commit": get_git_commit(),
+        "timestamp": time.time(),
+        "config": {
+            "script": script_path,
+            "asr": asr_model or "stand-in",
+            "llm": llm_name or "stand-in",
+            "tts": tts_model or "stand-in",
+            "stand_in_kwargs": stand_in_kwargs,
+            "process_modules": list(process_modules),
+        },
+        "turns": turn_measures,
+        "inter_clause_gaps": list(speaker.inter_clause_gaps),
+        "n_underruns": speaker.n_underruns,
+        "summary": summarize(
+            turn_measures, list(speaker.inter_clause_gaps), callback_measures
+        ),
+    }
+
+    print(f"{'stage':26s} {'n':>3s} {'p50':>8s} {'p95':>8s} {'p99':>8s}")
+    for stage, stats in results["summary"].items():
+        print(
+            f"{stage:26s} {stats['n']:3d} "
+            + " ".join(
+                f"{stats[p] * 1000:6.0f}ms" if stats[p] is not None else f"{'-':>8s}"
+                for p in ("p50", "p95", "p99")
+            )
+        )
+    if output_path is not None:
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return results
@@ -0,0 +1,751 @@
+"""
+Process Runtime
+===============
+
+Runs chosen modules of the network (e.g. the ASR, LLM and TTS) in
+separate processes, so that their Python-side work does not contend for
+the GIL with the other modules and the audio callback.
+
+A ProcessModule takes the place of a module in the network : it creates
+the real module in a child process (with the module's own, unchanged,
+code), forwards it the UpdateMessages it receives, and appends the
+UpdateMessages the module outputs. In the child process, the module is
+fed by an internal module with the received UpdateMessages, and its
+append method sends its outputs back directly (without waiting for
+another module's loop).
+
+The IUs travel between the processes as their attributes (the IUs
+themselves, the links to their creator and queues, cannot be shared) :
+
+- the metadata (class, attributes, update type) through pipes,
+- the raw audio through shared-memory rings (SharedAudioRing), without
+  being pickled : it is copied once into the ring by the sending
+  process, and once out of it by the receiving one (the received IUs
+  can live longer than the ring's content),
+- the grounded_in and previous_iu links as tokens, resolved back to the
+  original IUs on the other side (e.g. the TextFinalIUs of an LLM
+  running in a child process are grounded in the main process's
+  SpeechRecognitionIUs, not in copies of them).
+
+An IU sent again (e.g. ADD then COMMIT) is updated in place on the other
+side.
+
+.. code-block:: python
+
+    asr = ProcessModule(
+        SimpleWhisperASRModule,
+        log_folder=log_folder,
+        module_kwargs={"device": device, "framerate": rate},
+    )
+    vad.subscribe(asr)
+    asr.subscribe(llm)
+
+The module's parameters have to be picklable, modules sharing objects
+with other modules (e.g. the PlaybackClock shared by the VAD and the
+speaker) have to stay in the main process, and objects only used by the
+module (e.g. the LLM's DialogueHistory) can be created in the child
+process by a factory.
+
+Once the module is set up, its file_logger sends its log events (with
+the time at which they happened in the child process) to the
+ProcessModule, which logs them with its own file_logger : they are
+written in the main process's log file, and recorded by the
+BinaryEventLog or the IUTracer instrumenting the ProcessModule. The
+IUTracer only sees the module through the ProcessModule though : its
+IUs' append and consume times are traced, but its process_update spans
+only cover the queueing of the UpdateMessages for the child process.
+
+At shutdown, the child process waits at most shutdown_timeout seconds
+for the module's threads, and is terminated by the ProcessModule if it
+still has not ended after that.
+"""
+
+import collections
+import importlib
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+from multiprocessing import shared_memory
+import numpy as np
+
+import retico_core
+from retico_core import log_utils
+
+# attributes of the IUs that are not sent, or sent separately
+IU_LINKS = ("creator", "previous_iu", "grounded_in", "mutex", "_processed_list")
+
+
+def get_iu_state(iu):
+    """Returns the attributes of an IU, except its links to other IUs and
+    modules.
+
+    Args:
+        iu (retico_core.IncrementalUnit): the IU.
+
+    Returns:
+        dict: the attributes.
+    """
+    state = dict(iu.__dict__)
+    for name in IU_LINKS:
+        state.pop(name, None)
+    return state
+
+
+def set_iu_state(iu, state):
+    """Sets the attributes of an IU.
+
+    Args:
+        iu (retico_core.IncrementalUnit): the IU.
+        state (dict): the attributes.
+    """
+    for k, v in state.items():
+        setattr(iu, k, v)
+
+
+class SharedAudioRing:
+    """Single-producer single-consumer byte ring in shared memory, used to
+    send the raw audio of the IUs from one process to another.
+
+    The first 16 bytes of the shared memory hold the (monotonic) write
+    and read positions, only the producer moves the write position, and
+    only the consumer the read position.
+    """
+
+    HEADER_SIZE = 16
+
+    def __init__(self, capacity=None, name=None):
+        """Creates the ring (if capacity is given) or attaches to an
+        existing one (if name is given).
+
+        Args:
+            capacity (int, optional): capacity (in bytes) of the created
+                ring. Defaults to None.
+            name (str, optional): name of the shared memory of the ring to
+                attach to. Defaults to None.
+        """
+        if name is None:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=self.HEADER_SIZE + capacity
+            )
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.shm.name
+        self.capacity = self.shm.size - self.HEADER_SIZE
+        self.positions = np.ndarray((2,), dtype=np.uint64, buffer=self.shm.buf)
+        if self.owner:
+            self.positions[:] = 0
+        self.data = self.shm.buf[self.HEADER_SIZE : self.HEADER_SIZE + self.capacity]
+        self.closed = False
+
+    def write(self, raw_audio):
+        """Writes raw audio in the ring, waiting for enough free space.
+
+        Args:
+            raw_audio (bytes): the raw audio.
+
+        Returns:
+            int: the position of the audio, None if the ring was closed
+                while waiting.
+        """
+        length = len(raw_audio)
+        if length > self.capacity:
+            raise ValueError(f"audio of {length} bytes larger than the ring")
+        position = int(self.positions[0])
+        while position + length - int(self.positions[1]) > self.capacity:
+            if self.closed:
+                return None
+            time.sleep(0.001)
+        start = position % self.capacity
+        first = min(length, self.capacity - start)
+        view = memoryview(raw_audio).cast("B")
+        self.data[start : start + first] = view[:first]
+        self.data[: length - first] = view[first:]
+        self.positions[0] = position + length
+        return position
+
+    def read(self, position, length):
+        """Reads the raw audio written at a position, and frees its space.
+        The audio has to be read in the order it was written.
+
+        Args:
+            position (int): position of the audio.
+            length (int): length (in bytes) of the audio.
+
+        Returns:
+            bytes: the raw audio.
+        """
+        start = position % self.capacity
+        first = min(length, self.capacity - start)
+        raw_audio = bytes(self.data[start : start + first])
+        if first < length:
+            raw_audio += bytes(self.data[: length - first])
+        self.positions[1] = position + length
+        return raw_audio
+
+    def close(self):
+        """Detaches from the shared memory, and frees it if the ring was
+        created by this process."""
+        self.closed = True
+        del self.positions
+        self.data.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class IUChannel:
+    """One end of the transport of the IUs between two processes : encodes
+    the sent IUs and decodes the received ones, keeping the tokens of the
+    last IUs to resolve the links between them."""
+
+    def __init__(self, send_ring, receive_ring, creator=None, max_ius=10000):
+        """Initializes the IUChannel.
+
+        Args:
+            send_ring (SharedAudioRing): the ring of the sent audio.
+            receive_ring (SharedAudioRing): the ring of the received
+                audio.
+            creator (retico_core.AbstractModule, optional): the creator
+                of the received IUs. Defaults to None.
+            max_ius (int, optional): number of sent and received IUs
+                whose tokens are kept. Defaults to 10000.
+        """
+        self.send_ring = send_ring
+        self.receive_ring = receive_ring
+        self.creator = creator
+        self.max_ius = max_ius
+        # token -> IU, and id(IU) -> token
+        self.sent = collections.OrderedDict()
+        self.sent_tokens = {}
+        self.received = collections.OrderedDict()
+        self.received_tokens = {}
+        self.n_sent = 0
+        self._classes = {}
+
+    def _keep(self, ius, tokens, token, iu):
+        ius[token] = iu
+        tokens[id(iu)] = token
+        if len(ius) > self.max_ius:
+            _, old_iu = ius.popitem(last=False)
+            tokens.pop(id(old_iu), None)
+
+    def reference(self, iu):
+        """Returns the reference of a linked IU, for the other process.
+
+        Args:
+            iu (retico_core.IncrementalUnit): the linked IU.
+
+        Returns:
+            tuple: ("s", token) for a sent IU, ("r", token) for a
+                received one, None if the IU is unknown.
+        """
+        if iu is None:
+            return None
+        token = self.sent_tokens.get(id(iu))
+        if token is not None:
+            return ("s", token)
+        token = self.received_tokens.get(id(iu))
+        if token is not None:
+            return ("r", token)
+        return None
+
+    def resolve(self, reference):
+        """Returns the IU of a reference from the other process.
+
+        Args:
+            reference (tuple): the reference.
+
+        Returns:
+            retico_core.IncrementalUnit: the IU, None if it is unknown.
+        """
+        if reference is None:
+            return None
+        kind, token = reference
+        # the IUs sent by the other process are the received ones
+        return (self.received if kind == "s" else self.sent).get(token)
+
+    def encode(self, update_message):
+        """Encodes an UpdateMessage, writing the raw audio of its new IUs in
+        the ring.
+
+        Args:
+            update_message (retico_core.UpdateMessage): the
+                UpdateMessage.
+
+        Returns:
+            list[tuple]: the encoded IUs, None if the ring was closed.
+        """
+        entries = []
+        for iu, ut in update_message:
+            token = self.sent_tokens.get(id(iu))
+            new = token is None
+            if new:
+                token = self.n_sent
+                self.n_sent += 1
+            state = get_iu_state(iu)
+            audio = None
+            raw_audio = state.get("raw_audio")
+            if raw_audio is not None:
+                # the audio is only sent with the IU's first UpdateMessage
+                del state["raw_audio"]
+                is_payload = state.get("payload") is raw_audio
+                if is_payload:
+                    del state["payload"]
+                if new:
+                    position = self.send_ring.write(raw_audio)
+                    if position is None:
+                        return None
+                    audio = (position, len(raw_audio), is_payload)
+            entries.append(
+                (
+                    token,
+                    (type(iu).__module__, type(iu).__qualname__),
+                    state,
+                    self.reference(iu.previous_iu),
+                    self.reference(iu.grounded_in),
+                    audio,
+                    ut.value,
+                )
+            )
+            if new:
+                self._keep(self.sent, self.sent_tokens, token, iu)
+        return entries
+
+    def _get_class(self, class_path):
+        cls = self._classes.get(class_path)
+        if cls is None:
+            module_name, qualname = class_path
+            cls = importlib.import_module(module_name)
+            for name in qualname.split("."):
+                cls = getattr(cls, name)
+            self._classes[class_path] = cls
+        return cls
+
+    def decode(self, entries):
+        """Decodes the encoded IUs of an UpdateMessage, reading the raw audio
+        of the new IUs from the ring.
+
+        Args:
+            entries (list[tuple]): the encoded IUs.
+
+        Returns:
+            retico_core.UpdateMessage: the UpdateMessage.
+        """
+        update_message = retico_core.UpdateMessage()
+        for token, class_path, state, previous, grounded, audio, ut in entries:
+            iu = self.received.get(token)
+            if iu is None:
+                cls = self._get_class(class_path)
+                iu = cls.__new__(cls)
+                iu.mutex = threading.Lock()
+                iu._processed_list = []
+                iu.creator = self.creator
+                if audio is not None:
+                    position, length, is_payload = audio
+                    iu.raw_audio = self.receive_ring.read(position, length)
+                    if is_payload:
+                        iu.payload = iu.raw_audio
+                self._keep(self.received, self.received_tokens, token, iu)
+            set_iu_state(iu, state)
+            iu.previous_iu = self.resolve(previous)
+            iu.grounded_in = self.resolve(grounded)
+            update_message.add_iu(iu, retico_core.UpdateType(ut))
+        return update_message
+
+
+class _PipeInputModule(retico_core.AbstractModule):
+    """Feeds the module of a child process with the UpdateMessages received
+    from the main process."""
+
+    @staticmethod
+    def name():
+        return "Pipe Input Module"
+
+    @staticmethod
+    def description():
+        return "A module feeding the UpdateMessages received from another process."
+
+    @staticmethod
+    def input_ius():
+        return []
+
+    @staticmethod
+    def output_iu():
+        return retico_core.IncrementalUnit
+
+    def process_update(self, update_message):
+        return None
+
+
+class _PipeFileLogger:
+    """File logger of a module running in a child process, sending its log
+    events to the ProcessModule in the main process.
+
+    The exceptions (logged with their traceback) and the events whose
+    fields cannot be pickled are logged in the child process.
+    """
+
+    def __init__(self, file_logger, send):
+        """Initializes the _PipeFileLogger.
+
+        Args:
+            file_logger (structlog.BoundLogger): the module's file logger.
+            send (callable): function sending a message to the main
+                process.
+        """
+        self.file_logger = file_logger
+        self.send = send
+
+    def _log(self, level, event, **kw):
+        fields = dict(kw)
+        fields.setdefault("event_time", time.time())
+        try:
+            self.send(("log", level, event, fields))
+        except Exception:
+            getattr(self.file_logger, level)(event, **kw)
+
+    def debug(self, event, **kw):
+        self._log("debug", event, **kw)
+
+    def info(self, event, **kw):
+        self._log("info", event, **kw)
+
+    def warning(self, event, **kw):
+        self._log("warning", event, **kw)
+
+    def error(self, event, **kw):
+        self._log("error", event, **kw)
+
+    def __getattr__(self, attribute):
+        return getattr(self.file_logger, attribute)
+
+
+def _run_module_process(
+    module_class,
+    factory,
+    module_kwargs,
+    log_folder,
+    log_filters,
+    connection,
+    input_ring_name,
+    output_ring_name,
+    max_ius,
+    shutdown_timeout,
+):
+    """Target of a ProcessModule's child process : creates and sets up the
+    module, then runs it with the UpdateMessages received from the main
+    process until it is stopped."""
+    input_ring = SharedAudioRing(name=input_ring_name)
+    output_ring = SharedAudioRing(name=output_ring_name)
+    try:
+        if log_folder is not None:
+            log_utils.configurate_logger(log_folder, filters=log_filters)
+        module = (factory or module_class)(**module_kwargs)
+        module.setup()
+    except Exception:
+        connection.send(("error", traceback.format_exc()))
+        input_ring.close()
+        output_ring.close()
+        return
+    pipe_input = _PipeInputModule()
+    channel = IUChannel(output_ring, input_ring, creator=pipe_input, max_ius=max_ius)
+    pipe_input.subscribe(module)
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            connection.send(message)
+
+    def append(update_message):
+        if not update_message:
+            return
+        with send_lock:
+            entries = channel.encode(update_message)
+            if entries:
+                connection.send(("update", entries))
+
+    # the module's outputs and log events are sent to the main process
+    module.append = append
+    module.file_logger = _PipeFileLogger(module.file_logger, send)
+    connection.send(("ready",))
+
+    while True:
+        message = connection.recv()
+        if message[0] == "update":
+            pipe_input.append(channel.decode(message[1]))
+        elif message[0] == "run":
+            module.run(run_setup=False)
+        elif message[0] == "stop":
+            break
+    module.stop()
+    # waits for the module's shutdown, for at most shutdown_timeout seconds
+    deadline = time.monotonic() + shutdown_timeout
+    stuck_threads = []
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and not thread.daemon:
+            thread.join(max(0.0, deadline - time.monotonic()))
+            if thread.is_alive():
+                stuck_threads.append(thread.name)
+    with send_lock:
+        output_ring.closed = True
+        connection.send(("stopped", stuck_threads))
+    input_ring.close()
+    output_ring.close()
+    if stuck_threads:
+        # the interpreter's exit would wait for the stuck threads
+        os._exit(0)
+
+
+class ProcessModule(retico_core.AbstractModule):
+    """Takes the place of a module in the network, and runs it in a child
+    process.
+
+    The ProcessModule has the name and IU types of the module. The
+    UpdateMessages put in its left buffers are queued right away, instead
+    of waiting for the module's loop to poll them, and a sending thread
+    encodes and sends them to the child process (so that the modules
+    putting them, e.g. the VAD, never wait for the ring or the pipe).
+
+    Attributes:
+        n_dropped (int): number of UpdateMessages dropped because the
+            queue stayed full.
+    """
+
+    def name(self):
+        return self.module_class.name()
+
+    def description(self):
+        return self.module_class.description()
+
+    def input_ius(self):
+        return self.module_class.input_ius()
+
+    def output_iu(self):
+        return self.module_class.output_iu()
+
+    def __init__(
+        self,
+        module_class,
+        factory=None,
+        log_folder=None,
+        log_filters=None,
+        ring_capacity=16 * 2**20,
+        max_ius=10000,
+        max_queued=256,
+        send_timeout=5.0,
+        shutdown_timeout=5.0,
+        module_kwargs=None,
+        **kwargs,
+    ):
+        """Initializes the ProcessModule.
+
+        Args:
+            module_class (type): class of the module.
+            factory (callable, optional): function creating the module
+                from module_kwargs in the child process, module_class is
+                used if None. Defaults to None.
+            log_folder (str, optional): log folder given to
+                log_utils.configurate_logger in the child process, before
+                creating the module, None to not configure the loggers
+                (e.g. if the factory does). Defaults to None.
+            log_filters (list, optional): filters of the terminal logger
+                of the child process. Defaults to None.
+            ring_capacity (int, optional): capacity (in bytes) of each of
+                the two shared-memory audio rings. Defaults to 16 MiB.
+            max_ius (int, optional): number of sent and received IUs
+                whose links are kept. Defaults to 10000.
+            max_queued (int, optional): maximum number of UpdateMessages
+                waiting to be sent to the child process. Defaults to 256.
+            send_timeout (float, optional): maximum time (in seconds)
+                process_update waits for a place in the full queue before
+                dropping the UpdateMessage. Defaults to 5.0.
+            shutdown_timeout (float, optional): time (in seconds) the
+                child process waits for the module's threads at shutdown,
+                and the ProcessModule waits for the child process before
+                terminating it. Defaults to 5.0.
+            module_kwargs (dict, optional): parameters of the module (or
+                of the factory), they have to be picklable. Defaults to
+                None.
+        """
+        self.module_class = module_class
+        super().__init__(**kwargs)
+        self.factory = factory
+        self.log_folder = log_folder
+        self.log_filters = log_filters
+        self.module_kwargs = module_kwargs or {}
+        self.ring_capacity = ring_capacity
+        self.max_ius = max_ius
+        self.send_timeout = send_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.n_dropped = 0
+        self.process = None
+        self.connection = None
+        self.channel = None
+        self._send_lock = threading.Lock()
+        self._forwarding = False
+        self._receiving_thread = None
+        self._sending_thread = None
+
+    def add_left_buffer(self, left_buffer):
+        """Adds a left buffer, whose UpdateMessages are queued for the child
+        process as soon as they are put in it."""
+        super().add_left_buffer(left_buffer)
+        left_buffer.put = self._forward
+
+    def _forward(self, update_message, block=True, timeout=None):
+        if self._forwarding:
+            self.process_update(update_message)
+
+    def setup(self):
+        """Starts the child process, and waits for the module to be created
+        and set up."""
+        super().setup()
+        input_ring = SharedAudioRing(self.ring_capacity)
+        output_ring = SharedAudioRing(self.ring_capacity)
+        self.channel = IUChannel(
+            input_ring, output_ring, creator=self, max_ius=self.max_ius
+        )
+        context = multiprocessing.get_context("spawn")
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=_run_module_process,
+            args=(
+                self.module_class,
+                self.factory,
+                self.module_kwargs,
+                self.log_folder,
+                self.log_filters,
+                child_connection,
+                input_ring.name,
+                output_ring.name,
+                self.max_ius,
+                self.shutdown_timeout,
+            ),
+            name=self.name(),
+            daemon=True,
+        )
+        self.process.start()
+        child_connection.close()
+        message = self.connection.recv()
+        if message[0] == "error":
+            self.process.join()
+            self.close_rings()
+            raise RuntimeError(f"{self.name()} setup failed :\n{message[1]}")
+        self.terminal_logger.info("process_module_ready", pid=self.process.pid)
+
+    def prepare_run(self):
+        """Runs the module in the child process, and starts sending it the
+        queued UpdateMessages and receiving its UpdateMessages."""
+        super().prepare_run()
+        self._receiving_thread = threading.Thread(target=self._receive_thread)
+        self._receiving_thread.start()
+        self._sending_thread = threading.Thread(target=self._send_thread)
+        self._sending_thread.start()
+        with self._send_lock:
+            self.connection.send(("run",))
+        self._forwarding = True
+
+    def process_update(self, update_message):
+        """Queues the UpdateMessage for the module in the child process
+        (blocking while the queue is full, for at most send_timeout seconds,
+        the UpdateMessage being dropped after that)."""
+        try:
+            self.queue.put(update_message, timeout=self.send_timeout)
+        except queue.Full:
+            self.n_dropped += 1
+            self.terminal_logger.warning(
+                "process_module_queue_full", n_dropped=self.n_dropped
+            )
+        return None
+
+    def _send_thread(self):
+        """Encodes and sends the queued UpdateMessages to the child process,
+        until None is queued."""
+        while True:
+            update_message = self.queue.get()
+            if update_message is None:
+                return
+            try:
+                with self._send_lock:
+                    entries = self.channel.encode(update_message)
+                    if entries:
+                        self.connection.send(("update", entries))
+            except Exception as e:
+                log_utils.log_exception(module=self, exception=e)
+
+    def _stop_sending(self):
+        """Sends the queued UpdateMessages and stops the sending thread,
+        dropping the UpdateMessages still queued after shutdown_timeout
+        seconds."""
+        try:
+            self.queue.put(None, timeout=self.shutdown_timeout)
+            self._sending_thread.join(self.shutdown_timeout)
+        except queue.Full:
+            pass
+        if self._sending_thread.is_alive():
+            self.terminal_logger.warning(
+                "process_module_dropped_updates", n_queued=self.queue.qsize()
+            )
+            # stops the wait for space in the ring, and empties the queue
+            self.channel.send_ring.closed = True
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            self.queue.put(None)
+            self._sending_thread.join()
+
+    def _receive_thread(self):
+        """Appends the UpdateMessages received from the child process, and
+        logs its module's log events, until it is stopped."""
+        while True:
+            try:
+                message = self.connection.recv()
+                if message[0] == "stopped":
+                    if message[1]:
+                        self.terminal_logger.warning(
+                            "process_module_stuck_threads", threads=message[1]
+                        )
+                    return
+                if message[0] == "log":
+                    _, level, event, fields = message
+                    getattr(self.file_logger, level)(event, **fields)
+                else:
+                    self.append(self.channel.decode(message[1]))
+            except (EOFError, OSError):
+                return
+            except Exception as e:
+                log_utils.log_exception(module=self, exception=e)
+
+    def close_rings(self):
+        """Frees the shared-memory audio rings."""
+        self.channel.send_ring.close()
+        self.channel.receive_ring.close()
+
+    def shutdown(self):
+        """Stops the module in the child process, and waits for the process
+        to end."""
+        super().shutdown()
+        self._forwarding = False
+        self._stop_sending()
+        self.channel.send_ring.closed = True
+        with self._send_lock:
+            self.connection.send(("stop",))
+        # the child process waits shutdown_timeout seconds for its threads
+        self.process.join(2 * self.shutdown_timeout)
+        if self.process.is_alive():
+            self.terminal_logger.warning(
+                "process_module_terminated", pid=self.process.pid
+            )
+            self.process.terminate()
+            self.process.join()
+        self._receiving_thread.join()
+        self.connection.close()
+        self.close_rings()
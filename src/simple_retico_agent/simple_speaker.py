@@ -11,12 +11,35 @@ calculated from latest_processed_iu and IU's final attribute). These
 agent BOT and EOT information could be received by a Voice Activity
 Dectection (VAD) or a Dialogue Manager (DM) Modules.
 
+The module also publishes a PlaybackClock, updated with every buffer
+handed to the audio output, that other modules (e.g. the VAD) can read
+directly to know the agent's voice activity from the actual playback
+timeline, without waiting for the agent BOT and EOT TextIUs.
+
+The received audio is written into a preallocated PCMRingBuffer, from
+which the audio callback reads exactly the number of frames asked by the
+audio output, so that the size of the callback buffers does not depend
+on the size of the received AudioFinalIUs. The agent BOT and EOT are
+kept as markers on the buffer's positions. The playback of an agent turn
+starts once a jitter target of audio is buffered (or once the whole turn
+is buffered), and starts again the same way after an underrun.
+
+The module measures the inter-clause gaps, i.e. the silences played in
+the middle of an agent turn because the audio of the next clause was
+not synthesized yet, and counts the buffer underruns.
+
+The callback runs in the real-time audio thread : its per-callback log
+events are recorded in an EventRecorder, and logged by a background
+thread (optionally aggregated).
+
 Inputs : AudioFinalIU
 
 Outputs : TextIU
 """
 
+import collections
 import platform
+import numpy as np
 import pyaudio
 
 import retico_core
@@ -25,6 +48,8 @@ from retico_core import text
 # import simple_retico_agent
 
 from simple_retico_agent.additional_IUs import AudioFinalIU
+from simple_retico_agent.audio_processing import PCMRingBuffer, PlaybackClock
+from simple_retico_agent.event_recorder import EventRecorder
 
 
 class SimpleSpeakerModule(retico_core.AbstractModule):
@@ -68,6 +93,11 @@ class SimpleSpeakerModule(retico_core.AbstractModule):
         sample_width=2,
         use_speaker="both",
         device_index=None,
+        playback_clock=None,
+        jitter_target=0.06,
+        buffer_duration=30.0,
+        event_flush_interval=0.02,
+        aggregate_events=False,
         **kwargs,
     ):
         """Initializes the SimpleSpeakerModule.
@@ -82,6 +112,22 @@ class SimpleSpeakerModule(retico_core.AbstractModule):
             use_speaker (string): wether the audio should be played in
                 the right, left or both speakers.
             device_index (string): PortAudio's default device.
+            playback_clock (PlaybackClock, optional): clock updated with
+                the played audio, a new one is created if None. Defaults
+                to None.
+            jitter_target (float, optional): duration (in seconds) of
+                audio buffered before the playback of an agent turn
+                starts (or starts again after an underrun). Defaults to
+                0.06.
+            buffer_duration (float, optional): capacity (in seconds) of
+                the PCM ring buffer. Defaults to 30.0.
+            event_flush_interval (float, optional): time (in seconds)
+                between two flushes of the events recorded in the audio
+                callback to the file logger. Defaults to 0.02.
+            aggregate_events (bool, optional): if True, the
+                output_audio and output_silence events are logged once
+                per flush, with their number of occurrences and their
+                times, instead of one by one. Defaults to False.
         """
         super().__init__(**kwargs)
         self.rate = rate
@@ -89,23 +135,81 @@ class SimpleSpeakerModule(retico_core.AbstractModule):
         self.use_speaker = use_speaker
         self.channels = channels
         self.frame_length = frame_length
-        self._p = pyaudio.PyAudio()
-        if device_index is None:
-            device_index = self._p.get_default_output_device_info()["index"]
+        self._p = None
         self.device_index = device_index
         self.stream = None
-        self.audio_iu_buffer = []
+        self.frame_size = channels * sample_width
+        self.ring_buffer = PCMRingBuffer(
+            int(buffer_duration * rate) * self.frame_size
+        )
+        self.jitter_target_bytes = int(jitter_target * rate) * self.frame_size
+        # (position, "agent_BOT" or "agent_EOT", iu), appended by process_update
+        # and popped by the callback
+        self.markers = collections.deque()
+        self.turn_written = False
+        self.n_eot_written = 0
+        self.n_eot_played = 0
+        self.playing = False
+        self.n_underruns = 0
         self.latest_processed_iu = None
+        self.playback_clock = (
+            playback_clock if playback_clock is not None else PlaybackClock(rate)
+        )
+        self.current_gap = 0.0
+        self.inter_clause_gaps = []
+        self.event_recorder = EventRecorder(
+            self,
+            flush_interval=event_flush_interval,
+            aggregated_events=(
+                ("output_audio", "output_silence") if aggregate_events else ()
+            ),
+        )
 
     def process_update(self, update_message):
-        """Process the received ADD AudioFinalIU by storing them in
-        self.audio_iu_buffer."""
+        """Process the received ADD AudioFinalIU by writing their audio in the
+        ring buffer, and the agent BOT and EOT as markers on the buffer."""
         for iu, ut in update_message:
             if isinstance(iu, AudioFinalIU):
                 if ut == retico_core.UpdateType.ADD:
-                    self.audio_iu_buffer.append(iu)
+                    position = self.ring_buffer.write_position
+                    # the last IU of an agent turn only carries the agent EOT
+                    if hasattr(iu, "final") and iu.final:
+                        self.markers.append((position, "agent_EOT", iu))
+                        self.n_eot_written += 1
+                        self.turn_written = False
+                        continue
+                    if not self.turn_written:
+                        self.markers.append((position, "agent_BOT", iu))
+                        self.turn_written = True
+                    self.ring_buffer.write(iu.raw_audio)
         return None
 
+    def is_primed(self):
+        """Returns True if enough audio is buffered to start (or start again)
+        the playback of the current agent turn : the jitter target, or the
+        whole turn.
+
+        Returns:
+            bool: True if the playback can start.
+        """
+        return (
+            self.ring_buffer.available() >= self.jitter_target_bytes
+            or self.n_eot_written > self.n_eot_played
+        )
+
+    def send_turn_event(self, event, iu):
+        """Logs an agent BOT or EOT and outputs it as a TextIU.
+
+        Args:
+            event (str): "agent_BOT" or "agent_EOT".
+            iu (AudioFinalIU): the IU the event is grounded in.
+        """
+        self.terminal_logger.info(event)
+        self.file_logger.info("EOT" if event == "agent_EOT" else event)
+        output_iu = self.create_iu(grounded_in=iu, text=event)
+        um = retico_core.UpdateMessage.from_iu(output_iu, retico_core.UpdateType.ADD)
+        self.append(um)
+
     def callback(self, in_data, frame_count, time_info, status):
         """Callback function given to the pyaudio stream that will output audio
         to the computer speakers. This function returns an audio chunk that
@@ -124,52 +228,89 @@ class SimpleSpeakerModule(retico_core.AbstractModule):
                 (bytes) and the pyaudio type informing wether the stream
                 should continue or stop.
         """
-        if len(self.audio_iu_buffer) == 0:
-            self.terminal_logger.info("output_silence")
-            self.file_logger.info("output_silence")
-            silence_bytes = b"\x00" * frame_count * self.channels * self.sample_width
-            return (silence_bytes, pyaudio.paContinue)
-
-        iu = self.audio_iu_buffer.pop(0)
-        # if it is the last IU from TTS for this agent turn, which corresponds to an agent EOT.
-        if hasattr(iu, "final") and iu.final:
-            self.terminal_logger.info("agent_EOT")
-            self.file_logger.info("EOT")
-            output_iu = self.create_iu(grounded_in=iu, text="agent_EOT")
-            self.latest_processed_iu = None
-            um = retico_core.UpdateMessage.from_iu(
-                output_iu, retico_core.UpdateType.ADD
-            )
-            self.append(um)
-
-            self.terminal_logger.info("output_silence")
-            self.file_logger.info("output_silence")
-            silence_bytes = b"\x00" * frame_count * self.channels * self.sample_width
-            return (silence_bytes, pyaudio.paContinue)
-
-        # if it is the first IU from new agent turn, which corresponds to the official agent BOT
-        if self.latest_processed_iu is None:
-            self.terminal_logger.info("agent_BOT")
-            self.file_logger.info("agent_BOT")
-            output_iu = self.create_iu(
-                grounded_in=iu,
-                text="agent_BOT",
-            )
-            um = retico_core.UpdateMessage.from_iu(
-                output_iu, retico_core.UpdateType.ADD
-            )
-            self.append(um)
+        output_latency = 0.0
+        if time_info:
+            output_latency = time_info.get(
+                "output_buffer_dac_time", 0.0
+            ) - time_info.get("current_time", 0.0)
 
-        self.terminal_logger.info("output_audio")
-        self.file_logger.info("output_audio")
-        data = bytes(iu.raw_audio)
-        self.latest_processed_iu = iu
-        return (data, pyaudio.paContinue)
+        out = bytearray(frame_count * self.frame_size)
+        view = memoryview(out)
+        filled = 0
+        while filled < len(out):
+            if len(self.markers) != 0:
+                position, event, iu = self.markers[0]
+                if position <= self.ring_buffer.read_position:
+                    if event == "agent_EOT":
+                        self.send_turn_event(event, iu)
+                        self.n_eot_played += 1
+                        self.latest_processed_iu = None
+                        self.current_gap = 0.0
+                        self.playing = False
+                    elif self.is_primed():
+                        # the official agent BOT, when its audio is played
+                        self.send_turn_event(event, iu)
+                        self.latest_processed_iu = iu
+                        self.playing = True
+                    else:
+                        break
+                    self.markers.popleft()
+                    continue
+                limit = min(
+                    len(out), filled + position - self.ring_buffer.read_position
+                )
+            else:
+                limit = len(out)
+            if self.latest_processed_iu is None:
+                break
+            if not self.playing:
+                if not self.is_primed():
+                    break
+                self.playing = True
+            n = self.ring_buffer.read_into(view[filled:limit])
+            filled += n
+            if n == 0:
+                # underrun in the middle of an agent turn
+                self.n_underruns += 1
+                self.playing = False
+                break
+
+        n_audio = filled // self.frame_size
+        n_silence = frame_count - n_audio
+        if n_audio != 0:
+            if self.current_gap > 0:
+                self.event_recorder.record(
+                    "inter_clause_gap", duration=self.current_gap
+                )
+                self.inter_clause_gaps.append(self.current_gap)
+                self.current_gap = 0.0
+            self.playback_clock.push(n_audio, True, output_latency)
+            self.event_recorder.record("output_audio")
+        if n_silence != 0:
+            if self.latest_processed_iu is not None:
+                # silence in the middle of an agent turn
+                self.current_gap += n_silence / self.rate
+            self.playback_clock.push(
+                n_silence,
+                False,
+                output_latency + n_audio / self.rate if output_latency > 0 else 0.0,
+            )
+            if n_audio == 0:
+                self.event_recorder.record("output_silence")
+        return (bytes(out), pyaudio.paContinue)
 
     def prepare_run(self):
         """Open the stream to enable sound outputting through speakers."""
         super().prepare_run()
-        p = self._p
+        self.event_recorder.start()
+        self.open_stream()
+
+    def open_stream(self):
+        """Open the PortAudio output stream, calling self.callback every time
+        it needs a new buffer."""
+        self._p = p = pyaudio.PyAudio()
+        if self.device_index is None:
+            self.device_index = p.get_default_output_device_info()["index"]
 
         if platform.system() == "Darwin":
             if self.use_speaker == "left":
@@ -198,8 +339,24 @@ class SimpleSpeakerModule(retico_core.AbstractModule):
         self.stream.start_stream()
 
     def shutdown(self):
-        """Close the audio stream."""
+        """Close the audio stream, and logs the inter-clause gaps and underruns
+        statistics."""
         super().shutdown()
+        self.ring_buffer.close()
+        self.close_stream()
+        self.event_recorder.stop()
+        if len(self.inter_clause_gaps) != 0:
+            self.terminal_logger.info(
+                "inter_clause_gap_stats",
+                n=len(self.inter_clause_gaps),
+                mean=float(np.mean(self.inter_clause_gaps)),
+                p95=float(np.percentile(self.inter_clause_gaps, 95)),
+                total=float(np.sum(self.inter_clause_gaps)),
+            )
+        self.terminal_logger.info("playback_underruns", n=self.n_underruns)
+
+    def close_stream(self):
+        """Close the PortAudio output stream."""
         self.stream.stop_stream()
         self.stream.close()
         self.stream = None
@@ -10,6 +10,37 @@ corresponding to all IUs contained in UpdateMessage (the complete
 clause). The module only sends TextFinalIU with a fixed raw_audio
 length.
 
+In streaming mode, the AudioFinalIUs are sent as soon as their audio is
+synthesized, before the synthesis of the whole clause is over : with
+XTTS models, the audio chunks are generated with inference_stream, and
+with VITS models, the latent representation of the whole clause is
+computed first, then decoded into audio by the waveform decoder chunk by
+chunk (with a few frames of context on each side to limit the artefacts
+at the chunk boundaries). The models supporting neither are refused in
+setup.
+
+The synthesized clauses can be cached (cf. TTSPhraseCache), in memory
+and on disk : the clauses already synthesized are then sent immediately,
+without calling the TTS model.
+
+The clauses are queued and synthesized by a pool of n_workers worker
+threads (each with its own replica of the model by default), so that
+the synthesis of the next clauses can start before the current one is
+over. Each model has a lock held during its forward passes, so that the
+workers sharing a model (worker_replicas=False) take turns using it.
+The synthesized audio is reassembled in the clauses order before being
+sent (the audio of the clause currently played being streamed
+directly).
+
+When several clauses are queued, VITS models can synthesize them in a
+single batched forward pass (cf. batch_max_tokens). The first clause of
+each agent turn is always synthesized alone, to keep the time-to-first-
+audio low.
+
+A ClausePacker can also be given to adapt the committed clauses to a
+target synthesis duration per call, merging the tiny fragments and
+splitting the over-long clauses, before they are queued.
+
 This modules uses the deep learning approach implemented with coqui-ai's
 TTS library : https://github.com/coqui-ai/TTS
 
@@ -18,15 +49,40 @@ Inputs : TextFinalIU
 Outputs : AudioFinalIU
 """
 
+import collections
 import threading
 import time
 import numpy as np
+import torch
 from TTS import api
+from TTS.tts.utils.synthesis import trim_silence
 
 import retico_core
 from retico_core import log_utils
 from simple_retico_agent.utils import device_definition
 from simple_retico_agent.additional_IUs import TextFinalIU, AudioFinalIU
+from simple_retico_agent.audio_processing import split_chunks, to_int16_chunks
+from simple_retico_agent.tts_cache import TTSPhraseCache
+from simple_retico_agent.tts_optimization import OPTIMIZATION_MODES, optimize_tts_model
+
+
+class VITSLatentCapture(torch.nn.Module):
+    """Module temporarily replacing the waveform decoder of a VITS model, to
+    capture its input latent representation (and speaker conditioning)
+    instead of decoding the whole audio at once."""
+
+    def __init__(self, hop_length):
+        super().__init__()
+        self.hop_length = hop_length
+        self.z = None
+        self.g = None
+
+    def forward(self, z, g=None):
+        self.z = z
+        self.g = g
+        return torch.zeros(
+            (z.shape[0], 1, z.shape[-1] * self.hop_length), device=z.device
+        )
 
 
 class SimpleTTSModule(retico_core.AbstractModule):
@@ -85,6 +141,23 @@ class SimpleTTSModule(retico_core.AbstractModule):
         frame_duration=0.2,
         verbose=False,
         device=None,
+        streaming=False,
+        stream_language="en",
+        stream_chunk_size=20,
+        first_chunk_frames=16,
+        chunk_frames=64,
+        context_frames=8,
+        cache_max_bytes=0,
+        cache_dir=None,
+        prewarm_phrases=None,
+        n_workers=1,
+        worker_replicas=True,
+        batch_max_tokens=0,
+        batch_max_clauses=8,
+        clause_packer=None,
+        optimization=None,
+        optimization_cache_dir=None,
+        warmup_text=None,
         **kwargs,
     ):
         """Initializes the SimpleTTSModule.
@@ -102,6 +175,57 @@ class SimpleTTSModule(retico_core.AbstractModule):
                 model. Defaults to False.
             device (string, optional): the device the module will run on
                 (cuda for gpu, or cpu)
+            streaming (bool, optional): if True, the AudioFinalIUs are
+                sent as soon as their audio is synthesized, instead of
+                once the whole clause is synthesized. Defaults to False.
+            stream_language (str, optional): language of the XTTS
+                streaming synthesis. Defaults to "en".
+            stream_chunk_size (int, optional): number of GPT tokens per
+                chunk of the XTTS streaming synthesis. Defaults to 20.
+            first_chunk_frames (int, optional): number of latent frames
+                in the first decoded chunk of the VITS streaming
+                synthesis, smaller than the next ones to reduce the
+                time-to-first-audio. Defaults to 16.
+            chunk_frames (int, optional): number of latent frames in the
+                next decoded chunks of the VITS streaming synthesis.
+                Defaults to 64.
+            context_frames (int, optional): number of latent frames
+                decoded on each side of a VITS chunk as context.
+                Defaults to 8.
+            cache_max_bytes (int, optional): byte budget of the
+                in-memory synthesis cache, the cache is disabled if it
+                is 0 and cache_dir is None. Defaults to 0.
+            cache_dir (str, optional): directory of the on-disk
+                synthesis cache, None disables it. Defaults to None.
+            prewarm_phrases (list[str], optional): clauses synthesized
+                and cached during setup. Defaults to None.
+            n_workers (int, optional): number of worker threads
+                synthesizing the queued clauses concurrently. Defaults
+                to 1.
+            worker_replicas (bool, optional): if True, each worker loads
+                its own replica of the model, otherwise the workers
+                share the module's model. Defaults to True.
+            batch_max_tokens (int, optional): maximum number of tokens
+                (approximated by the number of characters, padding
+                included) of a batch of queued clauses synthesized in
+                a single forward pass, 0 disables the batching. Only
+                used with single-speaker VITS models. Defaults to 0.
+            batch_max_clauses (int, optional): maximum number of
+                clauses in a batch. Defaults to 8.
+            clause_packer (ClausePacker, optional): packing stage
+                merging and splitting the committed clauses, None
+                disables the packing. Defaults to None.
+            optimization (str, optional): optimized CPU inference mode
+                ("int8", "compile" or "torchscript", cf.
+                tts_optimization), None uses the eager fp32 model.
+                Defaults to None.
+            optimization_cache_dir (str, optional): directory of the
+                cached optimized models. Defaults to None.
+            warmup_text (str, optional): text synthesized by every model
+                during setup, so that the first clause does not pay the
+                lazy initializations (and compilation, worth it with an
+                optimization mode). None disables the warm-up. Defaults
+                to None.
         """
         super().__init__(**kwargs)
 
@@ -132,6 +256,49 @@ class SimpleTTSModule(retico_core.AbstractModule):
         self.samplewidth = 2
         self.chunk_size = None
         self.chunk_size_bytes = None
+        self.hop_length = None
+
+        # optimization
+        if optimization is not None and optimization not in OPTIMIZATION_MODES:
+            raise ValueError(f"unknown optimization mode : {optimization}")
+        self.optimization = optimization
+        self.optimization_cache_dir = optimization_cache_dir
+        self.warmup_text = warmup_text
+
+        # streaming
+        self.streaming = streaming
+        self.stream_language = stream_language
+        self.stream_chunk_size = stream_chunk_size
+        self.first_chunk_frames = first_chunk_frames
+        self.chunk_frames = chunk_frames
+        self.context_frames = context_frames
+        self.gpt_cond_latent = None
+        self.speaker_embedding = None
+
+        # cache
+        self.cache = None
+        if cache_max_bytes > 0 or cache_dir is not None:
+            self.cache = TTSPhraseCache(max_bytes=cache_max_bytes, cache_dir=cache_dir)
+        self.prewarm_phrases = prewarm_phrases or []
+
+        # workers
+        self.n_workers = n_workers
+        self.worker_replicas = worker_replicas
+        self.batch_max_tokens = batch_max_tokens
+        self.batch_max_clauses = batch_max_clauses
+        self._previous_clause_final = True
+        self.clause_packer = clause_packer
+        self.worker_models = []
+        self._model_locks = {}
+        self._worker = threading.local()
+        self.clause_queue = collections.deque()
+        self._queue_lock = threading.Lock()
+        self._next_queued_seq = 0
+        # ordered reassembly of the clauses synthesized concurrently
+        self._order_lock = threading.RLock()
+        self._pending_outputs = {}
+        self._completed_seqs = set()
+        self._next_sent_seq = 0
 
         # general
         self.verbose = verbose
@@ -146,21 +313,23 @@ class SimpleTTSModule(retico_core.AbstractModule):
 
     def synthesize(self, text):
         """Takes the given text and synthesizes speech using the TTS model.
-        Returns the synthesized speech as 22050 Hz int16-encoded numpy ndarray.
+        Returns the synthesized speech as an int16-encoded numpy ndarray,
+        padded with silence to a whole number of chunks.
 
         Args:
             text (str): The text to use to synthesize speech.
 
         Returns:
-            bytes: The speech as a 22050 Hz int16-encoded numpy ndarray.
+            np.ndarray: The speech as an int16-encoded numpy ndarray.
         """
 
-        final_outputs = self.model.tts(
-            text=text,
-            return_extra_outputs=True,
-            split_sentences=False,
-            verbose=self.verbose,
-        )
+        with self.get_model_lock():
+            final_outputs = self.get_model().tts(
+                text=text,
+                return_extra_outputs=True,
+                split_sentences=False,
+                verbose=self.verbose,
+            )
 
         # if self.is_multilingual:
         #     # if "multilingual" in file or "vctk" in file:
@@ -181,14 +350,103 @@ class SimpleTTSModule(retico_core.AbstractModule):
         else:
             waveforms, outputs = final_outputs
 
-        # waveform = waveforms.squeeze(1).detach().numpy()[0]
-        waveform = np.array(waveforms)
-
-        # Convert float32 data [-1,1] to int16 data [-32767,32767]
-        waveform = (waveform * 32767).astype(np.int16).tobytes()
+        # Convert float32 data [-1,1] to int16 data [-32767,32767], once, from
+        # the outputs' numpy waveforms rather than the waveforms list of floats
+        waveform = to_int16_chunks(
+            np.concatenate([np.asarray(o["wav"]).reshape(-1) for o in outputs]),
+            self.chunk_size,
+        )
 
         return waveform, outputs
 
+    def synthesize_stream(self, text):
+        """Takes the given text and synthesizes speech chunk by chunk, using
+        XTTS's inference_stream or VITS's waveform decoder on chunks of the
+        latent representation (setup checks that the model supports one
+        of them).
+
+        Args:
+            text (str): The text to use to synthesize speech.
+
+        Yields:
+            np.ndarray: the successive float32 audio chunks.
+        """
+        tts_model = self.get_model().synthesizer.tts_model
+        if hasattr(tts_model, "inference_stream"):
+            with self.get_model_lock(), torch.no_grad():
+                for chunk in tts_model.inference_stream(
+                    text,
+                    self.stream_language,
+                    self.gpt_cond_latent,
+                    self.speaker_embedding,
+                    stream_chunk_size=self.stream_chunk_size,
+                    enable_text_splitting=False,
+                ):
+                    yield chunk.cpu().numpy().reshape(-1)
+        else:
+            z, g = self.get_vits_latents(text)
+            yield from self.decode_vits_latents(z, g)
+
+    def get_vits_latents(self, text):
+        """Runs the VITS model on the given text, with its waveform decoder
+        replaced by a VITSLatentCapture, to get the latent representation of
+        the whole text without decoding it. The model's lock is held during
+        the replacement, so that no other worker uses the VITSLatentCapture.
+
+        Args:
+            text (str): The text to use to synthesize speech.
+
+        Returns:
+            (torch.Tensor, torch.Tensor): the latent representation and
+                the speaker conditioning (or None).
+        """
+        model = self.get_model()
+        tts_model = model.synthesizer.tts_model
+        capture = VITSLatentCapture(self.hop_length)
+        with self.get_model_lock():
+            waveform_decoder = tts_model.waveform_decoder
+            tts_model.waveform_decoder = capture
+            try:
+                model.tts(text=text, split_sentences=False, verbose=self.verbose)
+            finally:
+                tts_model.waveform_decoder = waveform_decoder
+        return capture.z, capture.g
+
+    def decode_vits_latents(self, z, g):
+        """Decodes the latent representation chunk by chunk with the VITS
+        waveform decoder. Each chunk is decoded with context_frames frames
+        of context on each side, then cropped, to limit the discontinuities
+        at the chunk boundaries. The decoder's receptive field can be wider
+        than the context, so the concatenated chunks are close to, but not
+        guaranteed to be identical to, the audio decoded at once.
+
+        Args:
+            z (torch.Tensor): the latent representation.
+            g (torch.Tensor): the speaker conditioning, or None.
+
+        Yields:
+            np.ndarray: the successive float32 audio chunks.
+        """
+        tts_model = self.get_model().synthesizer.tts_model
+        n_frames = z.shape[-1]
+        start = 0
+        chunk_frames = self.first_chunk_frames
+        with torch.no_grad():
+            while start < n_frames:
+                end = min(start + chunk_frames, n_frames)
+                left = max(0, start - self.context_frames)
+                right = min(n_frames, end + self.context_frames)
+                with self.get_model_lock():
+                    wav = tts_model.waveform_decoder(z[:, :, left:right], g=g)
+                wav = wav[
+                    0,
+                    0,
+                    (start - left) * self.hop_length : (end - left) * self.hop_length,
+                ]
+                yield wav.cpu().numpy()
+                start = end
+                chunk_frames = self.chunk_frames
+
     def one_clause_text_and_words(self, clause_ius):
         """Convert received IUs data accumulated in current_input list into a
         string.
@@ -199,9 +457,36 @@ class SimpleTTSModule(retico_core.AbstractModule):
         words = [iu.text for iu in clause_ius]
         return "".join(words), words
 
+    def get_model(self):
+        """Returns the TTS model of the current worker thread (its own replica
+        if the workers have one), or the module's model.
+
+        Returns:
+            api.TTS: the TTS model.
+        """
+        return getattr(self._worker, "model", self.model)
+
+    def get_model_lock(self):
+        """Returns the lock of the current worker thread's TTS model, to hold
+        during its forward passes.
+
+        Returns:
+            threading.Lock: the lock.
+        """
+        return self._model_locks[id(self.get_model())]
+
+    def backlog_depth(self):
+        """Returns the number of clauses waiting to be synthesized.
+
+        Returns:
+            int: the backlog depth.
+        """
+        return len(self.clause_queue)
+
     def process_update(self, update_message):
         """Process the COMMIT TextFinalIUs received by appending to
-        self.current_input the list of IUs corresponding to the full clause."""
+        self.clause_queue the list of IUs corresponding to the full clause,
+        with its sequence number."""
         if not update_message:
             return None
 
@@ -215,96 +500,530 @@ class SimpleTTSModule(retico_core.AbstractModule):
                 elif ut == retico_core.UpdateType.COMMIT:
                     clause_ius.append(iu)
         if len(clause_ius) != 0:
-            self.current_input.append(clause_ius)
+            with self._queue_lock:
+                if self.clause_packer is None:
+                    self.enqueue_clause(clause_ius)
+                else:
+                    for unit in self.clause_packer.add(clause_ius):
+                        self.enqueue_clause(unit)
 
-    def _process_one_clause(self):
+    def enqueue_clause(self, clause_ius):
+        """Appends a clause (or a packed unit) to the queue, with its
+        sequence number. Has to be called with self._queue_lock.
+
+        Args:
+            clause_ius (list[TextFinalIU]): the IUs of the clause.
+        """
+        self.clause_queue.append((self._next_queued_seq, clause_ius))
+        self._next_queued_seq += 1
+        if self.clause_packer is not None:
+            self.file_logger.info(
+                "tts_packed_unit",
+                seq=self._next_queued_seq - 1,
+                source_iuids=[iu.iuid for iu in clause_ius],
+            )
+        self.file_logger.info("tts_backlog", depth=len(self.clause_queue))
+
+    def _tts_worker(self, model):
+        """Function that runs on each worker Thread.
+
+        Pops the next clause of the queue and synthesizes it, the
+        workers synthesizing the queued clauses concurrently.
+
+        Args:
+            model (api.TTS): the TTS model of the worker.
+        """
+        self._worker.model = model
         while self._tts_thread_active:
             try:
-                time.sleep(0.02)
-                if len(self.current_input) != 0:
-                    clause_ius = self.current_input.pop(0)
-                    end_of_turn = clause_ius[-1].final
-                    um = retico_core.UpdateMessage()
-                    if end_of_turn:
-                        self.terminal_logger.info("EOT TTS")
-                        self.file_logger.info("EOT")
-                        self.first_clause = True
-                        um.add_iu(
-                            self.create_iu(grounded_in=clause_ius[-1], final=True),
-                            retico_core.UpdateType.ADD,
-                        )
+                with self._queue_lock:
+                    clauses = self.pop_clauses()
+                if len(clauses) == 0:
+                    time.sleep(0.02)
+                    continue
+                try:
+                    if len(clauses) == 1:
+                        self.process_clause(*clauses[0])
                     else:
-                        self.terminal_logger.info("EOC TTS")
-                        if self.first_clause:
-                            self.terminal_logger.info("start_answer_generation")
-                            self.file_logger.info("start_answer_generation")
-                            self.first_clause = False
-                        output_ius = self.get_new_iu_buffer_from_clause_ius(clause_ius)
-                        um.add_ius(
-                            [(iu, retico_core.UpdateType.ADD) for iu in output_ius]
-                        )
-                        self.file_logger.info("send_clause")
-                    self.append(um)
+                        self.process_clause_batch(clauses)
+                finally:
+                    for seq, _ in clauses:
+                        self.complete_clause(seq)
             except Exception as e:
                 log_utils.log_exception(module=self, exception=e)
 
-    def get_new_iu_buffer_from_clause_ius(self, clause_ius):
-        """Function that take all TextFinalIUs from one clause, synthesizes the
-        corresponding speech and split the audio into AudioFinalIUs of a fixed
-        raw_audio length.
+    def pop_clauses(self):
+        """Pops the next clause of the queue, and if batching is enabled,
+        the following clauses that fit in the batch token budget. The first
+        clause of an agent turn, and the agent EOT, are never batched. The
+        unit held by the clause packer is queued first if it is ready. Has
+        to be called with self._queue_lock.
+
+        Returns:
+            list[tuple[int, list[TextFinalIU]]]: the sequence numbers and
+                IUs of the popped clauses.
+        """
+        if self.clause_packer is not None:
+            for unit in self.clause_packer.poll(len(self.clause_queue)):
+                self.enqueue_clause(unit)
+        if len(self.clause_queue) == 0:
+            return []
+        seq, clause_ius = self.clause_queue.popleft()
+        clauses = [(seq, clause_ius)]
+        first_of_turn = self._previous_clause_final
+        self._previous_clause_final = clause_ius[-1].final
+        if (
+            self.batch_max_tokens <= 0
+            or first_of_turn
+            or clause_ius[-1].final
+            or not self.is_batch_capable()
+        ):
+            return clauses
+
+        max_length = len(self.one_clause_text_and_words(clause_ius)[0])
+        while (
+            len(self.clause_queue) != 0
+            and len(clauses) < self.batch_max_clauses
+            and not self.clause_queue[0][1][-1].final
+        ):
+            length = len(self.one_clause_text_and_words(self.clause_queue[0][1])[0])
+            if max(max_length, length) * (len(clauses) + 1) > self.batch_max_tokens:
+                break
+            max_length = max(max_length, length)
+            clauses.append(self.clause_queue.popleft())
+        return clauses
+
+    def is_batch_capable(self):
+        """Returns True if the model can synthesize batches of clauses, i.e.
+        if it is a single-speaker VITS model.
+
+        Returns:
+            bool: True if the model is batch-capable.
+        """
+        tts_model = self.model.synthesizer.tts_model
+        return (
+            hasattr(tts_model, "waveform_decoder")
+            and getattr(tts_model, "num_speakers", 0) <= 1
+            and getattr(tts_model, "language_manager", None) is None
+        )
+
+    def postprocess_waveform(self, waveform):
+        """Applies to a waveform output by the TTS model the post-processing
+        of coqui's Synthesizer.tts (the silence trimming, if the model's
+        audio config enables it), for the waveforms synthesized without it.
+
+        Args:
+            waveform (np.ndarray): the float32 waveform.
+
+        Returns:
+            np.ndarray: the post-processed waveform.
+        """
+        synthesizer = self.get_model().synthesizer
+        if synthesizer.tts_config.get("audio").get("do_trim_silence", False):
+            waveform = trim_silence(waveform, synthesizer.tts_model.ap)
+        return waveform
+
+    def synthesize_batch(self, texts):
+        """Synthesizes several texts in a single batched forward pass of the
+        VITS model, and splits the batch waveform back per text, each one
+        post-processed as in the unbatched synthesis.
+
+        Args:
+            texts (list[str]): the texts to use to synthesize speech.
+
+        Returns:
+            (list[np.ndarray], list[int]): the int16-encoded speech of each
+                text, padded with silence to a whole number of chunks, and
+                the number of synthesized samples of each text (without
+                the padding).
+        """
+        tts_model = self.get_model().synthesizer.tts_model
+        ids = [tts_model.tokenizer.text_to_ids(text) for text in texts]
+        x_lengths = torch.tensor([len(i) for i in ids], dtype=torch.long)
+        x = torch.zeros((len(ids), int(x_lengths.max())), dtype=torch.long)
+        for i, text_ids in enumerate(ids):
+            x[i, : len(text_ids)] = torch.tensor(text_ids, dtype=torch.long)
+        device = next(tts_model.parameters()).device
+        with self.get_model_lock(), torch.no_grad():
+            outputs = tts_model.inference(
+                x.to(device), aux_input={"x_lengths": x_lengths.to(device)}
+            )
+        waveforms = outputs["model_outputs"]
+        # number of audio frames of each text, from its latent mask
+        n_frames = outputs["y_mask"].sum(dim=[1, 2]).long().tolist()
+        waveforms = [
+            self.postprocess_waveform(
+                waveforms[i, 0, : n * self.hop_length].cpu().numpy()
+            )
+            for i, n in enumerate(n_frames)
+        ]
+        buffers = [to_int16_chunks(waveform, self.chunk_size) for waveform in waveforms]
+        return buffers, [len(waveform) for waveform in waveforms]
+
+    def process_clause_batch(self, clauses):
+        """Synthesizes a batch of clauses in a single forward pass (the
+        cached clauses are emitted directly), and emits the audio of each
+        clause with its sequence number.
+
+        Args:
+            clauses (list[tuple[int, list[TextFinalIU]]]): the sequence
+                numbers and IUs of the clauses.
+        """
+        to_synthesize = []
+        for seq, clause_ius in clauses:
+            self.terminal_logger.info("EOC TTS")
+            text, _ = self.one_clause_text_and_words(clause_ius)
+            cached_audio = self.get_cached_audio(text)
+            if cached_audio is not None:
+                self.emit(seq, clause_ius, cached_audio)
+            else:
+                to_synthesize.append((seq, clause_ius, text))
+        if len(to_synthesize) == 0:
+            return
+
+        self.file_logger.info("before_synthesize", batch_size=len(to_synthesize))
+        start = time.perf_counter()
+        buffers, n_samples = self.synthesize_batch(
+            [text for _, _, text in to_synthesize]
+        )
+        synthesis_time = time.perf_counter() - start
+        self.file_logger.info("after_synthesize")
+        for (seq, clause_ius, text), buffer, n in zip(
+            to_synthesize, buffers, n_samples
+        ):
+            self.emit(seq, clause_ius, buffer)
+            self.cache_audio(text, buffer, synthesis_time / len(to_synthesize))
+            self.observe_speaking_rate(text, n)
+
+    def process_clause(self, seq, clause_ius):
+        """Synthesizes one clause (or sends the agent EOT if it is the last
+        clause of the turn), emitting its audio with its sequence number.
+
+        Args:
+            seq (int): sequence number of the clause.
+            clause_ius (list[TextFinalIU]): the IUs of the clause.
+        """
+        if clause_ius[-1].final:
+            self.emit(seq, clause_ius, final=True)
+            return
+        if self.streaming:
+            self.stream_clause(seq, clause_ius)
+        else:
+            self.emit(seq, clause_ius, self.get_clause_audio(clause_ius))
+
+    def emit(self, seq, clause_ius, buffer=None, final=False):
+        """Emits the audio (or the agent EOT) of a clause. The clauses being
+        synthesized concurrently, the audio is sent immediately if the clause
+        is the next one to be sent, and kept until the previous clauses are
+        sent otherwise.
+
+        Args:
+            seq (int): sequence number of the clause.
+            clause_ius (list[TextFinalIU]): the IUs of the clause.
+            buffer (np.ndarray, optional): int16 audio of the clause,
+                containing a whole number of chunks. Defaults to None.
+            final (bool, optional): True if it is the agent EOT.
+                Defaults to False.
+        """
+        with self._order_lock:
+            self._pending_outputs.setdefault(seq, []).append(
+                (clause_ius, buffer, final)
+            )
+            self._flush_outputs()
+
+    def complete_clause(self, seq):
+        """Marks a clause as complete, so that the next clauses can be sent.
+
+        Args:
+            seq (int): sequence number of the clause.
+        """
+        with self._order_lock:
+            self._completed_seqs.add(seq)
+            self._flush_outputs()
+
+    def _flush_outputs(self):
+        """Sends, in order, the outputs of the next clauses, until a clause
+        that is not complete yet. Has to be called with self._order_lock."""
+        while True:
+            for clause_ius, buffer, final in self._pending_outputs.pop(
+                self._next_sent_seq, []
+            ):
+                self.send_clause_output(clause_ius, buffer, final)
+            if self._next_sent_seq not in self._completed_seqs:
+                break
+            self._completed_seqs.remove(self._next_sent_seq)
+            self._next_sent_seq += 1
+
+    def send_clause_output(self, clause_ius, buffer, final):
+        """Creates and sends the AudioFinalIUs of a clause's audio, or the
+        final IU of the agent EOT.
+
+        Args:
+            clause_ius (list[TextFinalIU]): the IUs of the clause.
+            buffer (np.ndarray): int16 audio of the clause.
+            final (bool): True if it is the agent EOT.
+        """
+        um = retico_core.UpdateMessage()
+        if final:
+            self.terminal_logger.info("EOT TTS")
+            self.file_logger.info("EOT")
+            self.first_clause = True
+            um.add_iu(
+                self.create_iu(grounded_in=clause_ius[-1], final=True),
+                retico_core.UpdateType.ADD,
+            )
+        else:
+            if self.first_clause:
+                self.terminal_logger.info("start_answer_generation")
+                self.file_logger.info("start_answer_generation")
+                self.first_clause = False
+            um.add_ius(
+                [
+                    (iu, retico_core.UpdateType.ADD)
+                    for iu in self.create_audio_ius(buffer, clause_ius)
+                ]
+            )
+            self.file_logger.info("send_clause")
+        self.append(um)
+
+    def get_clause_audio(self, clause_ius):
+        """Function that take all TextFinalIUs from one clause, and returns
+        the corresponding speech, from the cache or synthesized.
+
+        Args:
+            clause_ius (list[TextFinalIU]): the IUs of the clause.
 
         Returns:
-            list[AudioFinalIU]: the generated AudioFinalIUs, with a
-                fixed raw_audio length, that will be sent to the speaker
-                module.
+            np.ndarray: the int16 audio, containing a whole number of
+                chunks.
         """
         # preprocess on words
         current_text, words = self.one_clause_text_and_words(clause_ius)
+        self.terminal_logger.info("EOC TTS")
+        new_audio = self.get_cached_audio(current_text)
+        if new_audio is None:
+            self.file_logger.info("before_synthesize")
+            start = time.perf_counter()
+            new_audio, outputs = self.synthesize(current_text)
+            self.file_logger.info("after_synthesize")
+            self.cache_audio(current_text, new_audio, time.perf_counter() - start)
+            self.observe_speaking_rate(
+                current_text, sum(np.asarray(o["wav"]).size for o in outputs)
+            )
+        return new_audio
+
+    def stream_clause(self, seq, clause_ius):
+        """Function that take all TextFinalIUs from one clause, synthesizes the
+        corresponding speech chunk by chunk, and emits the audio of fixed
+        raw_audio length as soon as it is synthesized.
+
+        The streamed audio is not post-processed (its silence is not
+        trimmed, as the end of the clause is not known yet), but the cached
+        audio is, and the speaking rate is calibrated on it, once the
+        whole clause is synthesized.
+
+        Args:
+            seq (int): sequence number of the clause.
+            clause_ius (list[TextFinalIU]): the IUs of the clause.
+        """
+        current_text, _ = self.one_clause_text_and_words(clause_ius)
+        self.terminal_logger.info("EOC TTS")
+        cached_audio = self.get_cached_audio(current_text)
+        if cached_audio is not None:
+            self.emit(seq, clause_ius, cached_audio)
+            return
+
         self.file_logger.info("before_synthesize")
-        new_audio, final_outputs = self.synthesize(current_text)
+        start = time.perf_counter()
+        pending = np.zeros(0, dtype=np.float32)
+        wavs = []
+        first_chunk = True
+        for wav in self.synthesize_stream(current_text):
+            if first_chunk:
+                self.file_logger.info("first_chunk_synthesized")
+                first_chunk = False
+            wavs.append(wav)
+            pending = np.concatenate([pending, wav])
+            n_samples = len(pending) // self.chunk_size * self.chunk_size
+            if n_samples != 0:
+                self.emit(
+                    seq,
+                    clause_ius,
+                    to_int16_chunks(pending[:n_samples], self.chunk_size),
+                )
+                pending = pending[n_samples:]
+        if len(pending) != 0:
+            self.emit(seq, clause_ius, to_int16_chunks(pending, self.chunk_size))
         self.file_logger.info("after_synthesize")
-
-        # dispatch audio so that every IU has the same raw audio length
-        new_buffer = []
-        for outputs in final_outputs:
-            i = 0
-            while i < len(outputs["wav"]):
-                chunk = outputs["wav"][i : i + self.chunk_size]
-                # modify raw audio to match correct format
-                chunk = (np.array(chunk) * 32767).astype(np.int16).tobytes()
-                if len(chunk) <= self.chunk_size_bytes:
-                    chunk = chunk + b"\x00" * (self.chunk_size_bytes - len(chunk))
-
-                i += self.chunk_size
-                iu = self.create_iu(
-                    grounded_in=clause_ius[-1],
-                    raw_audio=chunk,
-                    chunk_size=self.chunk_size,
-                    rate=self.samplerate,
-                    sample_width=self.samplewidth,
+        if len(wavs) != 0:
+            waveform = self.postprocess_waveform(np.concatenate(wavs))
+            if self.cache is not None:
+                self.cache_audio(
+                    current_text,
+                    to_int16_chunks(waveform, self.chunk_size),
+                    time.perf_counter() - start,
                 )
-                new_buffer.append(iu)
+            self.observe_speaking_rate(current_text, len(waveform))
+
+    def observe_speaking_rate(self, text, n_samples):
+        """Calibrates the clause packer's speaking rate on a synthesized
+        clause, if there is a clause packer.
+
+        Args:
+            text (str): the clause text.
+            n_samples (int): number of synthesized samples of the clause,
+                without the silence padding it to a whole number of
+                chunks.
+        """
+        if self.clause_packer is not None:
+            self.clause_packer.observe(text, n_samples / self.samplerate)
+
+    def get_cached_audio(self, text):
+        """Returns the cached audio of a clause, padded to a whole number of
+        chunks, and logs the cache hit.
+
+        Args:
+            text (str): the clause text.
 
-        return new_buffer
+        Returns:
+            np.ndarray: the int16 audio, or None if the clause is not
+                cached (or if the cache is disabled).
+        """
+        if self.cache is None:
+            return None
+        key = self.cache.make_key(text, self.model_name, self.speaker_wav)
+        buffer = self.cache.get(key)
+        if buffer is None:
+            return None
+        stats = self.cache.get_stats()
+        self.file_logger.info(
+            "tts_cache_hit", hit_rate=stats["hit_rate"], saved_time=stats["saved_time"]
+        )
+        if len(buffer) % self.chunk_size != 0:
+            # cached with another frame_duration
+            padded = np.zeros(
+                -(-len(buffer) // self.chunk_size) * self.chunk_size, dtype=np.int16
+            )
+            padded[: len(buffer)] = buffer
+            buffer = padded
+        return buffer
+
+    def cache_audio(self, text, buffer, synthesis_time):
+        """Adds the audio of a clause to the cache, if it is enabled.
+
+        Args:
+            text (str): the clause text.
+            buffer (np.ndarray): the int16 audio.
+            synthesis_time (float): time needed to synthesize the audio.
+        """
+        if self.cache is not None:
+            key = self.cache.make_key(text, self.model_name, self.speaker_wav)
+            self.cache.put(key, buffer, synthesis_time, text=text)
+
+    def create_audio_ius(self, buffer, clause_ius):
+        """Creates the AudioFinalIUs of an int16 buffer containing a whole
+        number of chunks, their raw_audio being memoryview slices of the
+        buffer.
+
+        Args:
+            buffer (np.ndarray): the int16 buffer.
+            clause_ius (list[TextFinalIU]): the IUs of the clause.
+
+        Returns:
+            list[AudioFinalIU]: the AudioFinalIUs.
+        """
+        return [
+            self.create_iu(
+                grounded_in=clause_ius[-1],
+                raw_audio=chunk,
+                chunk_size=self.chunk_size,
+                rate=self.samplerate,
+                sample_width=self.samplewidth,
+            )
+            for chunk in split_chunks(buffer, self.chunk_size)
+        ]
+
+    def load_model(self):
+        """Loads the TTS model, and applies the optimized inference mode if
+        one is set.
+
+        Returns:
+            api.TTS: the TTS model.
+        """
+        model = api.TTS(self.model_name).to(self.device)
+        if self.optimization is not None:
+            model.synthesizer.tts_model = optimize_tts_model(
+                model.synthesizer.tts_model,
+                self.optimization,
+                self.model_name,
+                cache_dir=self.optimization_cache_dir,
+            )
+        return model
 
     def setup(self):
         """Setup Module by instanciating the TTS model and its related audio
         attributes."""
         super().setup()
-        self.model = api.TTS(self.model_name).to(self.device)
-        self.samplerate = self.model.synthesizer.tts_config.get("audio")["sample_rate"]
+        self.model = self.load_model()
+        self.worker_models = [self.model]
+        for _ in range(self.n_workers - 1):
+            self.worker_models.append(
+                self.load_model() if self.worker_replicas else self.model
+            )
+        self._model_locks = {id(m): threading.Lock() for m in self.worker_models}
+        audio_config = self.model.synthesizer.tts_config.get("audio")
+        # XTTS models output audio at a different framerate than their input
+        self.samplerate = audio_config.get(
+            "output_sample_rate", audio_config["sample_rate"]
+        )
         self.chunk_size = int(self.samplerate * self.frame_duration)
         self.chunk_size_bytes = self.chunk_size * self.samplewidth
+        self.hop_length = audio_config.get("hop_length")
+        tts_model = self.model.synthesizer.tts_model
+        if self.streaming and not (
+            hasattr(tts_model, "inference_stream")
+            or hasattr(tts_model, "waveform_decoder")
+        ):
+            raise ValueError(
+                f"streaming synthesis is not supported by {self.model_name}"
+            )
+        if self.streaming and hasattr(tts_model, "inference_stream"):
+            self.gpt_cond_latent, self.speaker_embedding = (
+                tts_model.get_conditioning_latents(audio_path=[self.speaker_wav])
+            )
+
+        # warm-up
+        if self.warmup_text is not None:
+            for model in {id(m): m for m in self.worker_models}.values():
+                self._worker.model = model
+                start = time.perf_counter()
+                self.synthesize(self.warmup_text)
+                self.terminal_logger.info(
+                    "tts_warmup", duration=time.perf_counter() - start
+                )
+            del self._worker.model
+
+        # prewarm the cache
+        if self.cache is not None:
+            for text in self.prewarm_phrases:
+                key = self.cache.make_key(text, self.model_name, self.speaker_wav)
+                if key in self.cache.entries or self.cache.load(key)[0] is not None:
+                    continue
+                start = time.perf_counter()
+                buffer, _ = self.synthesize(text)
+                self.cache_audio(text, buffer, time.perf_counter() - start)
 
     def prepare_run(self):
-        """Prepare run by instanciating the Thread that synthesizes the
+        """Prepare run by instanciating the worker Threads that synthesize the
         audio."""
         super().prepare_run()
         self._tts_thread_active = True
-        # threading.Thread(target=self._tts_thread).start()
-        threading.Thread(target=self._process_one_clause).start()
+        for model in self.worker_models:
+            threading.Thread(target=self._tts_worker, args=(model,)).start()
 
     def shutdown(self):
-        """Shutdown Thread and Module."""
+        """Shutdown Thread and Module, and logs the cache statistics."""
         super().shutdown()
         self._tts_thread_active = False
+        if self.cache is not None:
+            self.terminal_logger.info("tts_cache_stats", **self.cache.get_stats())
@@ -4,8 +4,9 @@ SimpleVADModule
 
 A retico module that provides Voice Activity Detection (VAD) using
 WebRTC's VAD. Takes AudioIU as input, resamples the IU's raw_audio to
-match WebRTC VAD's input frame rate, then call the VAD to predict
-(user's) voice activity on the resampled raw_audio (True == speech
+match WebRTC VAD's input frame rate (with pydub, or with a streaming
+resampler keeping its state across the chunks), then call the VAD to
+predict (user's) voice activity on the resampled raw_audio (True == speech
 recognized), and finally returns the prediction alognside with the
 raw_audio (and related parameter such as frame rate, etc) using a new IU
 type called VADIU.
@@ -15,17 +16,42 @@ agent's voice activity (agent == the retico system) by receiving IUs
 from the SpeakerModule. The agent's voice activity is also outputted in
 the VADIU.
 
+As WebRTC's VAD only accepts 10, 20 or 30ms frames, the resampled audio
+is re-framed : the samples are accumulated, the VAD is called on every
+complete frame, and the per-frame predictions are combined into the
+va_user of a single VADIU containing all the complete frames, the
+remaining samples being kept for the next AudioIU. The microphone can
+thus send AudioIUs of any size.
+
+The frames go through a VADCascade : an optional RMS energy gate skips
+the clearly silent frames, WebRTC's VAD is called on the remaining ones,
+and an optional ONNX neural VAD confirms (in a single batch) the frames
+flagged as speech by WebRTC's VAD, reducing the false user BOTs caused by
+noise. A VADIU is still outputted for every chunk, as the ASR needs the
+silent chunks to predict the user EOT.
+
+If the SimpleSpeakerModule's PlaybackClock is given, the agent's voice
+activity of each VADIU is read from the actual playback timeline instead
+of the agent BOT and EOT TextIUs, which lag behind the playback. The
+delay of these TextIUs is then measured and logged.
+
+The per-frame voice activity events are recorded in an EventRecorder,
+and logged by a background thread (optionally aggregated).
+
 Inputs : AudioIU, TextIU
 
 Outputs : VADIU
 """
 
+import time
+import numpy as np
 import pydub
-import webrtcvad
 
 import retico_core
 from retico_core import audio, text
 from simple_retico_agent.additional_IUs import VADIU
+from simple_retico_agent.audio_processing import StreamingResampler, VADCascade
+from simple_retico_agent.event_recorder import EventRecorder
 
 
 class SimpleVADModule(retico_core.AbstractModule):
@@ -66,6 +92,15 @@ class SimpleVADModule(retico_core.AbstractModule):
         channels=1,
         sample_width=2,
         vad_aggressiveness=3,
+        resampling_method="pydub",
+        vad_frame_length=0.02,
+        va_aggregation="any",
+        energy_threshold=None,
+        neural_vad_path=None,
+        neural_vad_threshold=0.5,
+        playback_clock=None,
+        event_flush_interval=0.02,
+        aggregate_events=False,
         **kwargs,
     ):
         """Initializes the SimpleVADModule Module.
@@ -83,14 +118,93 @@ class SimpleVADModule(retico_core.AbstractModule):
             vad_aggressiveness (int, optional): The level of
                 aggressiveness of VAD model, the greater the more
                 reactive. Defaults to 3.
+            resampling_method (str, optional): "pydub" to resample each
+                chunk independently with pydub (the fastest), or "numpy"
+                to resample the audio with a StreamingResampler, that
+                keeps its filter state across the chunks (no artefacts
+                at the chunk boundaries, a sharper anti-aliasing filter
+                and an exact number of samples), at about twice pydub's
+                CPU time per chunk (cf. benchmarks.benchmark_resampling).
+                The "numpy" method only supports mono audio. Defaults to
+                "pydub".
+            vad_frame_length (float, optional): duration of the frames
+                passed to WebRTC's VAD, has to be 0.01, 0.02 or 0.03.
+                Defaults to 0.02.
+            va_aggregation (str, optional): how the predictions of the
+                frames of a VADIU are combined into its va_user : "any"
+                (at least one frame contains speech), "majority" (more
+                than half of the frames) or "all". Defaults to "any".
+            energy_threshold (float, optional): RMS energy (in dBFS)
+                under which a frame is considered silent without calling
+                WebRTC's VAD, None disables the energy gate. Defaults to
+                None.
+            neural_vad_path (str, optional): path to an ONNX neural VAD
+                model, confirming the frames flagged as speech by
+                WebRTC's VAD (requires onnxruntime), None disables the
+                neural VAD. Defaults to None.
+            neural_vad_threshold (float, optional): speech probability
+                above which the neural VAD predicts speech. Defaults to
+                0.5.
+            playback_clock (PlaybackClock, optional): the
+                SimpleSpeakerModule's playback clock, used to set the
+                agent's voice activity, the agent BOT and EOT TextIUs
+                are used if None. Defaults to None.
+            event_flush_interval (float, optional): time (in seconds)
+                between two flushes of the recorded voice activity
+                events to the file logger. Defaults to 0.02.
+            aggregate_events (bool, optional): if True, the voice
+                activity events are logged once per flush, with their
+                number of occurrences and their times, instead of one
+                by one. Defaults to False.
         """
         super().__init__(**kwargs)
         self.target_framerate = target_framerate
         self.input_framerate = input_framerate
         self.channels = channels
         self.sample_width = sample_width
-        self.vad = webrtcvad.Vad(vad_aggressiveness)
         self.VA_agent = False
+        self.playback_clock = playback_clock
+        self.agent_message_delays = {"agent_BOT": [], "agent_EOT": []}
+        self.resampling_method = resampling_method
+        self.resampler = None
+        if self.resampling_method == "numpy":
+            if self.channels != 1:
+                raise ValueError("numpy resampling method only supports mono audio")
+            if self.input_framerate != self.target_framerate:
+                self.resampler = StreamingResampler(
+                    self.input_framerate, self.target_framerate
+                )
+        elif self.resampling_method != "pydub":
+            raise ValueError(f"unknown resampling method : {resampling_method}")
+
+        # re-framing and VAD cascade
+        self.vad = VADCascade(
+            framerate=self.target_framerate,
+            frame_length=vad_frame_length,
+            vad_aggressiveness=vad_aggressiveness,
+            energy_threshold=energy_threshold,
+            neural_vad_path=neural_vad_path,
+            neural_vad_threshold=neural_vad_threshold,
+        )
+        if va_aggregation not in ("any", "majority", "all"):
+            raise ValueError(f"unknown VA aggregation : {va_aggregation}")
+        self.vad_frame_length = vad_frame_length
+        self.va_aggregation = va_aggregation
+        self.frame_size = (
+            round(self.target_framerate * vad_frame_length)
+            * self.sample_width
+            * self.channels
+        )
+        self.frame_buffer = bytearray()
+        self.event_recorder = EventRecorder(
+            self,
+            flush_interval=event_flush_interval,
+            aggregated_events=(
+                ("VA_overlap", "VA_agent", "VA_user", "VA_silence")
+                if aggregate_events
+                else ()
+            ),
+        )
 
     def resample_audio(self, raw_audio):
         """Resample the audio's frame_rate to correspond to
@@ -103,6 +217,8 @@ class SimpleVADModule(retico_core.AbstractModule):
         Returns:
             bytes: the resampled audio chunk.
         """
+        if self.resampler is not None:
+            return self.resampler.process(raw_audio)
         if self.input_framerate != self.target_framerate:
             s = pydub.AudioSegment(
                 raw_audio,
@@ -114,6 +230,62 @@ class SimpleVADModule(retico_core.AbstractModule):
             return s._data
         return raw_audio
 
+    def detect_voice_activity(self, raw_audio):
+        """Predicts the voice activity of every frame of raw_audio with the
+        VAD cascade, and combines the predictions according to
+        self.va_aggregation.
+
+        Args:
+            raw_audio (bytes): resampled audio, containing a whole
+                number of VAD frames.
+
+        Returns:
+            bool: the user's voice activity.
+        """
+        va = self.vad.process(raw_audio)
+        if self.va_aggregation == "any":
+            return bool(va.any())
+        if self.va_aggregation == "all":
+            return bool(va.all())
+        return int(va.sum()) * 2 > len(va)
+
+    def get_agent_voice_activity(self, iu, raw_audio):
+        """Returns the agent's voice activity during the capture of raw_audio,
+        from the playback clock if there is one (True if agent audio was
+        played during at least half of it), or from the latest agent BOT or
+        EOT TextIU received otherwise.
+
+        Args:
+            iu (AudioIU): the latest AudioIU received, whose creation
+                time is considered as the end of raw_audio's capture.
+            raw_audio (bytes): the resampled audio of the VADIU.
+
+        Returns:
+            bool: the agent's voice activity.
+        """
+        if self.playback_clock is None:
+            return self.VA_agent
+        end = iu.created_at
+        start = end - len(raw_audio) / (
+            self.sample_width * self.channels * self.target_framerate
+        )
+        return self.playback_clock.agent_activity(start, end) >= 0.5
+
+    def measure_agent_message_delay(self, event):
+        """Measures the delay between the actual playback of an agent BOT or
+        EOT, given by the playback clock, and the reception of the
+        corresponding TextIU.
+
+        Args:
+            event (str): "agent_BOT" or "agent_EOT".
+        """
+        _, turn_id, _ = self.playback_clock.snapshot()
+        transition_time = self.playback_clock.transition_time(turn_id, event)
+        if transition_time is not None:
+            delay = time.time() - transition_time
+            self.agent_message_delays[event].append(delay)
+            self.file_logger.info(f"{event}_delay", delay=delay)
+
     def process_update(self, update_message):
         """Receives TextIU and AudioIU, use the first one to set the
         self.VA_agent class attribute, and process the second one by predicting
@@ -135,6 +307,11 @@ class SimpleVADModule(retico_core.AbstractModule):
                     # agent EOT
                     elif iu.payload == "agent_EOT":
                         self.VA_agent = False
+                    if self.playback_clock is not None and iu.payload in (
+                        "agent_BOT",
+                        "agent_EOT",
+                    ):
+                        self.measure_agent_message_delay(iu.payload)
             elif isinstance(iu, audio.AudioIU):
                 if ut == retico_core.UpdateType.ADD:
                     if self.input_framerate != iu.rate:
@@ -142,16 +319,22 @@ class SimpleVADModule(retico_core.AbstractModule):
                             f"input framerate differs from iu framerate : {self.input_framerate}\
                             vs {iu.rate}"
                         )
-                    raw_audio = self.resample_audio(iu.raw_audio)
-                    VA_user = self.vad.is_speech(raw_audio, self.target_framerate)
+                    self.frame_buffer += self.resample_audio(iu.raw_audio)
+                    n_bytes = len(self.frame_buffer) // self.frame_size * self.frame_size
+                    if n_bytes == 0:
+                        continue
+                    raw_audio = bytes(self.frame_buffer[:n_bytes])
+                    del self.frame_buffer[:n_bytes]
+                    VA_user = self.detect_voice_activity(raw_audio)
+                    VA_agent = self.get_agent_voice_activity(iu, raw_audio)
                     output_iu = self.create_iu(
                         grounded_in=iu,
                         raw_audio=raw_audio,
-                        nframes=iu.nframes,
-                        rate=self.input_framerate,
+                        nframes=len(raw_audio) // self.sample_width,
+                        rate=self.target_framerate,
                         sample_width=self.sample_width,
                         va_user=VA_user,
-                        va_agent=self.VA_agent,
+                        va_agent=VA_agent,
                     )
                     um = retico_core.UpdateMessage.from_iu(
                         output_iu, retico_core.UpdateType.ADD
@@ -159,7 +342,7 @@ class SimpleVADModule(retico_core.AbstractModule):
                     self.append(um)
 
                     # something for logging
-                    if self.VA_agent:
+                    if VA_agent:
                         if VA_user:
                             event = "VA_overlap"
                         else:
@@ -169,4 +352,24 @@ class SimpleVADModule(retico_core.AbstractModule):
                             event = "VA_user"
                         else:
                             event = "VA_silence"
-                    self.file_logger.info(event)
+                    self.event_recorder.record(event)
+
+    def prepare_run(self):
+        """Starts the EventRecorder's flushing thread."""
+        super().prepare_run()
+        self.event_recorder.start()
+
+    def shutdown(self):
+        """Logs the VAD cascade statistics, and the agent BOT and EOT TextIUs
+        delays, and shutdowns the Module."""
+        super().shutdown()
+        self.event_recorder.stop()
+        self.terminal_logger.info("vad_stats", **self.vad.get_stats())
+        for event, delays in self.agent_message_delays.items():
+            if len(delays) != 0:
+                self.terminal_logger.info(
+                    f"{event}_delay_stats",
+                    n=len(delays),
+                    mean=float(np.mean(delays)),
+                    p95=float(np.percentile(delays, 95)),
+                )
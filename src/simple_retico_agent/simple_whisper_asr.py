@@ -13,10 +13,12 @@ a final hypothesis and sends the corresponding IUs (with UpdateType =
 COMMIT).
 
 The faster_whisper library is used to speed up the whisper inference.
+Several ASR modules can share the same WhisperASREngine, that batches
+their requests.
 
 Inputs : VADTurnAudioIU
 
-Outputs : SpeechRecognitionIU
+Outputs : SpeechRecognitionTimedIU
 """
 
 import os
@@ -27,9 +29,10 @@ import transformers
 from faster_whisper import WhisperModel
 
 import retico_core
-from retico_core import log_utils, text
+from retico_core import log_utils
 from simple_retico_agent.utils import device_definition
-from simple_retico_agent.additional_IUs import VADIU
+from simple_retico_agent.additional_IUs import VADIU, SpeechRecognitionTimedIU
+from simple_retico_agent.turn_detection import SessionRecorder, VATurnDetector
 
 transformers.logging.set_verbosity_error()
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
@@ -51,7 +54,7 @@ class SimpleWhisperASRModule(retico_core.AbstractModule):
 
     Inputs : VADTurnAudioIU
 
-    Outputs : SpeechRecognitionTurnIU
+    Outputs : SpeechRecognitionTimedIU
     """
 
     @staticmethod
@@ -68,7 +71,7 @@ class SimpleWhisperASRModule(retico_core.AbstractModule):
 
     @staticmethod
     def output_iu():
-        return text.SpeechRecognitionIU
+        return SpeechRecognitionTimedIU
 
     def __init__(
         self,
@@ -79,6 +82,15 @@ class SimpleWhisperASRModule(retico_core.AbstractModule):
         silence_threshold=0.75,
         bot_dur=0.4,
         bot_threshold=0.75,
+        min_turn_dur=0.0,
+        min_silence_dur=0.0,
+        trim_silence=True,
+        silence_padding=0.2,
+        asr_engine=None,
+        endpointer=None,
+        session_record_path=None,
+        word_timestamps=False,
+        release_margin=1.0,
         **kwargs,
     ):
         """Initializes the SimpleWhisperASRModule Module.
@@ -103,14 +115,62 @@ class SimpleWhisperASRModule(retico_core.AbstractModule):
             bot_threshold (float, optional): share of IUs in the last
                 bot_dur seconds to present positive VA to predict user
                 BOT. Defaults to 0.75.
+            min_turn_dur (float, optional): minimum duration of a user
+                turn, no user EOT is predicted less than min_turn_dur
+                seconds after the user BOT. Defaults to 0.0.
+            min_silence_dur (float, optional): minimum duration of a
+                user silence, no user BOT is predicted less than
+                min_silence_dur seconds after the user EOT. Defaults to
+                0.0.
+            trim_silence (bool, optional): if True, the audio chunks
+                with no user VA are removed from the audio buffer before
+                the transcription, except the ones within
+                silence_padding seconds of a chunk containing speech.
+                Defaults to True.
+            silence_padding (float, optional): Duration of silence kept
+                before and after each speech span when trim_silence is
+                True. Defaults to 0.2.
+            asr_engine (WhisperASREngine, optional): a Whisper engine
+                shared with other ASR modules, that batches their
+                requests. If None, the module instantiates its own
+                WhisperModel. Defaults to None.
+            endpointer (AdaptiveEndpointer, optional): if given, used to
+                predict early user EOTs from the ASR hypotheses and the
+                current silence duration, the fixed silence_dur EOT
+                being kept as a fallback. Defaults to None.
+            session_record_path (str, optional): if given, path to a
+                JSON lines file where the user VA of every VADIU and the
+                ASR hypotheses are recorded, so that the session can be
+                replayed (cf. turn_detection.replay_endpointing).
+                Defaults to None.
+            word_timestamps (bool, optional): if True, the word
+                timestamps are predicted by faster_whisper, and the
+                start and end sample offsets of each word are added to
+                the outputted IUs. Not available with an asr_engine (a
+                ValueError is raised). Defaults to False.
+            release_margin (float, optional): if word_timestamps is
+                True, the audio preceding the last word that has been
+                stable across two hypotheses, and that ended at least
+                release_margin seconds ago, is released from the audio
+                buffer (the stable words are kept as transcription
+                prefix), bounding the transcribed audio during long
+                user turns. No audio is released if None. Defaults to
+                1.0.
         """
         super().__init__(**kwargs)
+        if word_timestamps and asr_engine is not None:
+            raise ValueError("word_timestamps is not available with an asr_engine")
 
         # model
-        self.device = device_definition(device)
-        self.model = WhisperModel(
-            whisper_model, device=self.device, compute_type="int8"
-        )
+        self.asr_engine = asr_engine
+        self.model = None
+        if self.asr_engine is None:
+            self.device = device_definition(device)
+            self.model = WhisperModel(
+                whisper_model, device=self.device, compute_type="int8"
+            )
+        else:
+            self.device = self.asr_engine.device
 
         # general
         self._asr_thread_active = False
@@ -119,70 +179,96 @@ class SimpleWhisperASRModule(retico_core.AbstractModule):
 
         # audio
         self.framerate = framerate
+        self.buffer_start_sample = 0
+
+        # word timestamps
+        self.word_timestamps = word_timestamps
+        self.release_margin = release_margin
+        self.latest_words = None
+        self.released_words = []
+        self._previous_words = None
 
         # vad
         self.silence_dur = silence_dur
         self.silence_threshold = silence_threshold
-        self._n_sil_audio_chunks = None
         self.bot_dur = bot_dur
         self.bot_threshold = bot_threshold
-        self._n_bot_audio_chunks = None
+        self.chunk_duration = None
+        self.turn_detector = VATurnDetector(
+            bot_dur=bot_dur,
+            bot_threshold=bot_threshold,
+            eot_dur=silence_dur,
+            eot_threshold=silence_threshold,
+            min_turn_dur=min_turn_dur,
+            min_silence_dur=min_silence_dur,
+        )
+        self._user_bot = threading.Event()
+        self._user_eot = threading.Event()
+        self._turn_lock = threading.Lock()
         self.vad_state = "user_silent"
+        self.endpointer = endpointer
+        self.session_recorder = (
+            SessionRecorder(session_record_path)
+            if session_record_path is not None
+            else None
+        )
 
-    def get_n_audio_chunks(self, n_chunks_param_name, duration):
-        """Returns the number of audio chunks corresponding to duration. Stores
-        this number in the n_chunks_param_name class argument if it hasn't been
-        done before.
-
-        Args:
-            n_chunks_param_name (str): the name of class argument to
-                check and/or set.
-            duration (float): duration in second.
-
-        Returns:
-            int: the number of audio chunks corresponding to duration.
-        """
-        if not getattr(self, n_chunks_param_name):
-            if len(self.current_input) == 0:
-                return None
-            first_iu = self.current_input[0]
-            self.framerate = first_iu.rate
-            # nb frames in each audio chunk
-            nb_frames_chunk = len(first_iu.payload) / 2
-            # duration of 1 audio chunk
-            duration_chunk = nb_frames_chunk / self.framerate
-            setattr(self, n_chunks_param_name, int(duration / duration_chunk))
-        return getattr(self, n_chunks_param_name)
+        # silence trimming
+        self.trim_silence = trim_silence
+        self.silence_padding = silence_padding
+        self.trim_offset_map = None
 
     def recognize_user_bot(self):
-        """Return the prediction on user BOT from the current audio buffer.
-        Returns True if enough audio chunks contain speech.
+        """Return the prediction on user BOT, made by the turn detector from
+        the VADIUs received. Returns True if a user BOT has been recognized
+        since the last call.
 
         Returns:
             bool: the BOT prediction.
         """
-        return self.recognize_turn(
-            _n_audio_chunks=self.get_n_audio_chunks(
-                n_chunks_param_name="_n_bot_audio_chunks", duration=self.bot_dur
-            ),
-            threshold=self.bot_threshold,
-            condition=lambda iu: iu.va_user,
-        )
+        if self._user_bot.is_set():
+            self._user_bot.clear()
+            return True
+        return False
 
     def recognize_user_eot(self):
-        """Return the prediction on user EOT from the current audio buffer.
-        Returns True if enough audio chunks do not contain speech.
+        """Return the prediction on user EOT, made by the turn detector from
+        the VADIUs received. Returns True if a user EOT has been recognized
+        since the last call.
 
         Returns:
             bool: the EOT prediction.
         """
-        return self.recognize_turn(
-            _n_audio_chunks=self.get_n_audio_chunks(
-                n_chunks_param_name="_n_sil_audio_chunks", duration=self.silence_dur
-            ),
-            threshold=self.silence_threshold,
-            condition=lambda iu: not iu.va_user,
-        )
+        if self._user_eot.is_set():
+            self._user_eot.clear()
+            return True
+        return False
+
+    def recognize_early_user_eot(self, prediction):
+        """Return the prediction of the endpointer on early user EOT, from
+        the latest ASR hypothesis and the current silence duration. If an
+        early EOT is predicted, the turn detector goes back to the
+        "user_silent" state.
+
+        Args:
+            prediction (str): the latest ASR hypothesis.
+
+        Returns:
+            bool: the early EOT prediction.
+        """
+        if self.endpointer is None:
+            return False
+        self.endpointer.update_hypothesis(prediction)
+        with self._turn_lock:
+            if self.turn_detector.state != "user_speaking":
+                return False
+            if not self.endpointer.is_endpoint(
+                self.turn_detector.silence_run_duration()
+            ):
+                return False
+            self.turn_detector.set_state("user_silent")
+        self.file_logger.info("early_EOT")
+        return True
 
     def recognize_agent_bot(self):
         """Return True if the last VAIU received presents a positive agent VA.
@@ -200,71 +286,208 @@ class SimpleWhisperASRModule(retico_core.AbstractModule):
         """
         return not self.current_input[-1].va_agent
 
-    def recognize_turn(self, _n_audio_chunks=None, threshold=None, condition=None):
-        """Function that predicts user BOT/EOT from VADIUs received.
+    def trim_silences(self, ius):
+        """Concatenates the audio chunks from the audio buffer, dropping the
+        silent spans (chunks with no user VA) that are further than
+        silence_padding seconds from a chunk containing speech.
 
-        Example : if self.silence_threshold==0.75 (percentage) and
-        self.bot_dur==0.4 (seconds), It predicts user BOT (returns True)
-        if, across the frames corresponding to the last 400ms second of
-        audio, >75% contains speech.
+        Also returns the offset map of the kept spans, each span being a
+        (trimmed_start, original_start, n_samples) tuple, so that a
+        sample offset in the trimmed audio can be converted back into
+        an offset in the audio buffer (cf. trimmed_to_original_offset).
 
         Args:
-            _n_audio_chunks (_type_, optional): the threshold number of
-                audio chunks to recognize a user BOT or EOT. Defaults to
-                None.
-            threshold (float, optional): the threshold share of audio
-                chunks to recognize a user BOT or EOT. Defaults to None.
-            condition (Callable[], optional): function that takes an IU
-                and returns a boolean, if True is returned, the
-                speech_counter is incremented. Defaults to None.
+            ius (list[VADIU]): the audio buffer.
 
         Returns:
-            boolean : the user BOT or EOT prediction.
+            (bytes, np.ndarray): the trimmed audio and its offset map.
         """
-        if not _n_audio_chunks or len(self.current_input) < _n_audio_chunks:
-            return False
-        _n_audio_chunks = int(_n_audio_chunks)
-        speech_counter = sum(
-            1 for iu in self.current_input[-_n_audio_chunks:] if condition(iu)
+        n_pad = self.turn_detector.n_chunks(self.silence_padding)
+        va_user = np.fromiter(
+            (bool(iu.va_user) for iu in ius), dtype=bool, count=len(ius)
         )
-        if speech_counter >= int(threshold * _n_audio_chunks):
-            return True
-        return False
+        # dilate the speech chunks by n_pad chunks on each side
+        n_pad = n_pad or 0
+        nb_chunks = len(va_user)
+        speech_cumsum = np.concatenate(([0], np.cumsum(va_user)))
+        chunk_ids = np.arange(nb_chunks)
+        keep = (
+            speech_cumsum[np.minimum(chunk_ids + n_pad + 1, nb_chunks)]
+            - speech_cumsum[np.maximum(chunk_ids - n_pad, 0)]
+        ) > 0
+        nb_samples = np.fromiter(
+            (len(iu.raw_audio) // iu.sample_width for iu in ius),
+            dtype=np.int64,
+            count=len(ius),
+        )
+        original_starts = np.concatenate(([0], np.cumsum(nb_samples)[:-1]))
+
+        # contiguous spans of kept chunks
+        edges = np.diff(np.concatenate(([0], keep.astype(np.int8), [0])))
+        span_starts = np.flatnonzero(edges == 1)
+        span_ends = np.flatnonzero(edges == -1)
+
+        offset_map = np.zeros((len(span_starts), 3), dtype=np.int64)
+        trimmed_start = 0
+        for i, (start, end) in enumerate(zip(span_starts, span_ends)):
+            n_samples = nb_samples[start:end].sum()
+            offset_map[i] = (trimmed_start, original_starts[start], n_samples)
+            trimmed_start += n_samples
+
+        trimmed_audio = b"".join([iu.raw_audio for iu, k in zip(ius, keep) if k])
+        return trimmed_audio, offset_map
+
+    def trimmed_to_original_offset(self, sample):
+        """Converts a sample offset in the last trimmed audio transcribed into
+        the corresponding sample offset in the audio buffer.
+
+        Args:
+            sample (int): sample offset in the trimmed audio.
+
+        Returns:
+            int: sample offset in the audio buffer.
+        """
+        if self.trim_offset_map is None or len(self.trim_offset_map) == 0:
+            return sample
+        span = max(
+            np.searchsorted(self.trim_offset_map[:, 0], sample, side="right") - 1, 0
+        )
+        trimmed_start, original_start, _ = self.trim_offset_map[span]
+        return int(original_start + sample - trimmed_start)
 
     def recognize(self):
         """Recreates the audio signal received by the microphone by
         concatenating the audio chunks from the audio_buffer and transcribes
         this concatenation into a list of predicted words.
 
+        If trim_silence is True, the long silent spans are removed
+        before the transcription (cf. trim_silences). If word_timestamps
+        is True, the words of the transcription, and their position in
+        the audio stream, are stored in latest_words.
+
         Returns:
             (list[string], boolean): the list of transcribed words.
         """
+        with self._turn_lock:
+            ius = list(self.current_input)
+            buffer_start_sample = self.buffer_start_sample
 
         # faster whisper
-        full_audio = b"".join([iu.raw_audio for iu in self.current_input])
+        if self.trim_silence:
+            full_audio, self.trim_offset_map = self.trim_silences(ius)
+        else:
+            full_audio = b"".join([iu.raw_audio for iu in ius])
+            self.trim_offset_map = None
+        if len(full_audio) == 0:
+            return " ".join([w[0] for w in self.released_words])
         audio_np = (
             np.frombuffer(full_audio, dtype=np.int16).astype(np.float32) / 32768.0
         )
-        segments, _ = self.model.transcribe(audio_np)  # the segments can be streamed
+        if self.asr_engine is not None:
+            return self.asr_engine.transcribe(
+                audio_np, stream_id=self.id, final=self.eos
+            )
+        segments, _ = self.model.transcribe(
+            audio_np, word_timestamps=self.word_timestamps
+        )  # the segments can be streamed
         segments = list(segments)
         transcription = "".join([s.text for s in segments])
 
+        if self.word_timestamps:
+            words = []
+            for segment in segments:
+                for word in segment.words:
+                    if word.word.strip() == "":
+                        continue
+                    words.append(
+                        (
+                            word.word.strip(),
+                            buffer_start_sample
+                            + self.trimmed_to_original_offset(
+                                int(word.start * self.framerate)
+                            ),
+                            buffer_start_sample
+                            + self.trimmed_to_original_offset(
+                                int(word.end * self.framerate)
+                            ),
+                        )
+                    )
+            self.latest_words = self.released_words + words
+            transcription = " ".join([w[0] for w in self.latest_words])
+            if self.release_margin is not None:
+                self.release_stable_words(words, ius, buffer_start_sample)
+
         return transcription
 
+    def release_stable_words(self, words, ius, buffer_start_sample):
+        """Releases from the audio buffer the audio chunks preceding the last
+        stable word boundary, i.e. the end of the last word that is identical
+        in the current and previous hypotheses (not counting the last word of
+        the hypothesis), and that ended at least release_margin seconds
+        before the end of the audio buffer. The words fully contained in the
+        released audio are stored in released_words, to be used as prefix of
+        the next hypotheses.
+
+        Args:
+            words (list[tuple]): the (text, start_sample, end_sample)
+                words of the current hypothesis (not counting the
+                previously released words).
+            ius (list[VADIU]): the audio buffer transcribed.
+            buffer_start_sample (int): offset of the first sample of the
+                audio buffer, in the audio stream.
+        """
+        previous_words, self._previous_words = self._previous_words, words
+        if previous_words is None:
+            return
+        n_stable = 0
+        for word, previous_word in zip(words[:-1], previous_words):
+            if word[0] != previous_word[0]:
+                break
+            n_stable += 1
+
+        chunk_ends = buffer_start_sample + np.cumsum(
+            [len(iu.raw_audio) // iu.sample_width for iu in ius]
+        )
+        release_limit = chunk_ends[-1] - int(self.release_margin * self.framerate)
+        while n_stable > 0 and words[n_stable - 1][2] > release_limit:
+            n_stable -= 1
+        if n_stable == 0:
+            return
+
+        # release the chunks ending before the stable word boundary
+        n_chunks = int(np.searchsorted(chunk_ends, words[n_stable - 1][2], "right"))
+        if n_chunks == 0:
+            return
+        released_end = chunk_ends[n_chunks - 1]
+        n_released = sum(1 for w in words[:n_stable] if w[2] <= released_end)
+        self.released_words.extend(words[:n_released])
+        self._previous_words = words[n_released:]
+        self.drop_oldest_chunks(n_chunks)
+
+    def drop_oldest_chunks(self, n_chunks):
+        """Removes the n_chunks oldest audio chunks from the audio buffer,
+        and updates the offset of the audio buffer in the audio stream.
+
+        Args:
+            n_chunks (int): the number of audio chunks to remove.
+        """
+        with self._turn_lock:
+            dropped = self.current_input[:n_chunks]
+            del self.current_input[:n_chunks]
+            self.buffer_start_sample += sum(
+                len(iu.raw_audio) // iu.sample_width for iu in dropped
+            )
+
     def update_current_input(self):
         """Remove from current_input, the oldest IUs, that will not be
         considered to predict user BOT."""
-        if len(self.current_input) > 0:
-            self.current_input = self.current_input[
-                -int(
-                    self.get_n_audio_chunks(
-                        n_chunks_param_name="_n_bot_audio_chunks", duration=self.bot_dur
-                    )
-                ) :
-            ]
+        n_bot_chunks = self.turn_detector.n_chunks(self.bot_dur)
+        if n_bot_chunks is not None and len(self.current_input) > n_bot_chunks:
+            self.drop_oldest_chunks(len(self.current_input) - n_bot_chunks)
 
     def process_update(self, update_message):
-        """Receives and stores VADIUs in the self.current_input buffer.
+        """Receives and stores VADIUs in the self.current_input buffer, and
+        updates the turn detector with their user VA.
 
         Args:
             update_message (UpdateType): UpdateMessage that contains new
@@ -276,19 +499,54 @@ class SimpleWhisperASRModule(retico_core.AbstractModule):
                 continue
             if self.framerate != iu.rate:
                 raise Exception("input framerate differs from iu framerate")
+            iu_duration = len(iu.raw_audio) / iu.sample_width / iu.rate
+            if self.chunk_duration is None:
+                self.chunk_duration = iu_duration
             self.current_input.append(iu)
             if not self.latest_input_iu:
                 self.latest_input_iu = iu
 
+            with self._turn_lock:
+                event = self.turn_detector.update(iu.va_user, iu_duration)
+            if self.session_recorder is not None:
+                self.session_recorder.record_chunk(iu.va_user, iu_duration)
+            if event == "user_BOT":
+                self._user_bot.set()
+            elif event == "user_EOT":
+                self._user_eot.set()
+            elif (
+                self.vad_state == "user_silent"
+                and self.turn_detector.state == "user_silent"
+            ):
+                self.update_current_input()
+
+    def get_latest_words(self, prediction):
+        """Returns the words (with their position in the audio stream) of the
+        latest hypothesis, if word_timestamps is True and they correspond
+        to the tokens of the prediction.
+
+        Args:
+            prediction (str): the latest hypothesis.
+
+        Returns:
+            list[tuple]: the (text, start_sample, end_sample) words, or
+                None.
+        """
+        if self.latest_words is None:
+            return None
+        if len(self.latest_words) != len(prediction.strip().split(" ")):
+            return None
+        return self.latest_words
+
     def _asr_thread(self):
         """Function that runs on a separate thread.
 
         Handles the ASR prediction and IUs sending aspect of the module.
         Keeps tracks of the "vad_state" (wheter the user is currently
-        speaking or not), and recognizes user BOT or EOT from VADIUs
-        received. When "vad_state" == "user_speaking", predicts
-        periodically new ASR hypothesis. When user EOT is recognized,
-        predicts and sends a final hypothesis.
+        speaking or not), following the user BOT or EOT recognized by
+        the turn detector from VADIUs received. When "vad_state" ==
+        "user_speaking", predicts periodically new ASR hypothesis. When
+        user EOT is recognized, predicts and sends a final hypothesis.
         """
         while self._asr_thread_active:
             try:
@@ -302,10 +560,18 @@ class SimpleWhisperASRModule(retico_core.AbstractModule):
                     # get ASR hypothesis
                     prediction = self.recognize()
                     self.file_logger.info("predict")
+                    if self.session_recorder is not None:
+                        self.session_recorder.record_hypothesis(prediction)
+                    if not user_EOT and self.recognize_early_user_eot(prediction):
+                        user_EOT = True
+                        self.eos = True
+                    um = retico_core.UpdateMessage()
                     if len(prediction) != 0:
                         um, new_tokens = retico_core.text.get_text_increment(
                             self, prediction
                         )
+                        words = self.get_latest_words(prediction)
+                        n_old_tokens = len(words) - len(new_tokens) if words else 0
                         for i, token in enumerate(new_tokens):
                             output_iu = self.create_iu(
                                 grounded_in=self.latest_input_iu,
@@ -314,6 +580,12 @@ class SimpleWhisperASRModule(retico_core.AbstractModule):
                                 stability=0.0,
                                 confidence=0.99,
                                 final=self.eos and (i == (len(new_tokens) - 1)),
+                                start_sample=(
+                                    words[n_old_tokens + i][1] if words else None
+                                ),
+                                end_sample=(
+                                    words[n_old_tokens + i][2] if words else None
+                                ),
                             )
                             self.current_output.append(output_iu)
                             um.add_iu(output_iu, retico_core.UpdateType.ADD)
@@ -324,21 +596,25 @@ class SimpleWhisperASRModule(retico_core.AbstractModule):
                             self.commit(iu)
                             um.add_iu(iu, retico_core.UpdateType.COMMIT)
 
-                        self.current_input = []
+                        self.drop_oldest_chunks(len(self.current_input))
                         self.current_output = []
                         self.eos = False
                         self.latest_input_iu = None
+                        self.latest_words = None
+                        self.released_words = []
+                        self._previous_words = None
                         self.file_logger.info("send_clause")
 
                     if len(um) != 0:
                         self.append(um)
 
                 elif self.vad_state == "user_silent":
-                    user_BOT = self.recognize_user_bot()
-                    if user_BOT:
+                    # wait for the turn detector to recognize a user BOT
+                    if self._user_bot.wait(timeout=0.1):
+                        self.recognize_user_bot()
                         self.vad_state = "user_speaking"
-                    else:
-                        self.update_current_input()
+                        if self.endpointer is not None:
+                            self.endpointer.reset()
 
             except Exception as e:
                 log_utils.log_exception(module=self, exception=e)
@@ -354,3 +630,5 @@ class SimpleWhisperASRModule(retico_core.AbstractModule):
         """Shutdown Thread and Module."""
         super().shutdown()
         self._asr_thread_active = False
+        if self.session_recorder is not None:
+            self.session_recorder.close()
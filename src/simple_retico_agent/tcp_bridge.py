@@ -0,0 +1,416 @@
+"""
+TCP Bridge
+==========
+
+Modules forwarding UpdateMessages from one machine (or process) to
+another over TCP, to distribute the pipeline, e.g. the ASR and TTS on
+one machine and the LLM on another :
+
+.. code-block:: python
+
+    # machine A
+    asr_to_llm = TCPBridgeSender("machine-b", 9001)
+    llm_to_tts = TCPBridgeReceiver(9002)
+    asr.subscribe(asr_to_llm)
+    llm_to_tts.subscribe(tts)
+
+    # machine B
+    asr_to_llm = TCPBridgeReceiver(9001)
+    llm_to_tts = TCPBridgeSender("machine-a", 9002)
+    asr_to_llm.subscribe(llm)
+    llm.subscribe(llm_to_tts)
+
+The UpdateMessages are encoded with the compact binary format of
+iu_serialization (the links between the IUs are kept as iuids, and
+resolved back on each machine). The TCPBridgeSender batches the
+UpdateMessages queued during batch_interval into a single TCP write,
+and applies backpressure : its queue is bounded, so that when the
+receiver does not keep up (and TCP's flow control blocks the writes),
+the sender's process_update blocks instead of buffering without limit.
+The blocking is bounded by send_timeout : the UpdateMessages that cannot
+be queued in time are dropped, and a write that does not complete in
+time (or fails, e.g. if the receiver is gone) marks the bridge as
+broken, the next UpdateMessages being dropped instead of blocking the
+pipeline.
+
+Each frame on the wire is a header (payload length and number of
+UpdateMessages) followed by the length-prefixed encoded UpdateMessages.
+Both modules log the time spent encoding or decoding each IU at
+shutdown.
+
+The IUs' created_at are sent as-is, the machines' clocks have to be
+synchronized for the latencies measured across machines to be
+meaningful.
+"""
+
+import queue
+import socket
+import struct
+import threading
+import time
+
+import retico_core
+from retico_core import log_utils
+
+from simple_retico_agent.iu_serialization import IUSerializer
+
+# payload length, number of UpdateMessages
+FRAME_HEADER = struct.Struct("<IH")
+MESSAGE_HEADER = struct.Struct("<I")
+
+
+def recv_exactly(sock, n):
+    """Receives exactly n bytes from a socket.
+
+    Args:
+        sock (socket.socket): the socket.
+        n (int): the number of bytes.
+
+    Returns:
+        bytearray: the bytes, None if the connection was closed.
+    """
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
+        size = sock.recv_into(view[received:])
+        if size == 0:
+            return None
+        received += size
+    return data
+
+
+class TCPBridgeSender(retico_core.AbstractConsumingModule):
+    """A module sending the UpdateMessages it receives to a
+    TCPBridgeReceiver, in batches.
+
+    The UpdateMessages put in its left buffers are encoded and queued
+    right away (in the thread of the module appending them), instead of
+    waiting for the module's loop to poll them, so that a full queue
+    blocks the producing modules.
+
+    Attributes:
+        n_ius (int): number of sent IUs.
+        n_dropped (int): number of dropped IUs.
+        encoding_time (float): total time (in seconds) spent encoding
+            them.
+        broken (bool): True once a write to the receiver failed.
+    """
+
+    @staticmethod
+    def name():
+        return "TCP Bridge Sender Module"
+
+    @staticmethod
+    def description():
+        return "A module sending the UpdateMessages it receives over TCP."
+
+    @staticmethod
+    def input_ius():
+        return [retico_core.IncrementalUnit]
+
+    def __init__(
+        self,
+        host,
+        port,
+        batch_interval=0.002,
+        max_batch_size=64,
+        max_queued=256,
+        connect_timeout=30.0,
+        send_timeout=5.0,
+        registry=None,
+        **kwargs,
+    ):
+        """Initializes the TCPBridgeSender.
+
+        Args:
+            host (str): host of the TCPBridgeReceiver.
+            port (int): port of the TCPBridgeReceiver.
+            batch_interval (float, optional): maximum time (in seconds)
+                an UpdateMessage waits for others to be sent in the same
+                batch. Defaults to 0.002.
+            max_batch_size (int, optional): maximum number of
+                UpdateMessages of a batch. Defaults to 64.
+            max_queued (int, optional): maximum number of UpdateMessages
+                waiting to be sent, process_update blocks when it is
+                reached. Defaults to 256.
+            connect_timeout (float, optional): time (in seconds) during
+                which the connection to the receiver is retried.
+                Defaults to 30.0.
+            send_timeout (float, optional): maximum time (in seconds)
+                process_update waits for a place in the full queue
+                before dropping the UpdateMessage, and a write to the
+                receiver can take before the bridge is considered
+                broken. Defaults to 5.0.
+            registry (IURegistry, optional): registry of the sent and
+                received IUs, the process's default one if None.
+                Defaults to None.
+        """
+        super().__init__(**kwargs)
+        self.host = host
+        self.port = port
+        self.batch_interval = batch_interval
+        self.max_batch_size = max_batch_size
+        self.connect_timeout = connect_timeout
+        self.send_timeout = send_timeout
+        self.serializer = IUSerializer(registry)
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.socket = None
+        self.n_ius = 0
+        self.n_dropped = 0
+        self.encoding_time = 0.0
+        self.broken = False
+        self._forwarding = False
+        self._sending_thread = None
+
+    def add_left_buffer(self, left_buffer):
+        """Adds a left buffer, whose UpdateMessages are queued as soon as
+        they are put in it."""
+        super().add_left_buffer(left_buffer)
+        left_buffer.put = self._forward
+
+    def _forward(self, update_message, block=True, timeout=None):
+        if self._forwarding:
+            self.process_update(update_message)
+
+    def connect(self):
+        """Connects to the receiver, retrying until connect_timeout."""
+        deadline = time.time() + self.connect_timeout
+        while True:
+            try:
+                self.socket = socket.create_connection((self.host, self.port))
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.settimeout(self.send_timeout)
+
+    def prepare_run(self):
+        """Connects to the receiver, and starts the sending thread."""
+        super().prepare_run()
+        self.connect()
+        self._sending_thread = threading.Thread(target=self._send_thread)
+        self._sending_thread.start()
+        self._forwarding = True
+
+    def process_update(self, update_message):
+        """Encodes the UpdateMessage, and queues it (blocking while the queue
+        is full, for at most send_timeout seconds). The UpdateMessage is
+        dropped if the queue stays full, or if the bridge is broken."""
+        if self.broken:
+            self.n_dropped += len(update_message)
+            return None
+        start = time.perf_counter()
+        data = self.serializer.encode_update_message(update_message)
+        self.encoding_time += time.perf_counter() - start
+        try:
+            self.queue.put(data, timeout=self.send_timeout)
+        except queue.Full:
+            self.n_dropped += len(update_message)
+            self.terminal_logger.warning("bridge_queue_full", n_dropped=self.n_dropped)
+            return None
+        self.n_ius += len(update_message)
+        return None
+
+    def _send_thread(self):
+        """Sends the queued UpdateMessages in batches, until None is
+        queued. Once a write failed, the queued UpdateMessages are dropped
+        instead of being sent."""
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get()]
+                deadline = time.perf_counter() + self.batch_interval
+                while len(batch) < self.max_batch_size and batch[-1] is not None:
+                    timeout = deadline - time.perf_counter()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(self.queue.get(timeout=timeout))
+                    except queue.Empty:
+                        break
+                if batch[-1] is None:
+                    running = False
+                    batch.pop()
+                if len(batch) == 0 or self.broken:
+                    continue
+                frame = bytearray(FRAME_HEADER.size)
+                for data in batch:
+                    frame += MESSAGE_HEADER.pack(len(data))
+                    frame += data
+                FRAME_HEADER.pack_into(
+                    frame, 0, len(frame) - FRAME_HEADER.size, len(batch)
+                )
+                self.socket.sendall(frame)
+            except OSError as e:
+                # the receiver is gone, or does not read in time
+                self.broken = True
+                self.terminal_logger.error(
+                    "bridge_broken", host=self.host, port=self.port
+                )
+                log_utils.log_exception(module=self, exception=e)
+            except Exception as e:
+                log_utils.log_exception(module=self, exception=e)
+
+    def shutdown(self):
+        """Sends the queued UpdateMessages (waiting at most send_timeout
+        seconds for a place in the queue, the queued UpdateMessages are
+        dropped otherwise), closes the connection, and logs the encoding
+        time per IU."""
+        super().shutdown()
+        self._forwarding = False
+        try:
+            self.queue.put(None, timeout=self.send_timeout)
+        except queue.Full:
+            # the sending thread only drops the queued UpdateMessages once
+            # the bridge is broken
+            self.broken = True
+            try:
+                self.queue.put(None, timeout=self.send_timeout)
+            except queue.Full:
+                self.terminal_logger.warning("bridge_shutdown_timeout")
+        self._sending_thread.join(2 * self.send_timeout)
+        self.socket.close()
+        self.socket = None
+        if self.n_ius != 0:
+            self.terminal_logger.info(
+                "bridge_encoding",
+                n_ius=self.n_ius,
+                us_per_iu=self.encoding_time / self.n_ius * 1e6,
+            )
+        if self.n_dropped != 0:
+            self.terminal_logger.warning("bridge_dropped", n_dropped=self.n_dropped)
+
+
+class TCPBridgeReceiver(retico_core.AbstractModule):
+    """A module appending the UpdateMessages received from a
+    TCPBridgeSender.
+
+    Attributes:
+        n_ius (int): number of received IUs.
+        decoding_time (float): total time (in seconds) spent decoding
+            them.
+    """
+
+    @staticmethod
+    def name():
+        return "TCP Bridge Receiver Module"
+
+    @staticmethod
+    def description():
+        return "A module appending the UpdateMessages received over TCP."
+
+    @staticmethod
+    def input_ius():
+        return []
+
+    @staticmethod
+    def output_iu():
+        return retico_core.IncrementalUnit
+
+    def __init__(self, port, host="0.0.0.0", registry=None, **kwargs):
+        """Initializes the TCPBridgeReceiver.
+
+        Args:
+            port (int): port to listen on.
+            host (str, optional): address to listen on. Defaults to
+                "0.0.0.0".
+            registry (IURegistry, optional): registry of the sent and
+                received IUs, the process's default one if None.
+                Defaults to None.
+        """
+        super().__init__(**kwargs)
+        self.port = port
+        self.host = host
+        self.serializer = IUSerializer(registry)
+        self.server_socket = None
+        self.connection = None
+        self.n_ius = 0
+        self.decoding_time = 0.0
+        self._receiving = False
+        self._receiving_thread = None
+
+    def setup(self):
+        """Listens on the port, so that the sender can connect before the
+        network is run."""
+        super().setup()
+        self.server_socket = socket.create_server((self.host, self.port))
+        self.server_socket.settimeout(0.2)
+
+    def prepare_run(self):
+        """Starts the receiving thread."""
+        super().prepare_run()
+        self._receiving = True
+        self._receiving_thread = threading.Thread(target=self._receive_thread)
+        self._receiving_thread.start()
+
+    def process_update(self, update_message):
+        return None
+
+    def _receive_thread(self):
+        """Accepts a sender's connection, and appends the UpdateMessages it
+        sends, until the module is stopped."""
+        while self._receiving:
+            try:
+                connection, _ = self.server_socket.accept()
+            except socket.timeout:
+                continue
+            connection.settimeout(None)
+            self.connection = connection
+            with connection:
+                self._receive_frames(connection)
+            self.connection = None
+
+    def _receive_frames(self, connection):
+        """Appends the UpdateMessages of the frames received on a
+        connection, until it is closed (by the sender, or at shutdown)."""
+        while True:
+            try:
+                header = recv_exactly(connection, FRAME_HEADER.size)
+                if header is None:
+                    return
+                length, n_messages = FRAME_HEADER.unpack(header)
+                payload = recv_exactly(connection, length)
+                if payload is None:
+                    return
+                view = memoryview(payload)
+                offset = 0
+                for _ in range(n_messages):
+                    (size,) = MESSAGE_HEADER.unpack_from(view, offset)
+                    offset += MESSAGE_HEADER.size
+                    start = time.perf_counter()
+                    um = self.serializer.decode_update_message(
+                        view[offset : offset + size]
+                    )
+                    self.decoding_time += time.perf_counter() - start
+                    self.n_ius += len(um)
+                    offset += size
+                    self.append(um)
+            except OSError:
+                return
+            except Exception as e:
+                log_utils.log_exception(module=self, exception=e)
+
+    def shutdown(self):
+        """Stops receiving, closes the sockets, and logs the decoding time
+        per IU."""
+        super().shutdown()
+        self._receiving = False
+        connection = self.connection
+        if connection is not None:
+            try:
+                # unblocks the receiving thread
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._receiving_thread.join()
+        self.server_socket.close()
+        self.server_socket = None
+        if self.n_ius != 0:
+            self.terminal_logger.info(
+                "bridge_decoding",
+                n_ius=self.n_ius,
+                us_per_iu=self.decoding_time / self.n_ius * 1e6,
+            )
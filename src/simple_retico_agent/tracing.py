@@ -0,0 +1,317 @@
+"""
+Tracing
+=======
+
+Opt-in per-IU latency tracing of a retico network, exported as a Chrome
+trace (JSON trace event format, that can be opened in Perfetto or
+chrome://tracing).
+
+The IUTracer instruments the modules of the network by wrapping their
+append and process_update methods : every appended IU is stamped with
+its append time and thread, every received IU with the time it is
+consumed by each module, and every process_update call is recorded as a
+span on the module's thread. The creation time of the IUs is their
+created_at attribute. The records are tuples appended to a bounded
+deque, the trace events are only built at export. The records do not
+keep the IUs (and their grounded_in chain and audio) alive : only their
+iuid, and at their append, their type, text, creation time and the
+iuid of the IU they are grounded in, are recorded.
+
+At export, the grounded_in chain of every agent BOT (the speaker's
+TextIU, grounded in the first AudioFinalIU of the turn, grounded in the
+TextFinalIU of the LLM, etc.) is rebuilt from the recorded iuids, and
+followed back to the user's audio, to
+give the turn's critical path : for every module of the chain, the time
+the grounding IU waited in the module's queue, and the time the module
+took to create its IU from it.
+
+.. code-block:: python
+
+    tracer = IUTracer()
+    tracer.instrument_network(mic)
+    network.run(mic)
+    ...
+    network.stop(mic)
+    tracer.export("trace.json")
+"""
+
+import collections
+import json
+import threading
+import time
+
+from retico_core import network
+
+
+class IUTracer:
+    """Records the creation, append and consumption times of the IUs of the
+    instrumented modules, and exports them as a Chrome trace.
+
+    Attributes:
+        records (collections.deque): the (time, kind, module name,
+            thread id, iuid, duration, IU info) records, the kinds being
+            "append", "consume" and "process", the IU info of the
+            "append" records being the (type name, text, created_at,
+            grounded_in iuid) of the IU.
+        thread_names (dict[int, str]): names of the recorded threads.
+    """
+
+    MODULES_PID = 1
+    TURNS_PID = 2
+
+    def __init__(self, max_records=1000000):
+        """Initializes the IUTracer.
+
+        Args:
+            max_records (int, optional): maximum number of records kept,
+                the oldest ones are dropped first. Defaults to 1000000.
+        """
+        self.records = collections.deque(maxlen=max_records)
+        self.thread_names = {}
+
+    def _thread(self):
+        """Returns the id of the current thread, storing its name."""
+        tid = threading.get_ident()
+        if tid not in self.thread_names:
+            self.thread_names[tid] = threading.current_thread().name
+        return tid
+
+    def instrument(self, module):
+        """Wraps the append and process_update methods of a module to record
+        its IUs.
+
+        Args:
+            module (retico_core.AbstractModule): the module.
+        """
+        name = module.name()
+        records = self.records
+        original_append = module.append
+        original_process_update = module.process_update
+
+        def append(update_message):
+            if update_message:
+                now = time.time()
+                tid = self._thread()
+                for iu, _ in update_message:
+                    text = getattr(iu, "text", None)
+                    grounded_in = iu.grounded_in
+                    info = (
+                        type(iu).__name__,
+                        text if isinstance(text, str) else None,
+                        iu.created_at,
+                        grounded_in.iuid if grounded_in is not None else None,
+                    )
+                    records.append((now, "append", name, tid, iu.iuid, 0.0, info))
+            return original_append(update_message)
+
+        def process_update(update_message):
+            # producing modules are called continuously without input
+            if update_message is None:
+                return original_process_update(update_message)
+            start = time.time()
+            try:
+                return original_process_update(update_message)
+            finally:
+                end = time.time()
+                tid = self._thread()
+                for iu, _ in update_message:
+                    records.append((start, "consume", name, tid, iu.iuid, 0.0, None))
+                records.append(
+                    (start, "process", name, tid, None, end - start, None)
+                )
+
+        module.append = append
+        module.process_update = process_update
+
+    def instrument_network(self, module):
+        """Instruments all the modules of a network.
+
+        Args:
+            module (retico_core.AbstractModule): a module of the network.
+        """
+        modules, _ = network.discover(module)
+        for m in modules:
+            self.instrument(m)
+
+    @staticmethod
+    def iu_label(info):
+        """Returns a short description of an IU.
+
+        Args:
+            info (tuple): the recorded (type name, text, created_at,
+                grounded_in iuid) of the IU.
+
+        Returns:
+            str: the description.
+        """
+        type_name, text, _, _ = info
+        return f"{type_name} '{text}'" if text is not None else type_name
+
+    def get_critical_paths(self, ius, append_times, consume_times):
+        """Follows the grounded_in chain of every agent BOT, and returns the
+        spans of the turns' critical paths.
+
+        An IU can be appended and consumed several times (e.g. ADD then
+        COMMIT), the latest consumption before the creation of the next
+        IU of the chain is used.
+
+        Args:
+            ius (dict[str, tuple]): the (IU info, creating module name)
+                of the appended IUs, by iuid.
+            append_times (dict[str, list[float]]): the append times of the
+                IUs, by iuid.
+            consume_times (dict[tuple[str, str], list[float]]): the times
+                the IUs are consumed, by iuid and module name.
+
+        Returns:
+            list[list[tuple[str, float, float, dict]]]: the (name, start,
+                end, args) spans of every turn.
+        """
+        bots = [iuid for iuid, (info, _) in ius.items() if info[1] == "agent_BOT"]
+        turns = []
+        for bot in bots:
+            chain = [bot]
+            while len(chain) < 32:
+                parent = ius[chain[-1]][0][3]
+                if parent is None or parent not in ius or parent in chain:
+                    break
+                chain.append(parent)
+            chain.reverse()
+            spans = []
+            for parent, child in zip(chain[:-1], chain[1:]):
+                child_info, module = ius[child]
+                created_at = child_info[2]
+                consumed = max(
+                    [
+                        t
+                        for t in consume_times.get((parent, module), [])
+                        if t <= created_at
+                    ],
+                    default=created_at,
+                )
+                appended = max(
+                    [t for t in append_times.get(parent, []) if t <= consumed],
+                    default=consumed,
+                )
+                args = {
+                    "from": self.iu_label(ius[parent][0]),
+                    "to": self.iu_label(child_info),
+                }
+                if consumed > appended:
+                    spans.append((f"{module} queue", appended, consumed, args))
+                spans.append((module, consumed, created_at, args))
+            turns.append(spans)
+        return turns
+
+    def to_chrome_trace(self):
+        """Builds the Chrome trace events of the records. Should be called
+        once the network is stopped.
+
+        Returns:
+            dict: the Chrome trace.
+        """
+        records = list(self.records)
+        if len(records) == 0:
+            return {"traceEvents": []}
+        t0 = min(r[0] for r in records)
+
+        def us(t):
+            return round((t - t0) * 1e6, 1)
+
+        events = [
+            {
+                "ph": "M",
+                "name": "process_name",
+                "pid": self.MODULES_PID,
+                "args": {"name": "modules"},
+            },
+            {
+                "ph": "M",
+                "name": "process_name",
+                "pid": self.TURNS_PID,
+                "args": {"name": "agent turns critical path"},
+            },
+        ]
+        for tid, name in self.thread_names.items():
+            events.append(
+                {
+                    "ph": "M",
+                    "name": "thread_name",
+                    "pid": self.MODULES_PID,
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+            )
+
+        ius = {}
+        append_times = {}
+        consume_times = {}
+        for t, kind, module, tid, iuid, duration, info in records:
+            if kind == "process":
+                events.append(
+                    {
+                        "ph": "X",
+                        "name": f"{module}.process_update",
+                        "cat": "process",
+                        "ts": us(t),
+                        "dur": round(duration * 1e6, 1),
+                        "pid": self.MODULES_PID,
+                        "tid": tid,
+                    }
+                )
+            elif kind == "append":
+                ius.setdefault(iuid, (info, module))
+                append_times.setdefault(iuid, []).append(t)
+                events.append(
+                    {
+                        "ph": "i",
+                        "s": "t",
+                        "name": f"append {self.iu_label(info)}",
+                        "cat": "append",
+                        "ts": us(t),
+                        "pid": self.MODULES_PID,
+                        "tid": tid,
+                        "args": {
+                            "module": module,
+                            "iuid": str(iuid),
+                            "age_ms": (t - info[2]) * 1000,
+                        },
+                    }
+                )
+            else:
+                consume_times.setdefault((iuid, module), []).append(t)
+
+        critical_paths = self.get_critical_paths(ius, append_times, consume_times)
+        for i, spans in enumerate(critical_paths):
+            events.append(
+                {
+                    "ph": "M",
+                    "name": "thread_name",
+                    "pid": self.TURNS_PID,
+                    "tid": i,
+                    "args": {"name": f"agent turn {i}"},
+                }
+            )
+            for name, start, end, args in spans:
+                events.append(
+                    {
+                        "ph": "X",
+                        "name": name,
+                        "cat": "critical_path",
+                        "ts": us(start),
+                        "dur": round(max(end - start, 0.0) * 1e6, 1),
+                        "pid": self.TURNS_PID,
+                        "tid": i,
+                        "args": args,
+                    }
+                )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export(self, path):
+        """Writes the Chrome trace to a JSON file.
+
+        Args:
+            path (str): path of the file.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_chrome_trace(), f)
@@ -0,0 +1,200 @@
+"""
+TTSPhraseCache
+==============
+
+A cache of the audio synthesized by the SimpleTTSModule, so that the
+clauses the agent says many times ("Very good!", "Let's try another
+one.") are only synthesized once.
+
+The synthesized audio is stored as int16 buffers, keyed by the
+normalized text of the clause, the name of the TTS model and the
+speaker. The cache keeps the most recently used buffers in memory, up to
+a byte budget (least recently used buffers are evicted first), and can
+also store them on disk as raw int16 files, that are loaded back through
+mmap.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+
+
+class TTSPhraseCache:
+    """LRU cache of synthesized audio, with a byte budget and an optional
+    on-disk store. It can be shared by several threads.
+
+    Attributes:
+        n_hits (int): number of cache hits.
+        n_misses (int): number of cache misses.
+        saved_time (float): synthesis time (in seconds) saved by the
+            cache hits.
+    """
+
+    def __init__(self, max_bytes=50 * 2**20, cache_dir=None):
+        """Initializes the TTSPhraseCache.
+
+        Args:
+            max_bytes (int, optional): maximum number of bytes of audio
+                kept in memory. Defaults to 50 * 2**20.
+            cache_dir (str, optional): directory of the on-disk store,
+                None disables it. Defaults to None.
+        """
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        # key -> (int16 buffer, synthesis time)
+        self.entries = collections.OrderedDict()
+        self.n_bytes = 0
+        self.n_hits = 0
+        self.n_misses = 0
+        self.saved_time = 0.0
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def normalize(text):
+        """Normalizes a clause text : lowercase, without leading, trailing
+        and repeated whitespaces (the punctuation, that changes the
+        prosody, is kept).
+
+        Args:
+            text (str): the clause text.
+
+        Returns:
+            str: the normalized text.
+        """
+        return " ".join(text.lower().split())
+
+    def make_key(self, text, model_name, speaker=None):
+        """Returns the cache key of a clause, synthesized by a model with a
+        speaker.
+
+        Args:
+            text (str): the clause text.
+            model_name (str): name of the TTS model.
+            speaker (str, optional): the speaker (or speaker wav file).
+                Defaults to None.
+
+        Returns:
+            str: the key.
+        """
+        description = f"{model_name}|{speaker}|{self.normalize(text)}"
+        return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Returns the audio of a key, from memory or from the on-disk store,
+        and updates the cache statistics.
+
+        Args:
+            key (str): the key.
+
+        Returns:
+            np.ndarray: the int16 audio, or None if it is not cached.
+        """
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                buffer, synthesis_time = self.entries[key]
+            else:
+                buffer, synthesis_time = self.load(key)
+                if buffer is None:
+                    self.n_misses += 1
+                    return None
+                self.add_entry(key, buffer, synthesis_time)
+            self.n_hits += 1
+            self.saved_time += synthesis_time
+            return buffer
+
+    def put(self, key, buffer, synthesis_time, text=None):
+        """Adds the audio of a key to the cache (and to the on-disk store).
+
+        Args:
+            key (str): the key.
+            buffer (np.ndarray): the int16 audio.
+            synthesis_time (float): time (in seconds) needed to
+                synthesize the audio.
+            text (str, optional): the clause text, stored in the on-disk
+                metadata. Defaults to None.
+        """
+        with self._lock:
+            self.add_entry(key, buffer, synthesis_time)
+            if self.cache_dir is not None:
+                self.save(key, buffer, synthesis_time, text)
+
+    def add_entry(self, key, buffer, synthesis_time):
+        """Adds an entry to the in-memory LRU, and evicts the least recently
+        used entries if the byte budget is exceeded.
+
+        Args:
+            key (str): the key.
+            buffer (np.ndarray): the int16 audio.
+            synthesis_time (float): time needed to synthesize the audio.
+        """
+        if buffer.nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.n_bytes -= self.entries.pop(key)[0].nbytes
+        self.entries[key] = (buffer, synthesis_time)
+        self.n_bytes += buffer.nbytes
+        while self.n_bytes > self.max_bytes:
+            _, (evicted, _) = self.entries.popitem(last=False)
+            self.n_bytes -= evicted.nbytes
+
+    def save(self, key, buffer, synthesis_time, text=None):
+        """Writes the audio of a key to the on-disk store, as a raw int16
+        file and a json metadata file.
+
+        Args:
+            key (str): the key.
+            buffer (np.ndarray): the int16 audio.
+            synthesis_time (float): time needed to synthesize the audio.
+            text (str, optional): the clause text. Defaults to None.
+        """
+        path = os.path.join(self.cache_dir, key)
+        with open(path + ".json", "w", encoding="utf-8") as f:
+            json.dump({"text": text, "synthesis_time": synthesis_time}, f)
+        # written to a temporary file first, so that a partially written file
+        # is never loaded
+        with open(path + ".raw.tmp", "wb") as f:
+            f.write(memoryview(buffer).cast("B"))
+        os.replace(path + ".raw.tmp", path + ".raw")
+
+    def load(self, key):
+        """Loads the audio of a key from the on-disk store, through mmap.
+
+        Args:
+            key (str): the key.
+
+        Returns:
+            (np.ndarray, float): the int16 audio and its synthesis time,
+                or (None, None) if it is not stored.
+        """
+        if self.cache_dir is None:
+            return None, None
+        path = os.path.join(self.cache_dir, key)
+        if not os.path.exists(path + ".raw") or os.path.getsize(path + ".raw") == 0:
+            return None, None
+        synthesis_time = 0.0
+        if os.path.exists(path + ".json"):
+            with open(path + ".json", encoding="utf-8") as f:
+                synthesis_time = json.load(f).get("synthesis_time", 0.0)
+        return np.memmap(path + ".raw", dtype=np.int16, mode="r"), synthesis_time
+
+    def get_stats(self):
+        """Returns the cache statistics.
+
+        Returns:
+            dict: the statistics.
+        """
+        n_requests = self.n_hits + self.n_misses
+        return {
+            "n_hits": self.n_hits,
+            "n_misses": self.n_misses,
+            "hit_rate": self.n_hits / n_requests if n_requests else None,
+            "saved_time": self.saved_time,
+            "n_entries": len(self.entries),
+            "n_bytes": self.n_bytes,
+        }
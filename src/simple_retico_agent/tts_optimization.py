@@ -0,0 +1,119 @@
+"""
+TTS Optimization
+================
+
+Optimized CPU inference modes for the coqui-ai TTS models used by the
+SimpleTTSModule :
+
+- "int8" : dynamic int8 quantization of the Linear and LSTM layers of
+  the model (not cached : quantize_dynamic has to be applied to the
+  loaded fp32 model anyway to build the quantized modules, so loading
+  cached quantized weights would not save any work).
+- "compile" : torch.compile of the waveform decoder (the compiled
+  kernels are cached on disk by TorchInductor's FX graph cache).
+- "torchscript" : TorchScript trace of the waveform decoder (the traced
+  decoder is cached on disk), for single-speaker VITS models.
+
+The waveform decoder (HiFi-GAN) takes most of the synthesis time of the
+VITS models, and being only made of convolutions, it does not benefit
+from the dynamic quantization, which only targets the text encoder and
+duration predictor layers.
+"""
+
+import os
+import torch
+
+OPTIMIZATION_MODES = ("int8", "compile", "torchscript")
+
+
+class TracedDecoder(torch.nn.Module):
+    """Wraps a traced waveform decoder, to keep the decoder(z, g=g) call
+    signature of the VITS models."""
+
+    def __init__(self, traced):
+        super().__init__()
+        self.traced = traced
+
+    def forward(self, z, g=None):
+        return self.traced(z)
+
+
+def get_cache_path(cache_dir, model_name, mode):
+    """Returns the path of the cached optimized artefact of a model.
+
+    Args:
+        cache_dir (str): the cache directory.
+        model_name (str): name of the TTS model.
+        mode (str): the optimization mode.
+
+    Returns:
+        str: the path.
+    """
+    name = model_name.replace("/", "--")
+    return os.path.join(cache_dir, f"{name}.{mode}.torch-{torch.__version__}.pt")
+
+
+def optimize_tts_model(tts_model, mode, model_name, cache_dir=None):
+    """Applies an optimized inference mode to a coqui-ai TTS model, loading
+    the optimized artefact from the cache if it exists.
+
+    Args:
+        tts_model (torch.nn.Module): the TTS model (the synthesizer's
+            tts_model).
+        mode (str): "int8", "compile" or "torchscript".
+        model_name (str): name of the TTS model, used to name the cached
+            artefact.
+        cache_dir (str, optional): directory of the cached artefacts
+            (of the "compile" and "torchscript" modes), None disables the
+            cache. Defaults to None.
+
+    Returns:
+        torch.nn.Module: the optimized TTS model.
+    """
+    if mode not in OPTIMIZATION_MODES:
+        raise ValueError(f"unknown optimization mode : {mode}")
+    cache_path = None
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = get_cache_path(cache_dir, model_name, mode)
+
+    tts_model.eval()
+    if mode == "int8":
+        layers = {torch.nn.Linear, torch.nn.LSTM}
+        return torch.ao.quantization.quantize_dynamic(
+            tts_model, layers, dtype=torch.qint8, inplace=True
+        )
+
+    if not hasattr(tts_model, "waveform_decoder"):
+        raise ValueError(
+            f"{mode} optimization is only supported for VITS models"
+        )
+
+    if mode == "compile":
+        if cache_dir is not None:
+            os.environ.setdefault(
+                "TORCHINDUCTOR_CACHE_DIR", os.path.join(cache_dir, "inductor")
+            )
+            torch._inductor.config.fx_graph_cache = True
+        tts_model.waveform_decoder = torch.compile(
+            tts_model.waveform_decoder, dynamic=True
+        )
+        return tts_model
+
+    # torchscript
+    if getattr(tts_model, "num_speakers", 0) > 1:
+        raise ValueError(
+            "torchscript optimization is only supported for single-speaker models"
+        )
+    if cache_path is not None and os.path.exists(cache_path):
+        traced = torch.jit.load(cache_path)
+    else:
+        decoder = tts_model.waveform_decoder
+        device = next(decoder.parameters()).device
+        example = torch.randn(1, decoder.conv_pre.in_channels, 100, device=device)
+        with torch.no_grad():
+            traced = torch.jit.trace(decoder, example)
+        if cache_path is not None:
+            torch.jit.save(traced, cache_path)
+    tts_model.waveform_decoder = TracedDecoder(traced)
+    return tts_model
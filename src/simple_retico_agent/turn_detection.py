@@ -0,0 +1,493 @@
+"""
+Turn Detection
+==============
+
+Components predicting the user Beginning-Of-Turn (BOT) and End-Of-Turn
+(EOT) from the voice activity (VA) of the VADIUs received.
+
+The VATurnDetector is updated once per VADIU, and keeps running
+counters of the user VA over the BOT and EOT windows in fixed-size ring
+arrays, so that every turn-taking decision costs O(1) per audio chunk,
+and is taken as soon as the VADIU is received (event-driven) instead of
+being recalculated periodically over the whole audio buffer.
+
+The AdaptiveEndpointer complements it by predicting early user EOTs from
+the ASR hypotheses, and recorded sessions can be replayed to evaluate
+the latency it saves against the premature cut-offs it causes.
+"""
+
+import json
+import threading
+
+
+class RingCounter:
+    """Fixed-size ring array of booleans, keeping a running count of the
+    True values it contains."""
+
+    def __init__(self, size):
+        """Initializes the RingCounter.
+
+        Args:
+            size (int): number of values in the ring array.
+        """
+        self.size = max(int(size), 1)
+        self.values = bytearray(self.size)
+        self.index = 0
+        self.count = 0
+        self.n_values = 0
+
+    def push(self, value):
+        """Adds a value to the ring array, replacing the oldest one if the
+        array is full, and updates the running count.
+
+        Args:
+            value (bool): the new value.
+        """
+        value = 1 if value else 0
+        self.count += value - self.values[self.index]
+        self.values[self.index] = value
+        self.index = (self.index + 1) % self.size
+        if self.n_values < self.size:
+            self.n_values += 1
+
+    def is_full(self):
+        """Returns True if the ring array has received at least size values.
+
+        Returns:
+            bool: True if the ring array is full.
+        """
+        return self.n_values == self.size
+
+    def reset(self):
+        """Empties the ring array."""
+        self.values = bytearray(self.size)
+        self.index = 0
+        self.count = 0
+        self.n_values = 0
+
+
+class VATurnDetector:
+    """Predicts user BOT and EOT from the user VA of each audio chunk.
+
+    A user BOT is predicted if, across the chunks corresponding to the
+    last bot_dur seconds of audio, more than bot_threshold contain
+    speech, and a user EOT is predicted if, across the chunks
+    corresponding to the last eot_dur seconds, more than eot_threshold
+    do not contain speech. The two different thresholds and windows
+    provide an hysteresis between the two states, and the
+    min_turn_dur and min_silence_dur rules prevent the detector from
+    switching back too quickly after a BOT or an EOT.
+
+    Attributes:
+        state (str): "user_silent" or "user_speaking".
+        silence_run (int): number of consecutive chunks without speech.
+    """
+
+    def __init__(
+        self,
+        bot_dur=0.4,
+        bot_threshold=0.75,
+        eot_dur=1,
+        eot_threshold=0.75,
+        min_turn_dur=0.0,
+        min_silence_dur=0.0,
+    ):
+        """Initializes the VATurnDetector.
+
+        Args:
+            bot_dur (float, optional): Duration of the time interval
+                over which the user's BOT will be calculated. Defaults
+                to 0.4.
+            bot_threshold (float, optional): share of chunks in the
+                last bot_dur seconds to present positive VA to predict
+                user BOT. Defaults to 0.75.
+            eot_dur (float, optional): Duration of the time interval
+                over which the user's EOT will be calculated. Defaults
+                to 1.
+            eot_threshold (float, optional): share of chunks in the
+                last eot_dur seconds to present negative VA to predict
+                user EOT. Defaults to 0.75.
+            min_turn_dur (float, optional): minimum duration of a user
+                turn, no EOT is predicted less than min_turn_dur
+                seconds after the BOT. Defaults to 0.0.
+            min_silence_dur (float, optional): minimum duration of a
+                user silence, no BOT is predicted less than
+                min_silence_dur seconds after the EOT. Defaults to 0.0.
+        """
+        self.bot_dur = bot_dur
+        self.bot_threshold = bot_threshold
+        self.eot_dur = eot_dur
+        self.eot_threshold = eot_threshold
+        self.min_turn_dur = min_turn_dur
+        self.min_silence_dur = min_silence_dur
+
+        self.chunk_duration = None
+        self.bot_window = None
+        self.eot_window = None
+        self._n_bot_speech_chunks = None
+        self._n_eot_silence_chunks = None
+        self._n_min_turn_chunks = None
+        self._n_min_silence_chunks = None
+
+        self.state = "user_silent"
+        self.n_chunks_in_state = 0
+        self.silence_run = 0
+
+    def configure(self, chunk_duration):
+        """Calculates the number of chunks of each window and rule from the
+        audio chunk duration, and allocates the ring arrays.
+
+        Args:
+            chunk_duration (float): duration of one audio chunk, in
+                seconds.
+        """
+        self.chunk_duration = chunk_duration
+        n_bot_chunks = int(self.bot_dur / chunk_duration)
+        n_eot_chunks = int(self.eot_dur / chunk_duration)
+        self.bot_window = RingCounter(n_bot_chunks)
+        self.eot_window = RingCounter(n_eot_chunks)
+        self._n_bot_speech_chunks = int(self.bot_threshold * self.bot_window.size)
+        self._n_eot_silence_chunks = int(self.eot_threshold * self.eot_window.size)
+        self._n_min_turn_chunks = int(self.min_turn_dur / chunk_duration)
+        self._n_min_silence_chunks = int(self.min_silence_dur / chunk_duration)
+
+    def n_chunks(self, duration):
+        """Returns the number of audio chunks corresponding to duration.
+
+        Args:
+            duration (float): duration in second.
+
+        Returns:
+            int: the number of audio chunks corresponding to duration.
+        """
+        if self.chunk_duration is None:
+            return None
+        return int(duration / self.chunk_duration)
+
+    def silence_run_duration(self):
+        """Returns the duration of the current run of chunks without speech.
+
+        Returns:
+            float: the duration in seconds.
+        """
+        if self.chunk_duration is None:
+            return 0.0
+        return self.silence_run * self.chunk_duration
+
+    def update(self, va_user, chunk_duration):
+        """Updates the running counters with the user VA of a new audio
+        chunk, and returns the turn-taking event it triggered, if any. A chunk
+        longer than the configured chunk_duration (the VAD re-framing can
+        produce chunks with a varying number of frames) is counted as the
+        corresponding number of chunks.
+
+        Args:
+            va_user (bool): user VA of the new audio chunk.
+            chunk_duration (float): duration of the audio chunk, in
+                seconds.
+
+        Returns:
+            str: "user_BOT", "user_EOT", or None.
+        """
+        if self.chunk_duration is None:
+            self.configure(chunk_duration)
+
+        n_chunks = max(1, round(chunk_duration / self.chunk_duration))
+        for _ in range(n_chunks):
+            self.bot_window.push(va_user)
+            self.eot_window.push(not va_user)
+        self.silence_run = 0 if va_user else self.silence_run + n_chunks
+        self.n_chunks_in_state += n_chunks
+
+        if self.state == "user_silent":
+            if (
+                self.bot_window.is_full()
+                and self.bot_window.count >= self._n_bot_speech_chunks
+                and self.n_chunks_in_state >= self._n_min_silence_chunks
+            ):
+                self.set_state("user_speaking")
+                return "user_BOT"
+        elif (
+            self.eot_window.is_full()
+            and self.eot_window.count >= self._n_eot_silence_chunks
+            and self.n_chunks_in_state >= self._n_min_turn_chunks
+        ):
+            self.set_state("user_silent")
+            return "user_EOT"
+        return None
+
+    def set_state(self, state):
+        """Sets the detector state, and empties the window used to detect the
+        next transition, so that it is only calculated on audio chunks
+        received after the current transition.
+
+        Args:
+            state (str): "user_silent" or "user_speaking".
+        """
+        self.state = state
+        self.n_chunks_in_state = 0
+        if self.bot_window is not None:
+            if state == "user_silent":
+                self.bot_window.reset()
+            else:
+                self.eot_window.reset()
+
+
+class AdaptiveEndpointer:
+    """Predicts early user EOT, before the VATurnDetector's fixed EOT window
+    is complete, by combining the duration of the current silence with
+    signals from the ASR hypotheses : whether the latest hypothesis ends
+    with a terminal punctuation, and whether it has been stable across
+    the last hypotheses.
+
+    A user EOT is predicted if the user has been silent for
+    min_silence_dur seconds and the latest hypothesis both ends with a
+    terminal punctuation and is stable, or if the user has been silent
+    for mid_silence_dur seconds and one of the two conditions is met.
+    Otherwise, the VATurnDetector's EOT is used as a fallback.
+    """
+
+    TERMINAL_PUNCTUATION = (".", "!", "?")
+
+    def __init__(
+        self,
+        min_silence_dur=0.3,
+        mid_silence_dur=0.6,
+        n_stable_hypotheses=2,
+    ):
+        """Initializes the AdaptiveEndpointer.
+
+        Args:
+            min_silence_dur (float, optional): minimum silence duration
+                to predict an EOT when both hypothesis conditions are
+                met. Defaults to 0.3.
+            mid_silence_dur (float, optional): minimum silence duration
+                to predict an EOT when only one hypothesis condition is
+                met. Defaults to 0.6.
+            n_stable_hypotheses (int, optional): number of consecutive
+                identical hypotheses for the hypothesis to be considered
+                stable. Defaults to 2.
+        """
+        self.min_silence_dur = min_silence_dur
+        self.mid_silence_dur = mid_silence_dur
+        self.n_stable_hypotheses = n_stable_hypotheses
+        self.hypothesis = None
+        self.n_identical_hypotheses = 0
+
+    def reset(self):
+        """Forgets the hypotheses of the previous user turn."""
+        self.hypothesis = None
+        self.n_identical_hypotheses = 0
+
+    def update_hypothesis(self, hypothesis):
+        """Registers the latest ASR hypothesis.
+
+        Args:
+            hypothesis (str): the latest ASR hypothesis.
+        """
+        hypothesis = hypothesis.strip()
+        if hypothesis == self.hypothesis:
+            self.n_identical_hypotheses += 1
+        else:
+            self.hypothesis = hypothesis
+            self.n_identical_hypotheses = 1
+
+    def is_terminal(self):
+        """Returns True if the latest hypothesis ends with a terminal
+        punctuation.
+
+        Returns:
+            bool: True if the hypothesis is terminal.
+        """
+        return self.hypothesis is not None and self.hypothesis.endswith(
+            self.TERMINAL_PUNCTUATION
+        )
+
+    def is_stable(self):
+        """Returns True if the latest hypothesis has been stable across the
+        last n_stable_hypotheses hypotheses.
+
+        Returns:
+            bool: True if the hypothesis is stable.
+        """
+        return self.n_identical_hypotheses >= self.n_stable_hypotheses
+
+    def is_endpoint(self, silence_duration):
+        """Returns the early user EOT prediction.
+
+        Args:
+            silence_duration (float): duration of the current user
+                silence, in seconds.
+
+        Returns:
+            bool: True if an early user EOT is predicted.
+        """
+        if not self.hypothesis:
+            return False
+        terminal, stable = self.is_terminal(), self.is_stable()
+        if silence_duration >= self.min_silence_dur and terminal and stable:
+            return True
+        if silence_duration >= self.mid_silence_dur and (terminal or stable):
+            return True
+        return False
+
+
+class SessionRecorder:
+    """Records the user VA of every audio chunk and the ASR hypotheses of a
+    session in a JSON lines file, so that the session can be replayed to
+    evaluate turn-taking strategies (cf. replay_endpointing).
+
+    The chunks and the hypotheses are recorded from different threads
+    (the module's process_update and its ASR thread), the writes are
+    serialized with a lock.
+    """
+
+    def __init__(self, path):
+        """Initializes the SessionRecorder.
+
+        Args:
+            path (str): path to the JSON lines file.
+        """
+        self.path = path
+        self.file = None
+        self.n_chunks = 0
+        self._lock = threading.Lock()
+
+    def record_chunk(self, va_user, chunk_duration):
+        """Records the user VA of an audio chunk.
+
+        Args:
+            va_user (bool): user VA of the audio chunk.
+            chunk_duration (float): duration of the audio chunk (the VAD
+                re-framing can produce chunks of varying durations).
+        """
+        with self._lock:
+            if self.file is None:
+                self.file = open(self.path, "w", encoding="utf-8")
+            self.file.write(
+                json.dumps({"va": int(bool(va_user)), "duration": chunk_duration})
+                + "\n"
+            )
+            self.n_chunks += 1
+
+    def record_hypothesis(self, hypothesis):
+        """Records an ASR hypothesis, made after the last recorded chunk.
+
+        Args:
+            hypothesis (str): the ASR hypothesis.
+        """
+        with self._lock:
+            if self.file is not None:
+                self.file.write(
+                    json.dumps({"chunk": self.n_chunks, "hypothesis": hypothesis})
+                    + "\n"
+                )
+
+    def close(self):
+        """Closes the JSON lines file."""
+        with self._lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def load_session(path):
+    """Loads a session recorded by a SessionRecorder.
+
+    Args:
+        path (str): path to the JSON lines file.
+
+    Returns:
+        (list[float], list[bool], dict[int, list[str]]): the duration
+            and the user VA of every chunk, and the hypotheses (in order)
+            by number of chunks recorded before them.
+    """
+    chunk_duration = None
+    chunk_durations = []
+    va_user = []
+    hypotheses = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if "chunk_duration" in record:
+                # sessions recorded with a single chunk duration
+                chunk_duration = record["chunk_duration"]
+            elif "va" in record:
+                va_user.append(bool(record["va"]))
+                chunk_durations.append(record.get("duration", chunk_duration))
+            else:
+                hypotheses.setdefault(record["chunk"], []).append(
+                    record["hypothesis"]
+                )
+    return chunk_durations, va_user, hypotheses
+
+
+def replay_endpointing(path, detector_kwargs=None, endpointer_kwargs=None):
+    """Replays a recorded session with the fixed VATurnDetector EOT, and
+    with the AdaptiveEndpointer, and compares their user EOTs.
+
+    For every user turn recognized with the fixed EOT, the first early
+    EOT of the adaptive strategy in this turn is considered a premature
+    cut-off if the user speaks again before the fixed EOT, otherwise the
+    latency saved is the time between the two EOTs.
+
+    As in the SimpleWhisperASRModule, the early EOT is only predicted
+    after each recorded hypothesis, with the silence duration at the time
+    the hypothesis was made.
+
+    Args:
+        path (str): path to the session JSON lines file.
+        detector_kwargs (dict, optional): VATurnDetector parameters.
+            Defaults to None.
+        endpointer_kwargs (dict, optional): AdaptiveEndpointer
+            parameters. Defaults to None.
+
+    Returns:
+        dict: the number of turns, the latency saved on each turn (in
+            seconds) and the number of premature cut-offs.
+    """
+    detector_kwargs = detector_kwargs or {}
+    endpointer_kwargs = endpointer_kwargs or {}
+    chunk_durations, va_user, hypotheses = load_session(path)
+
+    fixed = VATurnDetector(**detector_kwargs)
+    adaptive = VATurnDetector(**detector_kwargs)
+    endpointer = AdaptiveEndpointer(**endpointer_kwargs)
+    fixed_turns, adaptive_eots = [], []
+    bot_chunk = None
+    for i, va in enumerate(va_user):
+        event = fixed.update(va, chunk_durations[i])
+        if event == "user_BOT":
+            bot_chunk = i
+        elif event == "user_EOT":
+            fixed_turns.append((bot_chunk, i))
+
+        event = adaptive.update(va, chunk_durations[i])
+        if event == "user_BOT":
+            endpointer.reset()
+        elif event == "user_EOT":
+            adaptive_eots.append(i)
+        for hypothesis in hypotheses.get(i + 1, []):
+            if adaptive.state != "user_speaking":
+                break
+            endpointer.update_hypothesis(hypothesis)
+            if endpointer.is_endpoint(adaptive.silence_run_duration()):
+                adaptive.set_state("user_silent")
+                adaptive_eots.append(i)
+
+    latencies_saved, n_premature = [], 0
+    for bot, eot in fixed_turns:
+        early_eots = [e for e in adaptive_eots if bot < e <= eot]
+        if len(early_eots) == 0:
+            continue
+        if any(va_user[early_eots[0] + 1 : eot + 1]):
+            n_premature += 1
+        else:
+            latencies_saved.append(
+                float(sum(chunk_durations[early_eots[0] + 1 : eot + 1]))
+            )
+    return {
+        "n_turns": len(fixed_turns),
+        "latencies_saved": latencies_saved,
+        "n_premature": n_premature,
+    }
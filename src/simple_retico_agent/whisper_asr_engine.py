@@ -0,0 +1,346 @@
+"""
+WhisperASREngine
+================
+
+A Whisper inference engine that can be shared by several
+SimpleWhisperASRModules (one per audio stream, e.g. one per microphone
+in concurrent dialogues), so that only one WhisperModel is loaded, and
+the hypothesis requests from the different streams are batched together
+into a single CTranslate2 call.
+
+The requests are processed by priority : the final hypothesis requests
+(sent by an ASR module once it recognized the user EOT) are always
+processed before the interim ones. The engine also keeps track of the
+per-stream latency (from request submission to result) and of the
+aggregate real-time factor (computation time / audio duration), that can
+be retrieved with get_stats.
+
+The faster_whisper library is used to speed up the whisper inference.
+"""
+
+import collections
+import itertools
+import queue
+import threading
+import time
+import numpy as np
+from faster_whisper import WhisperModel
+from faster_whisper.tokenizer import Tokenizer
+
+from simple_retico_agent.utils import device_definition
+
+
+class ASRRequest:
+    """A transcription request submitted to the WhisperASREngine by an audio
+    stream.
+
+    Attributes:
+        stream_id (str): id of the stream that submitted the request.
+        audio (np.ndarray): 16kHz float32 audio to transcribe.
+        final (bool): True if it is a final hypothesis request.
+        submitted_at (float): time of submission.
+        transcription (str): the result, set once the request is
+            processed.
+        done (threading.Event): set once the request is processed.
+    """
+
+    def __init__(self, stream_id, audio, final):
+        self.stream_id = stream_id
+        self.audio = audio
+        self.final = final
+        self.submitted_at = time.perf_counter()
+        self.transcription = None
+        self.exception = None
+        self.done = threading.Event()
+
+
+class WhisperASREngine:
+    """Shared Whisper inference engine, batching the transcription requests
+    coming from multiple audio streams into a single CTranslate2 call, with
+    priority given to final hypothesis requests."""
+
+    SAMPLERATE = 16000
+
+    def __init__(
+        self,
+        whisper_model="distil-large-v2",
+        device=None,
+        compute_type="int8",
+        language="en",
+        max_batch_size=8,
+        batch_timeout=0.01,
+        beam_size=1,
+        stats_window=1000,
+    ):
+        """Initializes the WhisperASREngine.
+
+        Args:
+            whisper_model (str, optional): name of the desired model,
+                has to correspond to a model in the faster_whisper
+                library. Defaults to "distil-large-v2".
+            device (str, optional): wether the model will be executed
+                on cpu or gpu (using "cuda"). Defaults to None.
+            compute_type (str, optional): CTranslate2 compute type.
+                Defaults to "int8".
+            language (str, optional): language of the transcriptions,
+                it is fixed to avoid a language detection pass on every
+                batch. Defaults to "en".
+            max_batch_size (int, optional): maximum number of requests
+                batched together. Defaults to 8.
+            batch_timeout (float, optional): maximum time (in seconds)
+                to wait for other requests once a first request has been
+                received, before running the batch. Defaults to 0.01.
+            beam_size (int, optional): beam size of the decoding.
+                Defaults to 1.
+            stats_window (int, optional): number of latest requests
+                kept per stream to compute the statistics. Defaults to
+                1000.
+        """
+        self.device = device_definition(device)
+        self.model = WhisperModel(
+            whisper_model, device=self.device, compute_type=compute_type
+        )
+        self.tokenizer = Tokenizer(
+            self.model.hf_tokenizer,
+            self.model.model.is_multilingual,
+            task="transcribe",
+            language=language,
+        )
+        self.prompt = self.model.get_prompt(
+            self.tokenizer, [], without_timestamps=True
+        )
+        self.nb_max_frames = self.model.feature_extractor.nb_max_frames
+        self.max_batch_size = max_batch_size
+        self.batch_timeout = batch_timeout
+        self.beam_size = beam_size
+
+        # requests
+        self._requests = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._thread = None
+        self._thread_active = False
+        self._stopped = False
+        self._lock = threading.Lock()
+
+        # stats
+        self.stats_window = stats_window
+        self._latencies = collections.defaultdict(
+            lambda: collections.deque(maxlen=self.stats_window)
+        )
+        self._total_audio_duration = 0.0
+        self._total_compute_time = 0.0
+        self._batch_sizes = collections.deque(maxlen=stats_window)
+
+    def start(self):
+        """Starts the Thread processing the requests, if it is not already
+        running."""
+        with self._lock:
+            self._stopped = False
+            self._start_thread()
+
+    def _start_thread(self):
+        """Starts the Thread processing the requests if it is not running,
+        the engine's lock has to be held."""
+        if self._thread_active:
+            return
+        self._thread_active = True
+        self._thread = threading.Thread(target=self._engine_thread, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the Thread processing the requests, once it has processed
+        its current batch. The pending requests are woken up with an error,
+        and the new ones are refused until the engine is started again."""
+        pending = []
+        with self._lock:
+            self._thread_active = False
+            self._stopped = True
+            thread = self._thread
+            while True:
+                try:
+                    pending.append(self._requests.get_nowait()[2])
+                except queue.Empty:
+                    break
+        for request in pending:
+            request.exception = RuntimeError("the WhisperASREngine is stopped")
+            request.done.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def transcribe(self, audio, stream_id, final=False):
+        """Submits a transcription request and waits for its result. The
+        engine is started by the first request, and a RuntimeError is raised
+        if it has been stopped (before or while the request was pending).
+
+        Args:
+            audio (np.ndarray): 16kHz float32 audio to transcribe.
+            stream_id (str): id of the stream submitting the request
+                (the id of the ASR module for example).
+            final (bool, optional): True if it is a final hypothesis
+                request, that will be processed before the interim
+                requests. Defaults to False.
+
+        Returns:
+            str: the transcription.
+        """
+        request = ASRRequest(stream_id, audio, final)
+        priority = 0 if final else 1
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("the WhisperASREngine is stopped")
+            self._start_thread()
+            self._requests.put((priority, next(self._counter), request))
+        request.done.wait()
+        if request.exception is not None:
+            raise request.exception
+        return request.transcription
+
+    def _next_batch(self):
+        """Returns the next batch of requests, by order of priority. Waits at
+        most batch_timeout seconds after the first request for other
+        requests to fill the batch.
+
+        Returns:
+            list[ASRRequest]: the batch of requests.
+        """
+        try:
+            _, _, request = self._requests.get(timeout=0.1)
+        except queue.Empty:
+            return []
+        batch = [request]
+        deadline = time.perf_counter() + self.batch_timeout
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    _, _, request = self._requests.get(timeout=remaining)
+                else:
+                    _, _, request = self._requests.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(request)
+        return batch
+
+    def get_features(self, audio):
+        """Computes the log-mel features of an audio, padded or trimmed to
+        the 30 seconds of Whisper's input window.
+
+        Args:
+            audio (np.ndarray): 16kHz float32 audio.
+
+        Returns:
+            np.ndarray: the features.
+        """
+        features = self.model.feature_extractor(audio)[..., : self.nb_max_frames]
+        if features.shape[-1] < self.nb_max_frames:
+            features = np.pad(
+                features, ((0, 0), (0, self.nb_max_frames - features.shape[-1]))
+            )
+        return features
+
+    def transcribe_batch(self, audios):
+        """Transcribes a batch of audios in a single encoder and decoder
+        CTranslate2 call. The audios longer than Whisper's 30 seconds input
+        window are transcribed separately with the full faster_whisper
+        pipeline.
+
+        Args:
+            audios (list[np.ndarray]): the 16kHz float32 audios.
+
+        Returns:
+            list[str]: the transcriptions.
+        """
+        transcriptions = [None] * len(audios)
+        batch_ids = []
+        for i, audio in enumerate(audios):
+            if len(audio) > self.nb_max_frames * self.model.feature_extractor.hop_length:
+                segments, _ = self.model.transcribe(audio, beam_size=self.beam_size)
+                transcriptions[i] = "".join([s.text for s in segments])
+            else:
+                batch_ids.append(i)
+
+        if len(batch_ids) != 0:
+            features = np.stack([self.get_features(audios[i]) for i in batch_ids])
+            encoder_output = self.model.encode(features)
+            results = self.model.model.generate(
+                encoder_output,
+                [self.prompt] * len(batch_ids),
+                beam_size=self.beam_size,
+                max_length=448,  # whisper's maximum decoding length
+                suppress_blank=True,
+            )
+            for i, result in zip(batch_ids, results):
+                transcriptions[i] = self.tokenizer.decode(result.sequences_ids[0])
+
+        return transcriptions
+
+    def _engine_thread(self):
+        """Function that runs on a separate thread.
+
+        Gets the next batch of requests, transcribes it, sets the
+        results and records the statistics.
+        """
+        while self._thread_active:
+            batch = self._next_batch()
+            if len(batch) == 0:
+                continue
+            start = time.perf_counter()
+            try:
+                transcriptions = self.transcribe_batch([r.audio for r in batch])
+            except Exception as e:
+                for request in batch:
+                    request.exception = e
+                    request.done.set()
+                continue
+            end = time.perf_counter()
+
+            with self._lock:
+                self._total_compute_time += end - start
+                self._batch_sizes.append(len(batch))
+                for request, transcription in zip(batch, transcriptions):
+                    self._total_audio_duration += len(request.audio) / self.SAMPLERATE
+                    self._latencies[request.stream_id].append(
+                        end - request.submitted_at
+                    )
+            for request, transcription in zip(batch, transcriptions):
+                request.transcription = transcription
+                request.done.set()
+
+    def reset_stats(self):
+        """Resets the engine statistics."""
+        with self._lock:
+            self._latencies.clear()
+            self._batch_sizes.clear()
+            self._total_audio_duration = 0.0
+            self._total_compute_time = 0.0
+
+    def get_stats(self):
+        """Returns the engine statistics : the aggregate real-time factor
+        (total computation time / total transcribed audio duration), the mean
+        batch size, and the latency percentiles (in seconds) of each stream.
+
+        Returns:
+            dict: the statistics.
+        """
+        with self._lock:
+            stats = {
+                "rtf": (
+                    self._total_compute_time / self._total_audio_duration
+                    if self._total_audio_duration > 0
+                    else None
+                ),
+                "mean_batch_size": (
+                    float(np.mean(self._batch_sizes))
+                    if len(self._batch_sizes) != 0
+                    else None
+                ),
+                "streams": {},
+            }
+            for stream_id, latencies in self._latencies.items():
+                p50, p95 = np.percentile(list(latencies), [50, 95])
+                stats["streams"][stream_id] = {
+                    "n_requests": len(latencies),
+                    "latency_p50": float(p50),
+                    "latency_p95": float(p95),
+                }
+        return stats
@@ -0,0 +1,31 @@
+"""Tests of the pickling of the IU classes of additional_IUs."""
+
+import pickle
+
+import numpy as np
+import pytest
+
+pytest.importorskip("retico_core")
+
+from simple_retico_agent.benchmarks import make_benchmark_ius
+
+
+@pytest.mark.parametrize("name", list(make_benchmark_ius()))
+def test_pickle_roundtrip(name):
+    iu = make_benchmark_ius()[name]
+    loaded = pickle.loads(pickle.dumps(iu))
+    assert type(loaded) is type(iu)
+    assert loaded.iuid == iu.iuid
+    assert loaded.creator.name() == iu.creator.name()
+    assert loaded.payload == iu.payload
+
+
+def test_pickle_memoryview_audio():
+    """The TTS's AudioFinalIUs have memoryview slices as raw audio."""
+    iu = make_benchmark_ius()["AudioFinalIU"]
+    buffer = np.arange(9600, dtype=np.int16)
+    iu.raw_audio = iu.payload = memoryview(buffer).cast("B")
+    loaded = pickle.loads(pickle.dumps(iu))
+    assert loaded.raw_audio == buffer.tobytes()
+    assert loaded.payload == buffer.tobytes()
+
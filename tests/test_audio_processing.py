@@ -0,0 +1,113 @@
+"""Tests of the streaming audio processing utilities (audio_processing)."""
+
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip("webrtcvad")
+
+from simple_retico_agent.audio_processing import PCMRingBuffer, StreamingResampler
+
+
+def random_audio(n_samples, seed=0):
+    rng = np.random.default_rng(seed)
+    return (rng.standard_normal(n_samples) * 3000).astype(np.int16)
+
+
+@pytest.mark.parametrize(
+    "input_rate, output_rate",
+    [(44100, 16000), (48000, 16000), (16000, 48000), (16000, 16000)],
+)
+def test_chunked_equals_whole(input_rate, output_rate):
+    x = random_audio(50000)
+    whole = StreamingResampler(input_rate, output_rate).process(x.tobytes())
+    resampler = StreamingResampler(input_rate, output_rate)
+    rng = np.random.default_rng(1)
+    chunks, position = [], 0
+    while position < len(x):
+        n = int(rng.integers(1, 3000))
+        chunks.append(resampler.process(x[position : position + n].tobytes()))
+        position += n
+    assert b"".join(chunks) == whole
+
+
+def test_exact_output_sample_counts():
+    resampler = StreamingResampler(44100, 16000)
+    x = random_audio(882)
+    n_output = 0
+    for i in range(1, 101):
+        n_output += len(resampler.process(x.tobytes())) // 2
+        assert n_output == -(-i * 882 * 16000 // 44100)
+    # 20ms chunks give 20ms chunks
+    assert n_output == 100 * 320
+
+
+def test_reset():
+    resampler = StreamingResampler(44100, 16000)
+    x = random_audio(4410)
+    first = resampler.process(x.tobytes())
+    resampler.process(random_audio(1000, seed=2).tobytes())
+    resampler.reset()
+    assert resampler.process(x.tobytes()) == first
+
+
+def test_lowpass():
+    """A tone above the output Nyquist frequency is attenuated."""
+    t = np.arange(44100) / 44100
+    tone = (10000 * np.sin(2 * np.pi * 12000 * t)).astype(np.int16)
+    y = np.frombuffer(
+        StreamingResampler(44100, 16000).process(tone.tobytes()), dtype=np.int16
+    )
+    assert np.abs(y[1000:]).max() < 100
+
+
+def test_ring_buffer_wraparound():
+    ring = PCMRingBuffer(10)
+    out = bytearray(10)
+    data = bytes(range(100))
+    read = b""
+    for start in range(0, 100, 7):
+        assert ring.write(data[start : start + 7]) == len(data[start : start + 7])
+        n = ring.read_into(memoryview(out)[:7])
+        read += bytes(out[:n])
+    assert read == data
+    assert ring.read_position == ring.write_position == 100
+
+
+def test_ring_buffer_underrun():
+    ring = PCMRingBuffer(16)
+    ring.write(b"abcd")
+    out = bytearray(b"x" * 8)
+    assert ring.read_into(memoryview(out)) == 4
+    assert bytes(out) == b"abcdxxxx"
+    assert ring.available() == 0
+    assert ring.read_into(memoryview(out)) == 0
+
+
+def test_ring_buffer_writer_waits_for_the_reader():
+    ring = PCMRingBuffer(8)
+    data = bytes(range(40))
+    thread = threading.Thread(target=ring.write, args=(data,))
+    thread.start()
+    read = b""
+    out = bytearray(3)
+    while len(read) < len(data):
+        n = ring.read_into(memoryview(out))
+        assert ring.available() <= ring.capacity
+        read += bytes(out[:n])
+    thread.join(1.0)
+    assert not thread.is_alive()
+    assert read == data
+
+
+def test_ring_buffer_close_releases_the_writer():
+    ring = PCMRingBuffer(4)
+    written = []
+    thread = threading.Thread(target=lambda: written.append(ring.write(b"x" * 10)))
+    thread.start()
+    thread.join(0.05)
+    assert thread.is_alive()
+    ring.close()
+    thread.join(1.0)
+    assert written == [4]
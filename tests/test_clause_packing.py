@@ -0,0 +1,65 @@
+"""Tests of the ClausePacker."""
+
+import time
+import types
+
+from simple_retico_agent.clause_packing import ClausePacker
+
+
+def make_clause(*tokens, final=False):
+    ius = [types.SimpleNamespace(text=token, final=False) for token in tokens]
+    ius[-1].final = final
+    return ius
+
+
+def test_short_clause_is_merged_with_the_next_one():
+    packer = ClausePacker(min_duration=0.6, chars_per_second=14.0)
+    hi = make_clause("Hi,")
+    assert packer.add(hi) == []
+    clause = make_clause(" how", " are", " you", " doing", " today?")
+    ready = packer.add(clause)
+    assert ready == [hi + clause]
+    assert packer.held_unit is None
+
+
+def test_long_clause_is_split_after_punctuation():
+    packer = ClausePacker(
+        target_duration=1.0, min_duration=0.0, max_duration=3.0, chars_per_second=10.0
+    )
+    clause = make_clause(
+        "First", " part", " of", " it,", " then", " the", " second", " part."
+    )
+    units = packer.add(clause)
+    assert len(units) == 2
+    assert ClausePacker.text(units[0]) == "First part of it,"
+    assert ClausePacker.text(units[1]) == " then the second part."
+    assert sum(units, []) == clause
+
+
+def test_agent_eot_releases_the_held_unit():
+    packer = ClausePacker()
+    hi = make_clause("Hi.")
+    eot = make_clause("", final=True)
+    assert packer.add(hi) == []
+    assert packer.add(eot) == [hi, eot]
+
+
+def test_held_unit_is_polled_after_hold_time_without_backlog():
+    packer = ClausePacker(hold_time=0.05)
+    hi = make_clause("Hi.")
+    packer.add(hi)
+    assert packer.poll() == []
+    time.sleep(0.06)
+    assert packer.poll(backlog_depth=1) == []
+    assert packer.poll() == [hi]
+    assert packer.poll() == []
+
+
+def test_observe_calibrates_the_speaking_rate():
+    packer = ClausePacker(chars_per_second=10.0)
+    packer.observe("", 1.0)
+    packer.observe("abc", 0.0)
+    assert packer.chars_per_second == 10.0
+    packer.observe("a" * 20, 1.0, smoothing=0.5)
+    assert packer.chars_per_second == 15.0
+
@@ -0,0 +1,58 @@
+"""Tests of the EventRecorder."""
+
+import types
+
+import pytest
+
+pytest.importorskip("retico_core")
+
+from simple_retico_agent.event_recorder import EventRecorder
+
+
+def make_recorder(**kwargs):
+    messages = []
+    module = types.SimpleNamespace(
+        file_logger=types.SimpleNamespace(
+            info=lambda event, **fields: messages.append((event, fields))
+        )
+    )
+    return EventRecorder(module, **kwargs), messages
+
+
+def test_one_message_per_event_in_order():
+    recorder, messages = make_recorder()
+    for event in ("VA_user", "VA_user", "VA_silence", "VA_user"):
+        recorder.record(event)
+    recorder.record("inter_clause_gap", duration=0.1)
+    recorder.flush()
+    assert [event for event, _ in messages] == [
+        "VA_user",
+        "VA_user",
+        "VA_silence",
+        "VA_user",
+        "inter_clause_gap",
+    ]
+    times = [fields["event_time"] for _, fields in messages]
+    assert times == sorted(times)
+    assert messages[-1][1]["duration"] == 0.1
+
+
+def test_aggregated_events_keep_their_times():
+    recorder, messages = make_recorder(aggregated_events=("output_audio",))
+    for _ in range(3):
+        recorder.record("output_audio")
+    recorder.record("output_silence")
+    recorder.flush()
+    assert [event for event, _ in messages] == ["output_silence", "output_audio"]
+    fields = messages[1][1]
+    assert fields["count"] == 3 and len(fields["event_times"]) == 3
+    assert fields["event_time"] == fields["event_times"][0]
+    assert fields["last_event_time"] == fields["event_times"][-1]
+
+
+def test_stop_flushes():
+    recorder, messages = make_recorder(flush_interval=10)
+    recorder.start()
+    recorder.record("VA_agent")
+    recorder.stop()
+    assert [event for event, _ in messages] == ["VA_agent"]
@@ -0,0 +1,98 @@
+"""Tests of the binary IU wire format (iu_serialization)."""
+
+import numpy as np
+import pytest
+
+retico_core = pytest.importorskip("retico_core")
+
+from simple_retico_agent.benchmarks import make_benchmark_ius
+from simple_retico_agent.iu_serialization import IURegistry, IUSerializer
+
+
+def roundtrip(update_message, receiver_registry=None):
+    """Encodes an UpdateMessage and decodes it with another registry."""
+    data = IUSerializer(IURegistry()).encode_update_message(update_message)
+    receiver = IUSerializer(receiver_registry or IURegistry())
+    return list(receiver.decode_update_message(data))
+
+
+@pytest.mark.parametrize("name", list(make_benchmark_ius()))
+def test_roundtrip_fields(name):
+    iu = make_benchmark_ius()[name]
+    [(decoded, ut)] = roundtrip(
+        retico_core.UpdateMessage.from_iu(iu, retico_core.UpdateType.ADD)
+    )
+    assert ut == retico_core.UpdateType.ADD
+    assert type(decoded) is type(iu)
+    assert decoded.iuid == iu.iuid
+    assert decoded.creator.name() == iu.creator.name()
+    for attribute in ("raw_audio", "rate", "nframes", "text", "final", "va_user"):
+        if hasattr(iu, attribute):
+            assert getattr(decoded, attribute) == getattr(iu, attribute)
+
+
+def test_update_in_place_and_links():
+    ius = make_benchmark_ius()
+    asr_iu, llm_iu = ius["SpeechRecognitionTimedIU"], ius["TextFinalIU"]
+    llm_iu.grounded_in = asr_iu
+    receiver_registry = IURegistry()
+    receiver_registry.register(asr_iu)
+    sender = IUSerializer(IURegistry())
+    receiver = IUSerializer(receiver_registry)
+    [(first, _)] = receiver.decode_update_message(
+        sender.encode_update_message(
+            retico_core.UpdateMessage.from_iu(llm_iu, retico_core.UpdateType.ADD)
+        )
+    )
+    assert first.grounded_in is asr_iu
+    llm_iu.committed = True
+    [(second, ut)] = receiver.decode_update_message(
+        sender.encode_update_message(
+            retico_core.UpdateMessage.from_iu(llm_iu, retico_core.UpdateType.COMMIT)
+        )
+    )
+    assert second is first
+    assert second.committed and ut == retico_core.UpdateType.COMMIT
+
+
+def test_unknown_type():
+    creator = make_benchmark_ius()["VADIU"].creator
+    iu = retico_core.IncrementalUnit(creator=creator, iuid="x:0")
+    with pytest.raises(ValueError):
+        IUSerializer(IURegistry()).encode_update_message(
+            retico_core.UpdateMessage.from_iu(iu, retico_core.UpdateType.ADD)
+        )
+
+
+def test_tts_audio_and_eot_ius():
+    """The AudioFinalIUs of the TTS have no nframes, and its agent EOT IU has
+    no audio at all."""
+    pytest.importorskip("TTS")
+    from simple_retico_agent.additional_IUs import TextFinalIU
+    from simple_retico_agent.audio_processing import to_int16_chunks
+    from simple_retico_agent.simple_tts import SimpleTTSModule
+
+    tts = SimpleTTSModule()
+    tts.samplerate = 48000
+    tts.chunk_size = 9600
+    clause = TextFinalIU(creator=tts, iuid="llm:0", text=" Hello.")
+    buffer = to_int16_chunks(np.linspace(-1, 1, 3 * 9600 - 100), tts.chunk_size)
+    audio_ius = tts.create_audio_ius(buffer, [clause])
+    eot = tts.create_iu(grounded_in=clause, final=True)
+
+    um = retico_core.UpdateMessage()
+    for iu in audio_ius + [eot]:
+        um.add_iu(iu, retico_core.UpdateType.ADD)
+    receiver_registry = IURegistry()
+    receiver_registry.register(clause)
+    decoded = roundtrip(um, receiver_registry)
+
+    assert len(decoded) == 4
+    for (iu, _), original in zip(decoded, audio_ius):
+        assert iu.raw_audio == bytes(original.raw_audio)
+        assert iu.rate == 48000 and iu.sample_width == 2
+        assert iu.nframes == original.nframes
+        assert iu.grounded_in is clause
+        assert not iu.final
+    eot_iu, _ = decoded[-1]
+    assert eot_iu.final and eot_iu.raw_audio is None and eot_iu.rate is None
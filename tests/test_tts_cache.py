@@ -0,0 +1,74 @@
+"""Tests of the TTSPhraseCache."""
+
+import numpy as np
+
+from simple_retico_agent.tts_cache import TTSPhraseCache
+
+
+def audio(n_samples, value=1):
+    return np.full(n_samples, value, dtype=np.int16)
+
+
+def test_key_normalization():
+    cache = TTSPhraseCache()
+    key = cache.make_key("Very  good!", "vits", "p225")
+    assert key == cache.make_key(" very good! ", "vits", "p225")
+    assert key != cache.make_key("Very good.", "vits", "p225")
+    assert key != cache.make_key("Very good!", "xtts", "p225")
+    assert key != cache.make_key("Very good!", "vits", "p226")
+
+
+def test_lru_eviction_within_the_byte_budget():
+    cache = TTSPhraseCache(max_bytes=300)
+    cache.put("a", audio(50), 0.1)
+    cache.put("b", audio(50), 0.1)
+    cache.put("c", audio(50), 0.1)
+    # "a" becomes the most recently used, "b" is evicted instead
+    assert cache.get("a") is not None
+    cache.put("d", audio(50), 0.1)
+    assert list(cache.entries) == ["c", "a", "d"]
+    assert cache.n_bytes == 300
+    assert cache.get("b") is None
+
+
+def test_buffer_larger_than_the_budget_is_not_kept():
+    cache = TTSPhraseCache(max_bytes=100)
+    cache.put("a", audio(10), 0.1)
+    cache.put("b", audio(100), 0.1)
+    assert list(cache.entries) == ["a"]
+    assert cache.n_bytes == 20
+
+
+def test_stats():
+    cache = TTSPhraseCache()
+    cache.put("a", audio(10), 0.5)
+    cache.get("a")
+    cache.get("a")
+    cache.get("b")
+    stats = cache.get_stats()
+    assert stats["n_hits"] == 2
+    assert stats["n_misses"] == 1
+    assert stats["saved_time"] == 1.0
+    assert stats["n_entries"] == 1
+
+
+def test_disk_store_round_trip(tmp_path):
+    buffer = np.arange(-500, 500, dtype=np.int16)
+    TTSPhraseCache(cache_dir=str(tmp_path)).put("a", buffer, 0.25, text="Hi.")
+    assert not list(tmp_path.glob("*.tmp"))
+
+    cache = TTSPhraseCache(cache_dir=str(tmp_path))
+    loaded = cache.get("a")
+    assert np.array_equal(loaded, buffer)
+    assert loaded.dtype == np.int16
+    assert cache.saved_time == 0.25
+    assert "a" in cache.entries
+
+
+def test_disk_store_survives_memory_eviction(tmp_path):
+    cache = TTSPhraseCache(max_bytes=100, cache_dir=str(tmp_path))
+    cache.put("a", audio(50, 1), 0.1)
+    cache.put("b", audio(50, 2), 0.1)
+    assert "a" not in cache.entries
+    assert np.array_equal(cache.get("a"), audio(50, 1))
+    assert cache.get_stats()["n_misses"] == 0
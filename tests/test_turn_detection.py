@@ -0,0 +1,80 @@
+"""Tests of the RingCounter and the VATurnDetector."""
+
+from simple_retico_agent.turn_detection import RingCounter, VATurnDetector
+
+
+def test_ring_counter_running_count():
+    counter = RingCounter(4)
+    for value in (True, True, False, True):
+        counter.push(value)
+    assert counter.is_full()
+    assert counter.count == 3
+    # the oldest values are replaced
+    counter.push(False)
+    counter.push(False)
+    assert counter.count == 1
+    counter.push(True)
+    assert counter.count == 2
+    assert counter.count == sum(counter.values)
+
+
+def test_ring_counter_reset():
+    counter = RingCounter(3)
+    counter.push(True)
+    counter.reset()
+    assert counter.count == 0
+    assert not counter.is_full()
+    for _ in range(3):
+        counter.push(False)
+    assert counter.is_full()
+    assert counter.count == 0
+
+
+def run(detector, va_user, chunk_duration=0.1):
+    return [detector.update(va, chunk_duration) for va in va_user]
+
+
+def test_bot_and_eot():
+    detector = VATurnDetector(bot_dur=0.4, eot_dur=1.0)
+    events = run(detector, [False] * 5 + [True] * 4)
+    # 75% of the 4 chunks of the BOT window with speech
+    assert events.index("user_BOT") == 7
+    assert detector.state == "user_speaking"
+
+    events = run(detector, [True] * 5 + [False] * 10)
+    # 75% of the 10 chunks of the EOT window without speech
+    assert events.index("user_EOT") == 11
+    assert detector.state == "user_silent"
+    assert abs(detector.silence_run_duration() - 1.0) < 1e-9
+
+
+def test_hysteresis_ignores_short_speech_and_pauses():
+    detector = VATurnDetector(bot_dur=0.4, eot_dur=1.0)
+    assert "user_BOT" not in run(detector, [True, True, False, False] * 5)
+    detector.set_state("user_speaking")
+    assert "user_EOT" not in run(detector, [False] * 5 + [True] * 5 + [False] * 5)
+
+
+def test_min_turn_duration():
+    detector = VATurnDetector(bot_dur=0.2, eot_dur=0.2, min_turn_dur=1.0)
+    assert run(detector, [True] * 2)[-1] == "user_BOT"
+    events = run(detector, [False] * 12)
+    assert events.index("user_EOT") == 9
+
+
+def test_longer_chunks_count_as_several_chunks():
+    detector = VATurnDetector(bot_dur=0.4, eot_dur=1.0)
+    detector.update(False, 0.1)
+    assert detector.update(True, 0.4) == "user_BOT"
+    assert detector.update(False, 0.5) is None
+    assert detector.silence_run == 5
+    assert detector.update(False, 0.5) == "user_EOT"
+
+
+def test_set_state_resets_the_next_window():
+    detector = VATurnDetector(bot_dur=0.4, eot_dur=1.0)
+    run(detector, [True] * 3)
+    detector.set_state("user_silent")
+    assert detector.bot_window.count == 0
+    assert "user_BOT" not in run(detector, [True] * 3)
+    assert run(detector, [True])[-1] == "user_BOT"